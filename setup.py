@@ -1,6 +1,6 @@
 from setuptools import setup
 
-dependencies = ["aioamqp", "jsonschema", "pydantic", "pyyaml"]
+dependencies = ["aioamqp", "jsonschema", "pamqp", "pydantic", "pyyaml"]
 
 setup(
     name="twyla.service",
@@ -11,6 +11,10 @@ setup(
     install_requires=dependencies,
     extras_require={
         'test': ['pytest'],
+        'fast': ['orjson', 'fastjsonschema'],
+        'msgpack': ['msgpack'],
+        'compression': ['zstandard', 'lz4'],
+        'uvloop': ['uvloop'],
     },
     packages=["twyla.service"],
     entry_points={},
@@ -0,0 +1,906 @@
+"""
+AMQP 0-9-1 client on asyncio with a fast path for publishing and consuming.
+
+connect has the signature of aioamqp.connect and returns a protocol whose
+channels implement the part of the aioamqp channel API QueueManager uses (see
+twyla.service.transports). Connection setup, declarations and other rarely
+sent methods are encoded and decoded with pamqp. The frames of the hot path,
+basic.publish with its content header and body, basic.deliver, acks, rejects
+and publisher confirms, are encoded and decoded here with precompiled structs:
+
+- publishes are written into a preallocated buffer, which is reused as long as
+  the transport writes it out right away;
+- incoming data is read into a preallocated buffer (asyncio.BufferedProtocol)
+  and frames are decoded from memoryview slices of it, so only message bodies
+  are copied out.
+
+QueueManager (and thus EventBus) use it with the transport set to 'amqp':
+
+    EVENT_BUS_TRANSPORT=amqp
+"""
+import asyncio
+import collections
+import datetime
+import logging
+import struct
+import uuid
+
+from aioamqp.envelope import Envelope
+from aioamqp.exceptions import (AmqpClosedConnection, ChannelClosed,
+                                PublishFailed)
+from aioamqp.properties import Properties
+from aioamqp.protocol import CLOSED, CLOSING, CONNECTING, OPEN
+from pamqp import commands
+from pamqp import decode as pamqp_decode
+from pamqp import encode as pamqp_encode
+from pamqp import frame as pamqp_frame
+
+logger = logging.getLogger(__name__)
+
+PROTOCOL_HEADER = b'AMQP\x00\x00\x09\x01'
+FRAME_METHOD = 1
+FRAME_HEADER = 2
+FRAME_BODY = 3
+FRAME_HEARTBEAT = 8
+FRAME_END = 0xCE
+HEARTBEAT = b'\x08\x00\x00\x00\x00\x00\x00\xce'
+# Type, channel and size before, frame end after the payload of a frame
+FRAME_OVERHEAD = 8
+
+BASIC = 60
+BASIC_PUBLISH = 40
+BASIC_RETURN = 50
+BASIC_DELIVER = 60
+BASIC_ACK = 80
+BASIC_REJECT = 90
+BASIC_NACK = 120
+
+FRAME = struct.Struct('!BHI')
+METHOD = struct.Struct('!HH')
+# basic.publish up to the exchange name: class, method and reserved ticket
+PUBLISH = struct.Struct('!HHH')
+# class, weight, body size and property flags
+CONTENT_HEADER = struct.Struct('!HHQH')
+# A whole basic.ack, basic.reject or basic.nack frame: delivery tag and bits
+SETTLE = struct.Struct('!BHIHHQBB')
+SETTLE_SIZE = SETTLE.size - FRAME.size - 1
+UINT32 = struct.Struct('!I')
+UINT64 = struct.Struct('!Q')
+
+SHORTSTR = 0
+TABLE = 1
+OCTET = 2
+TIMESTAMP = 3
+
+# Basic properties in wire order: name (as in aioamqp), flag and type
+PROPERTIES = (
+    ('content_type', 0x8000, SHORTSTR),
+    ('content_encoding', 0x4000, SHORTSTR),
+    ('headers', 0x2000, TABLE),
+    ('delivery_mode', 0x1000, OCTET),
+    ('priority', 0x0800, OCTET),
+    ('correlation_id', 0x0400, SHORTSTR),
+    ('reply_to', 0x0200, SHORTSTR),
+    ('expiration', 0x0100, SHORTSTR),
+    ('message_id', 0x0080, SHORTSTR),
+    ('timestamp', 0x0040, TIMESTAMP),
+    ('message_type', 0x0020, SHORTSTR),
+    ('user_id', 0x0010, SHORTSTR),
+    ('app_id', 0x0008, SHORTSTR),
+    ('cluster_id', 0x0004, SHORTSTR),
+)
+PROPERTY_ORDER = {name: index for index, (name, _, _) in enumerate(PROPERTIES)}
+# Longest encoding of a property other than the headers table
+PROPERTY_MAX_SIZE = 256
+
+BUFFER_SIZE = 256 * 1024
+FRAME_MAX = 128 * 1024
+CHANNEL_MAX = 2047
+
+
+def encode_timestamp(value):
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            # Like pamqp, naive datetimes are UTC
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        value = value.timestamp()
+    return int(value)
+
+
+def encode_shortstr(value):
+    if isinstance(value, str):
+        value = value.encode()
+    if len(value) > 255:
+        raise ValueError(f'{value[:16]!r}... is too long for a short string')
+    return value
+
+
+class FrameEncoder:
+    """Encodes basic.publish frames into a reusable buffer.
+
+    encode_publish returns a memoryview of the buffer. Once it is handed to
+    the transport, call release if the transport did not write all of it right
+    away, as it may keep a reference to the data instead of copying it; the
+    next message is then written into a new buffer.
+    """
+
+    def __init__(self, size: int=BUFFER_SIZE):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+
+
+    def reserve(self, size: int):
+        if self.buffer is None:
+            # Sized to the message, as it may be released again right away
+            self.buffer = bytearray(size)
+        elif len(self.buffer) < size:
+            self.buffer = bytearray(max(size, 2 * len(self.buffer)))
+        else:
+            return
+        self.view = memoryview(self.buffer)
+
+
+    def release(self):
+        self.buffer = self.view = None
+
+
+    # pylint: disable-msg=too-many-arguments,too-many-locals
+    def encode_publish(self, channel_id: int, exchange_name: str,
+                       routing_key: str, body: bytes, properties: dict,
+                       frame_max: int, mandatory: bool=False,
+                       immediate: bool=False):
+        """Encode the method, content header and body frames of a message"""
+        exchange_name = encode_shortstr(exchange_name)
+        routing_key = encode_shortstr(routing_key)
+        headers = properties.get('headers') if properties else None
+        if headers is not None:
+            headers = pamqp_encode.field_table(headers)
+        body_size = len(body)
+        chunk_size = frame_max - FRAME_OVERHEAD
+        body_frames = -(-body_size // chunk_size)
+        self.reserve(
+            # method frame
+            FRAME_OVERHEAD + PUBLISH.size + 2 + len(exchange_name) +
+            len(routing_key) + 1 +
+            # content header frame
+            FRAME_OVERHEAD + CONTENT_HEADER.size +
+            (len(properties) * PROPERTY_MAX_SIZE if properties else 0) +
+            (len(headers) if headers is not None else 0) +
+            # body frames
+            body_size + body_frames * FRAME_OVERHEAD)
+        buffer, view = self.buffer, self.view
+
+        # basic.publish, its size is filled in once the payload is written
+        PUBLISH.pack_into(buffer, FRAME.size, BASIC, BASIC_PUBLISH, 0)
+        offset = FRAME.size + PUBLISH.size
+        for value in (exchange_name, routing_key):
+            length = len(value)
+            buffer[offset] = length
+            view[offset + 1:offset + 1 + length] = value
+            offset += 1 + length
+        buffer[offset] = mandatory | immediate << 1
+        offset = self.end_frame(FRAME_METHOD, channel_id, 0, offset + 1)
+
+        # content header
+        start = offset
+        offset += FRAME.size + CONTENT_HEADER.size
+        flags = 0
+        if properties:
+            flags, offset = self.encode_properties(properties, headers,
+                                                   offset)
+        CONTENT_HEADER.pack_into(buffer, start + FRAME.size, BASIC, 0,
+                                 body_size, flags)
+        offset = self.end_frame(FRAME_HEADER, channel_id, start, offset)
+
+        # body, split into frames of at most frame_max
+        body = memoryview(body)
+        for position in range(0, body_size, chunk_size):
+            chunk = body[position:position + chunk_size]
+            start = offset
+            offset += FRAME.size
+            view[offset:offset + len(chunk)] = chunk
+            offset = self.end_frame(FRAME_BODY, channel_id, start,
+                                    offset + len(chunk))
+        return view[:offset]
+
+
+    def end_frame(self, frame_type, channel_id, start, offset):
+        # Write the frame header and end of the frame starting at start
+        FRAME.pack_into(self.buffer, start, frame_type, channel_id,
+                        offset - start - FRAME.size)
+        self.buffer[offset] = FRAME_END
+        return offset + 1
+
+
+    def encode_properties(self, properties, headers, offset):
+        buffer, view = self.buffer, self.view
+        flags = 0
+        names = properties
+        if len(names) > 1:
+            names = sorted(names, key=PROPERTY_ORDER.__getitem__)
+        for name in names:
+            value = properties[name]
+            if value is None:
+                continue
+            _, flag, kind = PROPERTIES[PROPERTY_ORDER[name]]
+            flags |= flag
+            if kind == SHORTSTR:
+                value = encode_shortstr(value)
+                length = len(value)
+                buffer[offset] = length
+                view[offset + 1:offset + 1 + length] = value
+                offset += 1 + length
+            elif kind == OCTET:
+                buffer[offset] = value
+                offset += 1
+            elif kind == TIMESTAMP:
+                UINT64.pack_into(buffer, offset, encode_timestamp(value))
+                offset += UINT64.size
+            else:
+                view[offset:offset + len(headers)] = headers
+                offset += len(headers)
+        return flags, offset
+
+
+def decode_shortstr(view, offset):
+    length = view[offset]
+    end = offset + 1 + length
+    return str(view[offset + 1:end], 'utf-8'), end
+
+
+def decode_properties(view, flags):
+    """Decode the properties of a content header from a memoryview"""
+    properties = Properties()
+    if not flags:
+        return properties
+    offset = 0
+    for name, flag, kind in PROPERTIES:
+        if not flags & flag:
+            continue
+        if kind == SHORTSTR:
+            value, offset = decode_shortstr(view, offset)
+        elif kind == OCTET:
+            value = view[offset]
+            offset += 1
+        elif kind == TIMESTAMP:
+            value = datetime.datetime.fromtimestamp(
+                UINT64.unpack_from(view, offset)[0], datetime.timezone.utc)
+            offset += UINT64.size
+        else:
+            size = UINT32.size + UINT32.unpack_from(view, offset)[0]
+            _, value = pamqp_decode.field_table(
+                bytes(view[offset:offset + size]))
+            offset += size
+        setattr(properties, name, value)
+    return properties
+
+
+class Delivery:
+    """A message whose content frames are still being received"""
+    __slots__ = ('consumer_tag', 'delivery_tag', 'redelivered',
+                 'exchange_name', 'routing_key', 'properties', 'body',
+                 'body_size', 'received')
+
+    def __init__(self, consumer_tag, delivery_tag, redelivered,
+                 exchange_name, routing_key):
+        self.consumer_tag = consumer_tag
+        self.delivery_tag = delivery_tag
+        self.redelivered = redelivered
+        self.exchange_name = exchange_name
+        self.routing_key = routing_key
+        self.properties = None
+        self.body = None
+        self.body_size = 0
+        self.received = 0
+
+
+def decode_deliver(view):
+    """Decode the arguments of basic.deliver following class and method"""
+    consumer_tag, offset = decode_shortstr(view, METHOD.size)
+    delivery_tag, = UINT64.unpack_from(view, offset)
+    offset += UINT64.size
+    redelivered = bool(view[offset] & 1)
+    exchange_name, offset = decode_shortstr(view, offset + 1)
+    routing_key, _ = decode_shortstr(view, offset)
+    return Delivery(consumer_tag, delivery_tag, redelivered, exchange_name,
+                    routing_key)
+
+
+class Channel:
+
+    # pylint: disable-msg=too-many-instance-attributes
+    def __init__(self, protocol, channel_id: int):
+        self.protocol = protocol
+        self.channel_id = channel_id
+        self.is_open = False
+        self.close_reason = None
+        # Synchronous methods are sent one at a time, waiting for the reply
+        self.rpc_lock = asyncio.Lock()
+        self.waiter = None
+        self.publisher_confirms = False
+        self.next_publish_tag = 1
+        # delivery tag -> future of messages waiting for their confirm
+        self.confirms = {}
+        # consumer tag -> callback
+        self.consumers = {}
+        # Message being received (basic.deliver or basic.return) or None
+        self.content = None
+        self.deliveries = collections.deque()
+        self.delivering = None
+
+
+    def check_open(self):
+        if not self.is_open:
+            raise self.close_reason or ChannelClosed()
+
+
+    async def rpc(self, method, reply=None):
+        """Send a synchronous method and wait for the reply of type reply"""
+        async with self.rpc_lock:
+            self.check_open()
+            if reply is None:
+                self.protocol.send_method(self.channel_id, method)
+                return None
+            waiter = self.protocol.loop.create_future()
+            self.waiter = (reply, waiter)
+            self.protocol.send_method(self.channel_id, method)
+            try:
+                return await waiter
+            finally:
+                self.waiter = None
+
+
+    async def open(self):
+        self.is_open = True
+        await self.rpc(commands.Channel.Open(), commands.Channel.OpenOk)
+
+
+    async def exchange_declare(self, exchange_name, type_name, passive=False,
+                               durable=False, auto_delete=False,
+                               no_wait=False, arguments=None):
+        await self.rpc(
+            commands.Exchange.Declare(
+                exchange=exchange_name, exchange_type=type_name,
+                passive=passive, durable=durable, auto_delete=auto_delete,
+                nowait=no_wait, arguments=arguments),
+            None if no_wait else commands.Exchange.DeclareOk)
+        return True
+
+
+    async def queue_declare(self, queue_name='', passive=False,
+                            durable=False, exclusive=False,
+                            auto_delete=False, no_wait=False,
+                            arguments=None):
+        reply = await self.rpc(
+            commands.Queue.Declare(
+                queue=queue_name, passive=passive, durable=durable,
+                exclusive=exclusive, auto_delete=auto_delete, nowait=no_wait,
+                arguments=arguments),
+            None if no_wait else commands.Queue.DeclareOk)
+        if reply is None:
+            return None
+        return {'queue': reply.queue,
+                'message_count': reply.message_count,
+                'consumer_count': reply.consumer_count}
+
+
+    async def queue_bind(self, queue_name, exchange_name, routing_key,
+                         no_wait=False, arguments=None):
+        await self.rpc(
+            commands.Queue.Bind(
+                queue=queue_name, exchange=exchange_name,
+                routing_key=routing_key, nowait=no_wait, arguments=arguments),
+            None if no_wait else commands.Queue.BindOk)
+        return True
+
+
+    async def basic_qos(self, prefetch_size=0, prefetch_count=0,
+                        connection_global=False):
+        await self.rpc(commands.Basic.Qos(prefetch_size=prefetch_size,
+                                          prefetch_count=prefetch_count,
+                                          global_=connection_global),
+                       commands.Basic.QosOk)
+
+
+    async def confirm_select(self, no_wait=False):
+        await self.rpc(commands.Confirm.Select(nowait=no_wait),
+                       None if no_wait else commands.Confirm.SelectOk)
+        self.publisher_confirms = True
+
+
+    async def publish(self, payload, exchange_name, routing_key,
+                      properties=None, mandatory=False, immediate=False):
+        self.check_open()
+        protocol = self.protocol
+        if protocol.paused is not None:
+            await protocol.drain()
+            self.check_open()
+        if isinstance(payload, str):
+            payload = payload.encode()
+        encoder = protocol.encoder
+        protocol.send(encoder.encode_publish(
+            self.channel_id, exchange_name, routing_key, payload,
+            properties, protocol.frame_max, mandatory, immediate))
+        if protocol.transport.get_write_buffer_size():
+            encoder.release()
+        delivery_tag = self.next_publish_tag
+        self.next_publish_tag += 1
+        # Like aioamqp, wait for the confirm unless basic_server_ack was taken
+        # over (see queues.ConfirmTracker)
+        if self.publisher_confirms:
+            confirmed = protocol.loop.create_future()
+            self.confirms[delivery_tag] = confirmed
+            await confirmed
+
+
+    async def basic_server_ack(self, frame):
+        self.resolve_confirms(frame.delivery_tag, frame.multiple)
+
+
+    async def basic_server_nack(self, frame, delivery_tag=None):
+        self.resolve_confirms(frame.delivery_tag, frame.multiple,
+                              PublishFailed)
+
+
+    def resolve_confirms(self, delivery_tag, multiple, error=None):
+        if multiple:
+            tags = [tag for tag in self.confirms if tag <= delivery_tag]
+        else:
+            tags = [delivery_tag] if delivery_tag in self.confirms else []
+        for tag in tags:
+            confirmed = self.confirms.pop(tag)
+            if confirmed.done():
+                continue
+            if error is None:
+                confirmed.set_result(True)
+            else:
+                confirmed.set_exception(error(tag))
+
+
+    async def basic_consume(self, callback, queue_name='', consumer_tag='',
+                            no_local=False, no_ack=False, exclusive=False,
+                            no_wait=False, arguments=None):
+        if not consumer_tag:
+            # Like aioamqp, so the callback can be registered before sending:
+            # deliveries may arrive in the same read as ConsumeOk.
+            consumer_tag = f'ctag{self.channel_id}.{uuid.uuid4().hex}'
+        self.consumers[consumer_tag] = callback
+        try:
+            await self.rpc(
+                commands.Basic.Consume(
+                    queue=queue_name, consumer_tag=consumer_tag,
+                    no_local=no_local, no_ack=no_ack, exclusive=exclusive,
+                    nowait=no_wait, arguments=arguments),
+                None if no_wait else commands.Basic.ConsumeOk)
+        except Exception:
+            self.consumers.pop(consumer_tag, None)
+            raise
+        return {'consumer_tag': consumer_tag}
+
+
+    async def basic_cancel(self, consumer_tag, no_wait=False):
+        await self.rpc(commands.Basic.Cancel(consumer_tag=consumer_tag,
+                                             nowait=no_wait),
+                       None if no_wait else commands.Basic.CancelOk)
+        self.consumers.pop(consumer_tag, None)
+        return {'consumer_tag': consumer_tag}
+
+
+    async def basic_client_ack(self, delivery_tag, multiple=False):
+        self.check_open()
+        self.protocol.send(SETTLE.pack(
+            FRAME_METHOD, self.channel_id, SETTLE_SIZE, BASIC, BASIC_ACK,
+            delivery_tag, multiple, FRAME_END))
+
+
+    async def basic_reject(self, delivery_tag, requeue=False):
+        self.check_open()
+        self.protocol.send(SETTLE.pack(
+            FRAME_METHOD, self.channel_id, SETTLE_SIZE, BASIC, BASIC_REJECT,
+            delivery_tag, requeue, FRAME_END))
+
+
+    async def close(self, reply_code=0, reply_text='Normal Shutdown'):
+        await self.rpc(commands.Channel.Close(reply_code=reply_code,
+                                              reply_text=reply_text,
+                                              class_id=0, method_id=0),
+                       commands.Channel.CloseOk)
+        self.closed(ChannelClosed(reply_code, reply_text))
+
+
+    def closed(self, reason):
+        """Forget the state of the channel after it was closed"""
+        self.is_open = False
+        self.close_reason = reason
+        self.protocol.channels.pop(self.channel_id, None)
+        if self.waiter is not None and not self.waiter[1].done():
+            self.waiter[1].set_exception(reason)
+        for confirmed in self.confirms.values():
+            if not confirmed.done():
+                confirmed.set_exception(reason)
+        self.confirms.clear()
+        self.consumers.clear()
+        self.content = None
+        # The broker requeues unacknowledged deliveries
+        self.deliveries.clear()
+
+
+    def handle_method(self, class_id, method_id, payload):
+        # The hot path: decoded here without pamqp
+        if class_id == BASIC:
+            if method_id == BASIC_DELIVER:
+                self.content = decode_deliver(payload)
+                return
+            if method_id in (BASIC_ACK, BASIC_NACK):
+                delivery_tag, = UINT64.unpack_from(payload, METHOD.size)
+                bits = payload[METHOD.size + UINT64.size]
+                if method_id == BASIC_ACK:
+                    handler = self.basic_server_ack
+                    frame = commands.Basic.Ack(delivery_tag, bool(bits & 1))
+                else:
+                    handler = self.basic_server_nack
+                    frame = commands.Basic.Nack(delivery_tag, bool(bits & 1),
+                                                bool(bits & 2))
+                asyncio.ensure_future(handler(frame))
+                return
+        _, _, method = pamqp_frame.unmarshal(
+            bytes(self.protocol.frame_bytes(payload)))
+        self.handle_pamqp_method(method)
+
+
+    def handle_pamqp_method(self, method):
+        if isinstance(method, commands.Channel.Close):
+            self.protocol.send_method(self.channel_id,
+                                      commands.Channel.CloseOk())
+            self.closed(ChannelClosed(method.reply_code, method.reply_text))
+        elif isinstance(method, commands.Channel.Flow):
+            self.protocol.send_method(
+                self.channel_id, commands.Channel.FlowOk(active=method.active))
+        elif isinstance(method, commands.Basic.Return):
+            logger.warning("Message to %s with routing key %s returned: %s",
+                           method.exchange, method.routing_key,
+                           method.reply_text)
+            # The content frames that follow are dropped
+            self.content = Delivery(None, None, False, method.exchange,
+                                    method.routing_key)
+        elif isinstance(method, commands.Basic.Cancel):
+            logger.warning("Consumer %s was cancelled by the broker",
+                           method.consumer_tag)
+            self.consumers.pop(method.consumer_tag, None)
+        elif self.waiter is not None and isinstance(method, self.waiter[0]):
+            if not self.waiter[1].done():
+                self.waiter[1].set_result(method)
+        else:
+            logger.warning("Unexpected %s on channel %d", method.name,
+                           self.channel_id)
+
+
+    def handle_header(self, payload):
+        content = self.content
+        if content is None:
+            return
+        _, _, body_size, flags = CONTENT_HEADER.unpack_from(payload)
+        content.properties = decode_properties(
+            payload[CONTENT_HEADER.size:], flags)
+        content.body_size = body_size
+        if body_size == 0:
+            content.body = b''
+            self.content_received()
+
+
+    def handle_body(self, payload):
+        content = self.content
+        if content is None:
+            return
+        size = len(payload)
+        if content.received == 0 and size == content.body_size:
+            # The whole body in one frame
+            content.body = bytes(payload)
+            self.content_received()
+            return
+        # Otherwise the frames are copied out and joined once all arrived
+        if content.body is None:
+            content.body = []
+        content.body.append(bytes(payload))
+        content.received += size
+        if content.received >= content.body_size:
+            content.body = b''.join(content.body)
+            self.content_received()
+
+
+    def content_received(self):
+        content, self.content = self.content, None
+        callback = self.consumers.get(content.consumer_tag)
+        if callback is None:
+            return
+        self.deliveries.append((callback, content))
+        if self.delivering is None:
+            self.delivering = asyncio.ensure_future(self.run_deliveries())
+
+
+    async def run_deliveries(self):
+        # Like aioamqp, callbacks of a channel are awaited one after another
+        try:
+            while self.deliveries and self.is_open:
+                callback, content = self.deliveries.popleft()
+                envelope = Envelope(content.consumer_tag,
+                                    content.delivery_tag,
+                                    content.exchange_name,
+                                    content.routing_key,
+                                    content.redelivered)
+                try:
+                    await callback(self, content.body, envelope,
+                                   content.properties)
+                except Exception: # pylint: disable-msg=broad-except
+                    logger.exception("Error in consumer callback")
+        finally:
+            self.delivering = None
+
+
+class Protocol(asyncio.BufferedProtocol):
+    """A connection to the broker"""
+
+    # pylint: disable-msg=too-many-instance-attributes,too-many-arguments
+    def __init__(self, login, password, virtualhost, heartbeat, loop,
+                 buffer_size: int=BUFFER_SIZE):
+        self.login = login
+        self.password = password
+        self.virtualhost = virtualhost
+        self.heartbeat = heartbeat
+        self.loop = loop
+        self.state = CONNECTING
+        self.transport = None
+        self.frame_max = FRAME_MAX
+        self.channel_max = CHANNEL_MAX
+        self.channels = {}
+        self.next_channel_id = 1
+        self.encoder = FrameEncoder()
+        # Received data is in buffer[start:end]
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        # Start of the frame being handled in buffer, see frame_bytes
+        self.frame_start = 0
+        self.opened = loop.create_future()
+        self.closed = asyncio.Event()
+        self.paused = None
+        self.heartbeat_timer = None
+        self.sent = False
+        self.received = False
+        self.missed_heartbeats = 0
+
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.write(PROTOCOL_HEADER)
+
+
+    def connection_lost(self, exc):
+        self.state = CLOSED
+        reason = AmqpClosedConnection(exc) if exc else AmqpClosedConnection()
+        if not self.opened.done():
+            self.opened.set_exception(reason)
+        for channel in list(self.channels.values()):
+            channel.closed(reason)
+        if self.heartbeat_timer is not None:
+            self.heartbeat_timer.cancel()
+        if self.paused is not None and not self.paused.done():
+            self.paused.set_exception(reason)
+        self.closed.set()
+
+
+    def pause_writing(self):
+        self.paused = self.loop.create_future()
+
+
+    def resume_writing(self):
+        paused, self.paused = self.paused, None
+        if paused is not None and not paused.done():
+            paused.set_result(None)
+
+
+    async def drain(self):
+        if self.paused is not None:
+            await asyncio.shield(self.paused)
+
+
+    def send(self, data):
+        self.transport.write(data)
+        self.sent = True
+
+
+    def send_method(self, channel_id, method):
+        self.send(pamqp_frame.marshal(method, channel_id))
+
+
+    def get_buffer(self, sizehint):
+        if len(self.buffer) - self.end < 4096:
+            self.make_room(4096)
+        return self.view[self.end:]
+
+
+    def make_room(self, size):
+        # Move the unprocessed data to the front, or into a larger buffer if
+        # that is not enough
+        pending = self.end - self.start
+        if pending + size > len(self.buffer):
+            buffer = bytearray(max(2 * len(self.buffer), pending + size))
+            buffer[:pending] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        elif pending:
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+        self.start = 0
+        self.end = pending
+
+
+    def buffer_updated(self, nbytes):
+        self.end += nbytes
+        self.received = True
+        buffer, view = self.buffer, self.view
+        start, end = self.start, self.end
+        while end - start >= FRAME.size:
+            frame_type, channel_id, size = FRAME.unpack_from(buffer, start)
+            frame_end = start + FRAME.size + size
+            if frame_end >= end:
+                if frame_end >= len(buffer):
+                    self.start = start
+                    self.make_room(size + FRAME_OVERHEAD)
+                    return
+                break
+            if buffer[frame_end] != FRAME_END:
+                logger.error("Invalid frame end, closing the connection")
+                self.transport.close()
+                return
+            self.frame_start = start
+            self.handle_frame(frame_type, channel_id,
+                              view[start + FRAME.size:frame_end])
+            start = frame_end + 1
+        if start == end:
+            start = end = 0
+        self.start, self.end = start, end
+
+
+    def frame_bytes(self, payload):
+        # The whole frame of a payload handed to handle_frame
+        start = self.frame_start
+        return self.view[start:start + FRAME_OVERHEAD + len(payload)]
+
+
+    def handle_frame(self, frame_type, channel_id, payload):
+        if frame_type == FRAME_HEARTBEAT:
+            return
+        if channel_id == 0:
+            self.handle_connection_method(payload)
+            return
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            return
+        if frame_type == FRAME_BODY:
+            channel.handle_body(payload)
+        elif frame_type == FRAME_METHOD:
+            class_id, method_id = METHOD.unpack_from(payload)
+            channel.handle_method(class_id, method_id, payload)
+        elif frame_type == FRAME_HEADER:
+            channel.handle_header(payload)
+
+
+    def handle_connection_method(self, payload):
+        _, _, method = pamqp_frame.unmarshal(
+            bytes(self.frame_bytes(payload)))
+        if isinstance(method, commands.Connection.Start):
+            self.send_method(0, commands.Connection.StartOk(
+                client_properties={
+                    'product': 'twyla.service',
+                    'capabilities': {'publisher_confirms': True,
+                                     'basic.nack': True,
+                                     'consumer_cancel_notify': True}},
+                mechanism='PLAIN',
+                response=f'\0{self.login}\0{self.password}'))
+        elif isinstance(method, commands.Connection.Tune):
+            self.tune(method)
+        elif isinstance(method, commands.Connection.OpenOk):
+            self.state = OPEN
+            if not self.opened.done():
+                self.opened.set_result(None)
+        elif isinstance(method, commands.Connection.Close):
+            logger.warning("Connection closed by the broker: %s %s",
+                           method.reply_code, method.reply_text)
+            self.send_method(0, commands.Connection.CloseOk())
+            self.state = CLOSING
+            if not self.opened.done():
+                self.opened.set_exception(AmqpClosedConnection(
+                    method.reply_code, method.reply_text))
+            self.transport.close()
+        elif isinstance(method, commands.Connection.CloseOk):
+            self.transport.close()
+        elif isinstance(method, commands.Connection.Blocked):
+            logger.warning("Connection blocked by the broker: %s",
+                           method.reason)
+
+
+    def tune(self, method):
+        def negotiate(ours, theirs):
+            return min(ours, theirs) if ours and theirs else ours or theirs
+        self.channel_max = negotiate(CHANNEL_MAX, method.channel_max)
+        self.frame_max = negotiate(FRAME_MAX, method.frame_max)
+        self.heartbeat = negotiate(self.heartbeat, method.heartbeat)
+        self.send_method(0, commands.Connection.TuneOk(
+            channel_max=self.channel_max, frame_max=self.frame_max,
+            heartbeat=self.heartbeat))
+        self.send_method(0, commands.Connection.Open(
+            virtual_host=self.virtualhost))
+        if self.heartbeat:
+            self.heartbeat_timer = self.loop.call_later(self.heartbeat,
+                                                        self.beat)
+
+
+    def beat(self):
+        # Send a heartbeat if nothing else was sent and close the connection
+        # after two intervals without receiving anything
+        if not self.sent:
+            self.transport.write(HEARTBEAT)
+        self.sent = False
+        if self.received:
+            self.missed_heartbeats = 0
+        else:
+            self.missed_heartbeats += 1
+            if self.missed_heartbeats >= 2:
+                logger.error("Missed heartbeats, closing the connection")
+                self.transport.close()
+                return
+        self.received = False
+        self.heartbeat_timer = self.loop.call_later(self.heartbeat, self.beat)
+
+
+    async def channel(self):
+        if self.state != OPEN:
+            raise AmqpClosedConnection()
+        channel_id = self.next_channel_id
+        while channel_id in self.channels:
+            channel_id = channel_id % self.channel_max + 1
+            if channel_id == self.next_channel_id:
+                raise AmqpClosedConnection('No channels left')
+        self.next_channel_id = channel_id % self.channel_max + 1
+        channel = Channel(self, channel_id)
+        self.channels[channel_id] = channel
+        await channel.open()
+        return channel
+
+
+    async def close(self, no_wait=False, timeout=None):
+        if self.state != OPEN:
+            return
+        self.state = CLOSING
+        self.send_method(0, commands.Connection.Close(
+            reply_code=0, reply_text='Normal Shutdown', class_id=0,
+            method_id=0))
+        if not no_wait:
+            try:
+                await asyncio.wait_for(asyncio.shield(self.closed.wait()),
+                                       timeout)
+            except asyncio.TimeoutError:
+                self.transport.close()
+
+
+    async def wait_closed(self, timeout=None):
+        await asyncio.wait_for(self.closed.wait(), timeout)
+
+
+# pylint: disable-msg=unused-argument,too-many-arguments
+async def connect(host='localhost', port=None, login='guest',
+                  password='guest', virtualhost='/', ssl=None, heartbeat=60,
+                  loop=None, **kwargs):
+    """Open a connection and return (transport, protocol) like aioamqp"""
+    loop = loop or asyncio.get_event_loop()
+    port = port or (5671 if ssl else 5672)
+    transport, protocol = await loop.create_connection(
+        lambda: Protocol(login, password, virtualhost, heartbeat, loop),
+        host, port, ssl=ssl)
+    try:
+        await protocol.opened
+    except Exception:
+        transport.close()
+        raise
+    return transport, protocol
@@ -0,0 +1,135 @@
+"""
+Throughput benchmark of consume -> validate -> ack on the asyncio and uvloop
+event loops.
+
+A stand-in broker on a local TCP socket sends length prefixed event bodies and
+keeps at most prefetch_count of them unacknowledged, like a broker with a
+prefetch count. The consumer turns them into Events with
+MessageToEventAdapter, validates them and acks them over the same socket, so
+the socket I/O of the loop and the callback path are measured together.
+
+    python twyla/service/benchmarks/event_loop.py [messages] [prefetch_count]
+"""
+import asyncio
+import struct
+import sys
+import time
+from types import SimpleNamespace
+
+from twyla.service import event
+from twyla.service.event_bus import MessageToEventAdapter
+from twyla.service.test import common
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+BODY = event.EventPayload(
+    event_name='a-domain.an-event',
+    content={'name': 'test-name', 'text': 'test-text'},
+    context={'channel': 'test-channel',
+             'channel_user': {'name': 'test-user', 'id': 24}}).encode()
+LENGTH = struct.Struct('!I')
+TAG = struct.Struct('!Q')
+
+
+class Broker:
+    """Sends message bodies, at most prefetch_count unacknowledged"""
+
+    def __init__(self, messages: int, prefetch_count: int):
+        self.messages = messages
+        self.prefetch_count = prefetch_count
+        self.done = None
+
+    async def handle(self, reader, writer):
+        window = asyncio.Semaphore(self.prefetch_count)
+
+        async def read_acks():
+            acked = 0
+            while acked < self.messages:
+                await reader.readexactly(TAG.size)
+                acked += 1
+                window.release()
+            self.done.set_result(None)
+
+        acks = asyncio.ensure_future(read_acks())
+        frame = LENGTH.pack(len(BODY)) + BODY
+        for _ in range(self.messages):
+            await window.acquire()
+            writer.write(frame)
+            await writer.drain()
+        await acks
+        writer.close()
+
+
+class Channel:
+    """Acks deliveries over the connection to the stand-in broker"""
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    async def basic_client_ack(self, delivery_tag, multiple=False):
+        self.writer.write(TAG.pack(delivery_tag))
+
+
+async def consume(port: int, messages: int):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    channel = Channel(writer)
+    properties = SimpleNamespace(message_type=None, content_type=None,
+                                 content_encoding=None)
+
+    async def callback(evt):
+        evt.validate()
+        await evt.ack()
+    adapter = MessageToEventAdapter(callback)
+    for delivery_tag in range(1, messages + 1):
+        length, = LENGTH.unpack(await reader.readexactly(LENGTH.size))
+        body = await reader.readexactly(length)
+        envelope = SimpleNamespace(delivery_tag=delivery_tag,
+                                   exchange_name='a-domain',
+                                   routing_key='an-event')
+        await adapter(channel, body, envelope, properties)
+    await writer.drain()
+    return writer
+
+
+async def run(messages: int, prefetch_count: int):
+    broker = Broker(messages, prefetch_count)
+    broker.done = asyncio.get_event_loop().create_future()
+    server = await asyncio.start_server(broker.handle, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    started = time.perf_counter()
+    writer = await consume(port, messages)
+    await broker.done
+    elapsed = time.perf_counter() - started
+    writer.close()
+    server.close()
+    await server.wait_closed()
+    return messages / elapsed
+
+
+def main(messages: int, prefetch_count: int):
+    event.set_schemata(*common.schemata_fixtures())
+    policies = [('asyncio', asyncio.DefaultEventLoopPolicy)]
+    if uvloop is not None:
+        policies.append(('uvloop', uvloop.EventLoopPolicy))
+
+    baseline = None
+    for name, policy in policies:
+        asyncio.set_event_loop_policy(policy())
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            messages_per_second = loop.run_until_complete(
+                run(messages, prefetch_count))
+        finally:
+            loop.close()
+        baseline = baseline or messages_per_second
+        print(f'{name:<10} {messages_per_second:>12.0f} msg/s '
+              f'{messages_per_second / baseline:>6.1f}x')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 100)
@@ -0,0 +1,126 @@
+"""
+Micro-benchmark of the AMQP frame codec of twyla.service.amqp.
+
+Compares the messages/sec of encoding basic.publish (method, content header
+and body frames) and decoding basic.deliver with pamqp, the way aioamqp does,
+against the encoder and decoder of twyla.service.amqp, for a few body sizes.
+
+    python twyla/service/benchmarks/frames.py [iterations]
+"""
+import asyncio
+import sys
+import time
+import unittest.mock as mock
+
+from pamqp import body, commands, frame, header
+
+from twyla.service import amqp
+
+PROPERTIES = {'content_type': 'application/json'}
+FRAME_MAX = amqp.FRAME_MAX
+SIZES = (256, 4096, 65536, 262144)
+
+
+def pamqp_encode(payload):
+    # Like aioamqp.channel.Channel.publish, one write per frame
+    def encode():
+        written = [
+            frame.marshal(commands.Basic.Publish(exchange='a-domain',
+                                                 routing_key='an-event'), 1),
+            frame.marshal(header.ContentHeader(
+                body_size=len(payload),
+                properties=commands.Basic.Properties(**PROPERTIES)), 1)]
+        chunk_size = FRAME_MAX - 8
+        for start in range(0, len(payload), chunk_size):
+            written.append(frame.marshal(
+                body.ContentBody(payload[start:start + chunk_size]), 1))
+        return written
+    return encode
+
+
+def amqp_encode(payload):
+    encoder = amqp.FrameEncoder()
+
+    def encode():
+        return encoder.encode_publish(1, 'a-domain', 'an-event', payload,
+                                      PROPERTIES, FRAME_MAX)
+    return encode
+
+
+def deliver_frames(payload):
+    return amqp_encode(payload)().tobytes().replace(
+        # Turn basic.publish into basic.deliver, the rest is the same
+        frame.marshal(commands.Basic.Publish(exchange='a-domain',
+                                             routing_key='an-event'), 1),
+        frame.marshal(commands.Basic.Deliver(consumer_tag='a-consumer',
+                                             delivery_tag=1,
+                                             exchange='a-domain',
+                                             routing_key='an-event'), 1))
+
+
+def pamqp_decode(payload):
+    # Like aioamqp.frame.read, one frame at a time
+    data = deliver_frames(payload)
+
+    def decode():
+        offset = 0
+        chunks = []
+        while offset < len(data):
+            consumed, _, value = frame.unmarshal(data[offset:])
+            if isinstance(value, body.ContentBody):
+                chunks.append(value.value)
+            offset += consumed
+        return b''.join(chunks)
+    return decode
+
+
+class CountingChannel(amqp.Channel):
+
+    def content_received(self):
+        self.content = None
+
+
+def amqp_decode(payload):
+    data = deliver_frames(payload)
+    protocol = amqp.Protocol('guest', 'guest', '/', 0,
+                             asyncio.new_event_loop())
+    protocol.transport = mock.Mock()
+    channel = CountingChannel(protocol, 1)
+    channel.is_open = True
+    protocol.channels[1] = channel
+
+    def decode():
+        offset = 0
+        while offset < len(data):
+            buffer = protocol.get_buffer(-1)
+            size = min(len(buffer), len(data) - offset)
+            buffer[:size] = data[offset:offset + size]
+            protocol.buffer_updated(size)
+            offset += size
+    return decode
+
+
+def rate(run, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        run()
+    return iterations / (time.perf_counter() - start)
+
+
+def main(iterations):
+    for size in SIZES:
+        payload = b'x' * size
+        for operation, runs in (
+                ('encode', [('pamqp', pamqp_encode), ('amqp', amqp_encode)]),
+                ('decode', [('pamqp', pamqp_decode), ('amqp', amqp_decode)])):
+            baseline = None
+            for name, codec in runs:
+                messages_per_second = rate(codec(payload), iterations)
+                baseline = baseline or messages_per_second
+                print(f'{operation} {size:>7} {name:<6} '
+                      f'{messages_per_second:>12.0f} msg/s '
+                      f'{messages_per_second / baseline:>6.1f}x')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
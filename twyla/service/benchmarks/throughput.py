@@ -0,0 +1,193 @@
+"""
+End-to-end benchmarks of EventBus on the in-memory broker stand-in.
+
+For every payload size this measures:
+
+- publish: EventBus.emit rate into a bound queue
+- consume: rate of listening, validating and acking the published events
+- validate: cost of Event.validate per event
+- latency: percentiles of the time from emit until the handler is called,
+  with BURST events in flight
+
+The results are written as JSON, so they can be stored and compared across
+runs to track regressions:
+
+    python twyla/service/benchmarks/throughput.py \\
+        [--messages 5000] [--sizes 256 4096 65536] [--loop asyncio] \\
+        [--output results.json]
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import sys
+import time
+from types import SimpleNamespace
+
+from twyla.service import jsontool, memory
+from twyla.service.event import Event, EventPayload, set_schemata
+from twyla.service.event_bus import EventBus, MessageToEventAdapter
+from twyla.service.telemetry import Histogram
+from twyla.service.test import common
+
+PREFIX = 'BENCHMARK_'
+CONTEXT = {'channel': 'test-channel',
+           'channel_user': {'name': 'test-user', 'id': 24}}
+PREFETCH_COUNT = 100
+BURST = 10
+PERCENTILES = (50, 90, 99, 100)
+
+
+def event_name(benchmark: str, size: int):
+    # Every benchmark and size has an event (and queue) of its own, so the
+    # listeners of one do not receive the events of another
+    return f'benchmark.{benchmark}-{size}'
+
+
+def schemata(sizes):
+    content_schema_set, context_schema = common.schemata_fixtures()
+    content_schema = content_schema_set['a-domain.an-event']
+    return ({event_name(benchmark, size): content_schema
+             for benchmark in ('consume', 'latency') for size in sizes},
+            context_schema)
+
+
+def payload(name: str, size: int, sequence: str='benchmark'):
+    return EventPayload(event_name=name,
+                        content={'name': sequence, 'text': 'x' * size},
+                        context=CONTEXT)
+
+
+def result(benchmark: str, size: int, messages: int, seconds: float,
+           **extra):
+    return dict(benchmark=benchmark, payload_size=size, messages=messages,
+                seconds=seconds, rate=messages / seconds, **extra)
+
+
+async def publish(bus, size: int, messages: int):
+    name = event_name('consume', size)
+    await bus.queue_manager.bind_queue(name, 'benchmark')
+    event = payload(name, size)
+    started = time.perf_counter()
+    for _ in range(messages):
+        await bus.emit(event)
+    return result('publish', size, messages, time.perf_counter() - started)
+
+
+async def consume(bus, size: int, messages: int):
+    # Consumes the events left in the queue by publish
+    done = asyncio.get_event_loop().create_future()
+    handled = 0
+
+    async def callback(event):
+        nonlocal handled
+        event.validate()
+        await event.ack()
+        handled += 1
+        if handled == messages:
+            done.set_result(None)
+    started = time.perf_counter()
+    await bus.queue_manager.listen(event_name('consume', size), 'benchmark',
+                                   MessageToEventAdapter(callback),
+                                   prefetch_count=PREFETCH_COUNT)
+    await done
+    return result('consume', size, messages, time.perf_counter() - started)
+
+
+def validate(size: int, messages: int):
+    body = payload(event_name('consume', size), size).encode()
+    envelope = SimpleNamespace(delivery_tag=1)
+    started = time.perf_counter()
+    for _ in range(messages):
+        Event(None, body, envelope).validate()
+    seconds = time.perf_counter() - started
+    return result('validate', size, messages, seconds,
+                  microseconds_per_event=seconds / messages * 1e6)
+
+
+async def latency(bus, size: int, messages: int):
+    sent = {}
+    histogram = Histogram()
+    arrived = asyncio.Event()
+
+    async def callback(event):
+        started = sent.pop(event.content['name'])
+        histogram.add((time.perf_counter() - started) * 1000)
+        await event.ack()
+        if not sent:
+            arrived.set()
+    name = event_name('latency', size)
+    await bus.queue_manager.listen(name, 'benchmark',
+                                   MessageToEventAdapter(callback),
+                                   prefetch_count=PREFETCH_COUNT)
+    started = time.perf_counter()
+    for first in range(0, messages, BURST):
+        arrived.clear()
+        for sequence in range(first, min(first + BURST, messages)):
+            sent[str(sequence)] = time.perf_counter()
+            await bus.emit(payload(name, size, str(sequence)))
+        await arrived.wait()
+    milliseconds = {f'p{percentile}': histogram.percentile(percentile)
+                    for percentile in PERCENTILES}
+    return result('latency', size, messages, time.perf_counter() - started,
+                  latency_ms=milliseconds)
+
+
+async def run_all(bus, sizes, messages: int):
+    await bus.queue_manager.connect()
+    results = []
+    for size in sizes:
+        results.append(await publish(bus, size, messages))
+        results.append(await consume(bus, size, messages))
+        results.append(validate(size, messages))
+        results.append(await latency(bus, size, messages))
+    await bus.queue_manager.stop()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[256, 4096, 65536])
+    parser.add_argument('--loop', default='asyncio',
+                        help="'asyncio', 'uvloop' or 'auto'")
+    parser.add_argument('--output', help='file to write the results to')
+    args = parser.parse_args(argv)
+
+    os.environ[PREFIX + 'TRANSPORT'] = 'memory'
+    os.environ[PREFIX + 'LOOP'] = args.loop
+    memory.reset()
+    set_schemata(*schemata(args.sizes))
+    bus = EventBus(PREFIX)
+    loop = bus.new_event_loop()
+    try:
+        results = loop.run_until_complete(
+            run_all(bus, args.sizes, args.messages))
+    finally:
+        loop.close()
+
+    report = {
+        'meta': {
+            'timestamp': datetime.datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'loop': type(loop).__module__,
+            'json_codec': jsontool.get_codec().name,
+            'messages': args.messages,
+            'prefetch_count': PREFETCH_COUNT,
+        },
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as results_file:
+            results_file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
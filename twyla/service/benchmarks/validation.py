@@ -0,0 +1,69 @@
+"""
+Micro-benchmark of event payload validation.
+
+Compares the messages/sec of validating with jsonschema.validate on every
+message (the old behaviour) against the validators precompiled by
+set_schemata, with and without the fastjsonschema backend.
+
+    python twyla/service/benchmarks/validation.py [iterations]
+"""
+import sys
+import time
+
+import jsonschema
+
+from twyla.service import event
+from twyla.service.test import common
+
+EVENT_NAME = 'a-domain.an-event'
+CONTENT = {'name': 'test-name', 'text': 'test-text'}
+CONTEXT = {'channel': 'test-channel',
+           'channel_user': {'name': 'test-user', 'id': 24}}
+
+
+def uncached(content_schema_set, context_schema):
+    def validate():
+        jsonschema.validate(CONTENT, content_schema_set[EVENT_NAME])
+        jsonschema.validate(CONTEXT, context_schema)
+    return validate
+
+
+def compiled(content_schema_set, context_schema, fast):
+    event.set_schemata(content_schema_set, context_schema, fast=fast)
+    content_validators, context_validator = event.get_validators()
+    content_validator = content_validators[EVENT_NAME]
+
+    def validate():
+        content_validator(CONTENT)
+        context_validator(CONTEXT)
+    return validate
+
+
+def rate(validate, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        validate()
+    return iterations / (time.perf_counter() - start)
+
+
+def main(iterations):
+    content_schema_set, context_schema = common.schemata_fixtures()
+    runs = [
+        ('jsonschema.validate', uncached(content_schema_set, context_schema)),
+        ('compiled', compiled(content_schema_set, context_schema, False)),
+    ]
+    if event.fastjsonschema is not None:
+        runs.append(
+            ('compiled (fast)',
+             compiled(content_schema_set, context_schema, True)))
+
+    baseline = None
+    for name, validate in runs:
+        messages_per_second = rate(validate, iterations)
+        baseline = baseline or messages_per_second
+        print(f'{name:<22} {messages_per_second:>12.0f} msg/s '
+              f'{messages_per_second / baseline:>6.1f}x')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -1,4 +1,9 @@
+import asyncio
+import collections
 import json
+import logging
+import re
+import time
 
 from datetime import datetime
 from uuid import UUID, uuid4
@@ -7,49 +12,355 @@ from typing import List
 import jsonschema
 from pydantic import BaseModel, ValidationError
 
+try:
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
+
 import twyla.service.jsontool as jsontool
+import twyla.service.serialization as serialization
+from twyla.service.telemetry import elapsed_ms
+
+logger = logging.getLogger(__name__)
+
 
 def split_event_name(event_name: str):
     assert "." in event_name, "Event names should be of format domain.event_name"
     return event_name.split('.', 1)
 
 
+class AckCoalescer:
+    """Combines the acks of a channel into fewer multiple-acks.
+
+    Every delivery on the channel has to be registered with delivered. Acks
+    are collected and, once max_count are pending or max_delay seconds after
+    the first one, sent as a single multiple-ack for the highest delivery tag
+    up to which all deliveries are acked. Acks above a delivery that is not
+    settled yet are sent one by one. Rejects are sent right away, so a later
+    multiple-ack never covers them.
+    """
+
+    def __init__(self, channel, max_count: int, max_delay: float):
+        assert max_count > 0, "max_count should be positive"
+        self.channel = channel
+        self.max_count = max_count
+        self.max_delay = max_delay
+        # Unsettled delivery tags in delivery (and thus ascending) order,
+        # mapped to whether they are acked.
+        self.unsettled = collections.OrderedDict()
+        self.pending_acks = 0
+        self.timer = None
+        self.flushes = set()
+
+
+    def delivered(self, delivery_tag):
+        self.unsettled[delivery_tag] = False
+
+
+    async def ack(self, delivery_tag):
+        if delivery_tag not in self.unsettled:
+            # Not registered, nothing to coalesce with
+            await self.channel.basic_client_ack(delivery_tag=delivery_tag)
+            return
+        self.unsettled[delivery_tag] = True
+        self.pending_acks += 1
+        if self.pending_acks >= self.max_count:
+            await self.flush()
+        elif self.timer is None:
+            loop = asyncio.get_event_loop()
+            self.timer = loop.call_later(self.max_delay, self.flush_later)
+
+
+    async def reject(self, delivery_tag, requeue):
+        self.unsettled.pop(delivery_tag, None)
+        await self.channel.basic_reject(delivery_tag=delivery_tag,
+                                        requeue=requeue)
+
+
+    def flush_later(self):
+        self.timer = None
+        task = asyncio.ensure_future(self.flush())
+        self.flushes.add(task)
+        task.add_done_callback(self.flush_done)
+
+
+    def flush_done(self, task):
+        self.flushes.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Error sending acks", exc_info=task.exception())
+
+
+    async def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.pending_acks:
+            return
+        # The longest acked prefix is covered by one multiple-ack
+        highest = None
+        while self.unsettled:
+            delivery_tag, acked = next(iter(self.unsettled.items()))
+            if not acked:
+                break
+            highest = delivery_tag
+            self.unsettled.popitem(last=False)
+        single = [delivery_tag
+                  for delivery_tag, acked in self.unsettled.items() if acked]
+        for delivery_tag in single:
+            del self.unsettled[delivery_tag]
+        self.pending_acks = 0
+        if highest is not None:
+            await self.channel.basic_client_ack(delivery_tag=highest,
+                                                multiple=True)
+        for delivery_tag in single:
+            await self.channel.basic_client_ack(delivery_tag=delivery_tag)
+
+
+# Matches the start of a serialized EventPayload, which has the event name as
+# its first field.
+_EVENT_NAME_PREFIX = re.compile(rb'\s*\{\s*"event_name"\s*:\s*"([^"\\]+)"')
+_PREFIX_LENGTH = 256
+
+
+def peek_event_name(body):
+    """Read the event name from the start of a raw event body.
+
+    Returns None if the body does not start with the event name.
+    """
+    if isinstance(body, str):
+        prefix = body[:_PREFIX_LENGTH].encode()
+    elif isinstance(body, (bytes, bytearray, memoryview)):
+        prefix = bytes(memoryview(body)[:_PREFIX_LENGTH])
+    else:
+        return None
+    match = _EVENT_NAME_PREFIX.match(prefix)
+    if match is None:
+        return None
+    return match.group(1).decode()
+
+
+def decode_payload(body, content_type: str=None,
+                   content_encoding: str=None):
+    """Decompress, decode and validate the body of an event"""
+    if isinstance(body, memoryview):
+        body = body.tobytes()
+    body = serialization.decompress(body, content_encoding)
+    return EventPayload.decode(body, content_type)
+
+
 class Event:
+    """An event received from the broker.
+
+    The body is only decoded and validated when the payload is accessed (or
+    validate is called). The event name, domain and type are read without
+    decoding the body where possible: from the AMQP type property, the
+    exchange and routing key of the delivery or the start of the body. The
+    message id, timestamp, schema version and session id stamped by
+    EventBus.emit are read from the AMQP properties and headers; only events
+    without them fall back to the payload.
+
+    If a Telemetry instance is given, it is notified with the duration of
+    validate in milliseconds as <event>.validate and with <event>.ack,
+    <event>.reject and <event>.drop ticks.
 
-    def __init__(self, channel, body, envelope):
+    With an executor (a thread or process pool), validate_async decodes the
+    body there. Events sent to a process pool lose their channel, so
+    settling the copy has no effect.
+    """
+
+    def __init__(self, channel, body, envelope, properties=None,
+                 telemetry=None, acks=None, executor=None):
         self.channel = channel
         self.body = body
         self.envelope = envelope
-        self.payload = None
-        self.event_name = None
-        self.domain = None
-        self.event_type = None
+        self.properties = properties
+        self.telemetry = telemetry
+        # AckCoalescer of the channel, if acks are coalesced
+        self.acks = acks
+        # Whether the event was acked, rejected or dropped
+        self.settled = False
+        self.executor = executor
+        self._payload = None
+        self._event_name = None
 
 
     def validate(self):
-        self.payload = EventPayload.from_json(self.body)
-        self.event_name = self.payload.event_name
-        self.domain, self.event_type = split_event_name(self.event_name)
+        telemetry = self.telemetry
+        if telemetry is None or not telemetry.active:
+            self._decode()
+            return
+        started = time.perf_counter()
+        try:
+            self._decode()
+        finally:
+            telemetry.notify(telemetry.event.validate, elapsed_ms(started))
+
+
+    async def validate_async(self):
+        """Decode and validate the body in the executor of the event.
+
+        Without an executor, this is the same as validate.
+        """
+        if self._payload is not None:
+            return
+        if self.executor is None:
+            self.validate()
+            return
+        body = self.body
+        if isinstance(body, memoryview):
+            body = body.tobytes()
+        loop = asyncio.get_event_loop()
+        started = time.perf_counter()
+        try:
+            payload = await loop.run_in_executor(
+                self.executor, decode_payload, body,
+                getattr(self.properties, 'content_type', None),
+                getattr(self.properties, 'content_encoding', None))
+        finally:
+            telemetry = self.telemetry
+            if telemetry is not None:
+                telemetry.notify(telemetry.event.validate, elapsed_ms(started))
+        self._payload = payload
+        self._event_name = payload.event_name
+
+
+    def _decode(self):
+        self._payload = decode_payload(
+            self.body,
+            getattr(self.properties, 'content_type', None),
+            getattr(self.properties, 'content_encoding', None))
+        self._event_name = self._payload.event_name
+
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.update(channel=None, acks=None, telemetry=None, executor=None)
+        if isinstance(self.body, memoryview):
+            state['body'] = self.body.tobytes()
+        return state
+
+
+    @property
+    def payload(self):
+        if self._payload is None:
+            self.validate()
+        return self._payload
+
+
+    @property
+    def content(self):
+        return self.payload.content
+
+
+    @property
+    def context(self):
+        return self.payload.context
+
+
+    @property
+    def event_name(self):
+        if self._event_name is None:
+            self._event_name = self.peek_event_name()
+        return self._event_name
+
+
+    @property
+    def domain(self):
+        return split_event_name(self.event_name)[0]
+
+
+    @property
+    def event_type(self):
+        return split_event_name(self.event_name)[1]
+
+
+    @property
+    def message_id(self):
+        return getattr(self.properties, 'message_id', None)
+
+
+    @property
+    def timestamp(self):
+        timestamp = getattr(self.properties, 'timestamp', None)
+        if timestamp is None:
+            return self.payload.meta.timestamp
+        return timestamp
+
+
+    @property
+    def schema_version(self):
+        version = self.header('schema_version')
+        if version is None:
+            return self.payload.meta.version
+        return version
+
+
+    @property
+    def session_id(self):
+        session_id = self.header('session_id')
+        if session_id is None:
+            return self.payload.meta.session_id
+        return UUID(session_id)
+
+
+    def header(self, name, default=None):
+        """Return the AMQP header name of the event"""
+        headers = getattr(self.properties, 'headers', None)
+        if not headers:
+            return default
+        return headers.get(name, default)
+
+
+    def peek_event_name(self):
+        event_type = getattr(self.properties, 'message_type', None)
+        if isinstance(event_type, str) and '.' in event_type:
+            return event_type
+        exchange_name = getattr(self.envelope, 'exchange_name', None)
+        routing_key = getattr(self.envelope, 'routing_key', None)
+        if isinstance(exchange_name, str) and isinstance(routing_key, str) \
+           and exchange_name and routing_key:
+            return f'{exchange_name}.{routing_key}'
+        event_name = peek_event_name(self.body)
+        if event_name is not None:
+            return event_name
+        return self.payload.event_name
 
 
     async def ack(self):
-        if self.channel is not None:
+        if self.channel is None:
+            return
+        self.settled = True
+        if self.acks is not None:
+            await self.acks.ack(self.envelope.delivery_tag)
+        else:
             await self.channel.basic_client_ack(
                 delivery_tag=self.envelope.delivery_tag)
+        if self.telemetry is not None:
+            self.telemetry.notify(self.telemetry.event.ack)
 
 
     async def reject(self):
-        if self.channel is not None:
-            await self.channel.basic_reject(
-                delivery_tag=self.envelope.delivery_tag,
-                requeue=True)
+        await self._reject(requeue=True)
+        if self.channel is not None and self.telemetry is not None:
+            self.telemetry.notify(self.telemetry.event.reject)
 
 
     async def drop(self):
-        if self.channel is not None:
+        await self._reject(requeue=False)
+        if self.channel is not None and self.telemetry is not None:
+            self.telemetry.notify(self.telemetry.event.drop)
+
+
+    async def _reject(self, requeue):
+        if self.channel is None:
+            return
+        self.settled = True
+        if self.acks is not None:
+            await self.acks.reject(self.envelope.delivery_tag, requeue)
+        else:
             await self.channel.basic_reject(
                 delivery_tag=self.envelope.delivery_tag,
-                requeue=False)
+                requeue=requeue)
 
 
 class Meta(BaseModel):
@@ -60,28 +371,88 @@ class Meta(BaseModel):
 
 _CONTENT_SCHEMA_SET = None
 _CONTEXT_SCHEMA = None
+# Compiled validators, keyed by event name. The context validator is kept
+# separately as it is shared by all events.
+_CONTENT_VALIDATORS = {}
+_CONTEXT_VALIDATOR = None
+
+
+def _raiser(error):
+    def validate(instance):
+        raise error
+    return validate
+
+
+def _fast_validator(schema):
+    compiled = fastjsonschema.compile(schema)
+
+    def validate(instance):
+        try:
+            compiled(instance)
+        except fastjsonschema.JsonSchemaException as err:
+            # Keep the error type consistent with the jsonschema backend so
+            # callers only have to handle one exception class.
+            raise jsonschema.ValidationError(err.message) from err
+    return validate
+
 
+def compile_validator(schema, fast=False):
+    """Build a reusable validation function for schema.
 
-def set_schemata(content_schema_set, context_schema):
+    The schema is checked once here instead of on every validation, as
+    jsonschema.validate does. With fast=True the code-generating
+    fastjsonschema backend is used if it is installed. Schema errors are
+    deferred to validation time so that set_schemata accepts the same input
+    as before.
+    """
+    if fast and fastjsonschema is not None:
+        try:
+            return _fast_validator(schema)
+        except fastjsonschema.JsonSchemaDefinitionException:
+            # Fall back to jsonschema which reports a proper SchemaError
+            pass
+    cls = jsonschema.validators.validator_for(schema)
+    try:
+        cls.check_schema(schema)
+    except jsonschema.SchemaError as err:
+        return _raiser(err)
+    return cls(schema).validate
+
+
+def set_schemata(content_schema_set, context_schema, fast=False):
     global _CONTENT_SCHEMA_SET, _CONTEXT_SCHEMA
+    global _CONTENT_VALIDATORS, _CONTEXT_VALIDATOR
     assert isinstance(content_schema_set, dict)
     _CONTENT_SCHEMA_SET = content_schema_set
     _CONTEXT_SCHEMA = context_schema
+    _CONTENT_VALIDATORS = {
+        event_name: compile_validator(schema, fast=fast)
+        for event_name, schema in content_schema_set.items()
+    }
+    _CONTEXT_VALIDATOR = None
+    if context_schema is not None:
+        _CONTEXT_VALIDATOR = compile_validator(context_schema, fast=fast)
 
 
 def get_schemata():
     return _CONTENT_SCHEMA_SET, _CONTEXT_SCHEMA
 
 
+def get_validators():
+    return _CONTENT_VALIDATORS, _CONTEXT_VALIDATOR
+
+
 class EventPayload(BaseModel):
     event_name: str
     content: dict
     context: dict
     meta: Meta = Meta()
 
+    class Config:
+        json_loads = jsontool.decode
+
     def validate(self):
         content_schema_set, context_schema = get_schemata()
-        content_schema = content_schema_set[self.event_name]
 
         if any([content_schema_set is None, context_schema is None]):
             raise Exception(
@@ -90,8 +461,9 @@ class EventPayload(BaseModel):
                 set_schema(content_schema_set, context_schema)
                 '''
             )
-        jsonschema.validate(self.content, content_schema)
-        jsonschema.validate(self.context, context_schema)
+        content_validators, context_validator = get_validators()
+        content_validators[self.event_name](self.content)
+        context_validator(self.context)
         return self
 
     @classmethod
@@ -100,5 +472,20 @@ class EventPayload(BaseModel):
         payload = payload.validate()
         return payload
 
+    @classmethod
+    def decode(cls, data, content_type=None):
+        """Decode and validate data in the wire format of content_type"""
+        content_type = serialization.payload_content_type(content_type)
+        if content_type == serialization.JSON:
+            return cls.from_json(data)
+        payload = cls.parse_obj(serialization.decode(data, content_type))
+        payload = payload.validate()
+        return payload
+
+    def encode(self, content_type=None) -> bytes:
+        if content_type is None or content_type == serialization.JSON:
+            return jsontool.encode(self.dict())
+        return serialization.encode(self.dict(), content_type)
+
     def to_json(self):
-        return jsontool.dumps(self.dict())
+        return self.encode().decode()
@@ -1,47 +1,659 @@
 import sys
 import asyncio
 import atexit
+import concurrent.futures
+import datetime
+import random
 import signal
 import logging
+import time
+import uuid
 from aioamqp.protocol import OPEN
 
-from twyla.service import queues
-from twyla.service.event import Event
+import twyla.service.configuration as config
+from twyla.service import queues, serialization
+from twyla.service.event import AckCoalescer, Event
+from twyla.service.telemetry import elapsed_ms
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 logger = logging.getLogger(__name__)
 
 class MessageToEventAdapter:
-    def __init__(self, callback):
+    """Turns deliveries into Events and hands them to the callback.
+
+    If a Telemetry instance is given, it is notified with a <event>.received
+    tick per delivery, the number of callbacks running as <event>.in_flight
+    and their duration in milliseconds as <event>.handler.
+
+    With ack_batch_size set, the acks of the events are coalesced per channel
+    into multiple-acks, see AckCoalescer.
+
+    With an executor, events are decoded and validated there before the
+    callback is called. A synchronous callback is a plain function run in the
+    executor (or the default one of the loop); the event is acked when it
+    returns and rejected when it raises.
+
+    Once closed, deliveries are no longer handed to the callback. They are not
+    acked, so the broker delivers them again when the channel is closed.
+    """
+
+    def __init__(self, callback, max_concurrency=None, telemetry=None,
+                 ack_batch_size=None, ack_batch_wait=0.05, executor=None,
+                 synchronous=False):
+        self.callback = callback
+        self.executor = executor
+        self.synchronous = synchronous
+        self.max_concurrency = max_concurrency
+        self.telemetry = telemetry
+        self.ack_batch_size = ack_batch_size
+        self.ack_batch_wait = ack_batch_wait
+        self.coalescers = {}
+        self.semaphore = None
+        self.tasks = set()
+        self.in_flight = 0
+        # Callbacks run inline (without max_concurrency) and the future join
+        # waits for until they are done
+        self.running = 0
+        self.idle = None
+        self.closing = False
+        if max_concurrency is not None:
+            assert max_concurrency > 0, "max_concurrency should be positive"
+            self.semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def __call__(self, channel, body, envelope, properties):
+        if self.closing:
+            return
+        acks = None
+        if self.ack_batch_size:
+            acks = self.coalescers.get(channel)
+            if acks is None:
+                acks = self.coalescers[channel] = AckCoalescer(
+                    channel, self.ack_batch_size, self.ack_batch_wait)
+            acks.delivered(envelope.delivery_tag)
+        event = Event(channel, body, envelope, properties, self.telemetry,
+                      acks, self.executor)
+        if self.telemetry is not None:
+            self.telemetry.notify(self.telemetry.event.received)
+        if self.semaphore is None:
+            self.running += 1
+            try:
+                await self.handle(event)
+            finally:
+                self.running -= 1
+                if not self.running and self.idle is not None:
+                    self.idle.set_result(None)
+                    self.idle = None
+            return
+        # aioamqp awaits this coroutine in the reader of the whole connection,
+        # so waiting for a free slot here would hold up confirms, replies and
+        # the deliveries of every other channel. The event waits for its slot
+        # in a task instead; the prefetch count of the listener bounds how
+        # many do.
+        task = asyncio.ensure_future(self.run_callback(event))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def handle(self, event):
+        telemetry = self.telemetry
+        if telemetry is None or not telemetry.active:
+            await self.call(event)
+            return
+        self.in_flight += 1
+        telemetry.notify(telemetry.event.in_flight, self.in_flight)
+        started = time.perf_counter()
+        try:
+            await self.call(event)
+        finally:
+            self.in_flight -= 1
+            telemetry.notify(telemetry.event.handler, elapsed_ms(started))
+            telemetry.notify(telemetry.event.in_flight, self.in_flight)
+
+    async def call(self, event):
+        if self.executor is not None:
+            try:
+                await event.validate_async()
+            except Exception: # pylint: disable-msg=broad-except
+                # Raised again when the callback accesses the payload
+                pass
+        if not self.synchronous:
+            await self.callback(event)
+            return
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(self.executor, self.callback, event)
+        except Exception:
+            if not event.settled:
+                await event.reject()
+            raise
+        if not event.settled:
+            await event.ack()
+
+    async def run_callback(self, event):
+        await self.semaphore.acquire()
+        try:
+            await self.handle(event)
+        except Exception: # pylint: disable-msg=broad-except
+            logger.exception("Error handling event")
+        finally:
+            self.semaphore.release()
+
+    def close(self):
+        """Stop handing deliveries to the callback"""
+        self.closing = True
+
+    async def join(self):
+        """Wait for all running callbacks to finish"""
+        if self.running:
+            if self.idle is None:
+                self.idle = asyncio.get_event_loop().create_future()
+            await asyncio.shield(self.idle)
+        if self.tasks:
+            await asyncio.wait(list(self.tasks))
+
+    async def flush_acks(self):
+        for acks in self.coalescers.values():
+            await acks.flush()
+
+
+class MessagesToBatchAdapter:
+    """Collects deliveries into lists of Events for the callback.
+
+    The callback is called with up to max_size events, or fewer once
+    max_wait seconds passed since the first event of the batch arrived. One
+    batch is handled at a time. Events the callback does not ack, reject or
+    drop itself are acked when it returns and rejected (requeued) when it
+    raises. The acks of a batch are sent as few multiple-acks.
+
+    If a Telemetry instance is given, it is notified with the size of each
+    batch as <event>.batch_size and the duration of the callback in
+    milliseconds as <event>.handler.
+
+    Once closed, the events of the batch being filled and later deliveries are
+    not handed to the callback; the broker delivers them again.
+    """
+
+    def __init__(self, callback, max_size: int, max_wait: float,
+                 telemetry=None, executor=None):
+        assert max_size > 0, "max_size should be positive"
         self.callback = callback
+        self.executor = executor
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.telemetry = telemetry
+        self.coalescers = {}
+        self.pending = []
+        self.timer = None
+        self.lock = asyncio.Lock()
+        self.tasks = set()
+        self.closing = False
+
+    async def __call__(self, channel, body, envelope, properties):
+        if self.closing:
+            return
+        acks = self.coalescers.get(channel)
+        if acks is None:
+            acks = self.coalescers[channel] = AckCoalescer(
+                channel, self.max_size, self.max_wait)
+        acks.delivered(envelope.delivery_tag)
+        self.pending.append(Event(channel, body, envelope, properties,
+                                  self.telemetry, acks, self.executor))
+        if self.telemetry is not None:
+            self.telemetry.notify(self.telemetry.event.received)
+        if len(self.pending) >= self.max_size:
+            # Handled inline, so the next delivery of the channel waits
+            await self.dispatch()
+        elif self.timer is None:
+            loop = asyncio.get_event_loop()
+            self.timer = loop.call_later(self.max_wait, self.dispatch_later)
+
+    def dispatch_later(self):
+        self.timer = None
+        task = asyncio.ensure_future(self.dispatch())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def dispatch(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        async with self.lock:
+            try:
+                await self.handle(batch)
+                settle = Event.ack
+            except Exception: # pylint: disable-msg=broad-except
+                logger.exception("Error handling batch of events")
+                settle = Event.reject
+            for event in batch:
+                if not event.settled:
+                    await settle(event)
+            await self.flush_acks()
+
+    async def handle(self, batch):
+        telemetry = self.telemetry
+        if telemetry is None or not telemetry.active:
+            await self.callback(batch)
+            return
+        telemetry.notify(telemetry.event.batch_size, len(batch))
+        started = time.perf_counter()
+        try:
+            await self.callback(batch)
+        finally:
+            telemetry.notify(telemetry.event.handler, elapsed_ms(started))
+
+    def close(self):
+        """Stop handing deliveries to the callback"""
+        self.closing = True
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.pending = []
+
+    async def join(self):
+        """Wait for the batches being handled to finish"""
+        if self.tasks:
+            await asyncio.wait(list(self.tasks))
+        # A full batch is handled inline, holding the lock
+        async with self.lock:
+            pass
+
+    async def flush_acks(self):
+        for acks in self.coalescers.values():
+            await acks.flush()
+
+
+class EventStream:
+    """Async iterator over the events with the given name and group.
+
+    Deliveries are buffered in a queue of at most prefetch_count events. When
+    it is full, no further deliveries are read from the channel, and as the
+    broker does not deliver more than prefetch_count unacknowledged events,
+    a slow consumer holds back the broker instead of filling memory.
+
+    The stream starts listening when it is first iterated over and ends when
+    it is closed. Events buffered at that point are not handed out; as they
+    are not acked, the broker delivers them again.
+    """
+
+    def __init__(self, queue_manager, event_name: str, event_group: str,
+                 prefetch_count: int, telemetry=None, executor=None):
+        assert prefetch_count > 0, "prefetch_count should be positive"
+        self.queue_manager = queue_manager
+        self.executor = executor
+        self.event_name = event_name
+        self.event_group = event_group
+        self.prefetch_count = prefetch_count
+        self.telemetry = telemetry
+        self._queue = None
+        self.listening = False
+        self.closed = False
+
+    @property
+    def queue(self):
+        # Created on first use, so it belongs to the loop running then
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.prefetch_count)
+        return self._queue
+
+    async def listen(self):
+        # Events buffered from a previous connection can not be acked any
+        # more, the broker delivers them again.
+        self.clear()
+        await self.queue_manager.connect()
+        await self.queue_manager.listen(self.event_name, self.event_group,
+                                        self,
+                                        prefetch_count=self.prefetch_count)
+        self.listening = True
 
     async def __call__(self, channel, body, envelope, properties):
-        event = Event(channel, body, envelope)
-        await self.callback(event)
+        event = Event(channel, body, envelope, properties, self.telemetry,
+                      executor=self.executor)
+        if self.telemetry is not None:
+            self.telemetry.notify(self.telemetry.event.received)
+        await self.queue.put(event)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.closed:
+            raise StopAsyncIteration
+        if not self.listening:
+            await self.listen()
+        event = await self.queue.get()
+        if event is None:
+            # Closed; leave the marker for other consumers of the stream
+            self.queue.put_nowait(None)
+            raise StopAsyncIteration
+        return event
+
+    async def batches(self, max_size: int, max_wait: float):
+        """Iterate over lists of up to max_size events.
+
+        A list is handed out when it is full or max_wait seconds after its
+        first event arrived.
+        """
+        loop = asyncio.get_event_loop()
+        async for event in self:
+            batch = [event]
+            deadline = loop.time() + max_wait
+            while len(batch) < max_size and not self.closed:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    event = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if event is None:
+                    self.queue.put_nowait(None)
+                    break
+                batch.append(event)
+            yield batch
+
+    def clear(self):
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+    def close(self):
+        """End the iteration over the stream"""
+        self.closed = True
+        self.clear()
+        self.queue.put_nowait(None)
+
+
+class EventDispatcher:
+    """Calls the handler registered for the name of each event.
+
+    The name is read from the AMQP properties of the event (see
+    Event.event_name), so finding the handler does not decode the body.
+    Events without a handler are dropped with a warning.
+    """
+
+    def __init__(self, handlers: dict):
+        self.handlers = handlers
+
+    async def __call__(self, event):
+        handler = self.handlers.get(event.event_name)
+        if handler is None:
+            logger.warning("No handler for %s, dropping it", event.event_name)
+            await event.drop()
+            return
+        await handler(event)
+
+
+def backoff_delay(attempt: int, min_delay: float, max_delay: float):
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(max_delay, min_delay * 2 ** attempt))
 
 
 class EventBus:
 
-    def __init__(self, config_prefix: str):
+    def __init__(self, config_prefix: str, telemetry=None):
         self.config_prefix = config_prefix
+        self.config = config.from_env(config_prefix)
+        self.telemetry = telemetry
         self.event_listeners = {}
+        self.batch_listeners = {}
+        self.dispatch_listeners = {}
+        self.streams = []
+        self.adapters = []
         self.run_stop_on_queue_close = True
-        self.queue_manager = queues.QueueManager(config_prefix)
+        # Coalesce acks into multiple-acks of up to ack_batch_size events,
+        # sent at the latest after ack_batch_wait seconds
+        self.ack_batch_size = int(self.config.get('ack_batch_size', 0))
+        self.ack_batch_wait = float(self.config.get('ack_batch_wait', 0.05))
+        # Pool events are decoded and validated in, and synchronous callbacks
+        # run in: 'thread' or 'process'
+        self.executor = self.create_executor(
+            self.config.get('executor') or None,
+            int(self.config.get('executor_workers', 0)) or None)
+        # Reconnect instead of stopping when the connection to the broker is
+        # lost. The time it took to recover is sent to the telemetry as
+        # <event>.reconnect in milliseconds.
+        self.reconnect = self.config.get('reconnect', '').lower() in (
+            '1', 'true')
+        self.reconnect_min_delay = float(
+            self.config.get('reconnect_min_delay', 0.5))
+        self.reconnect_max_delay = float(
+            self.config.get('reconnect_max_delay', 30))
+        # Seconds stop_main waits for the callbacks running to finish
+        self.stop_timeout = float(self.config.get('stop_timeout', 10))
+        # Wire format of emitted events, see twyla.service.serialization.
+        # Listeners decode events in any of the supported formats.
+        self.content_type = self.config.get('content_type', serialization.JSON)
+        serialization.get_codec(self.content_type)
+        # Events of at least compression_threshold bytes are compressed if a
+        # compression is set. The telemetry is notified with
+        # <event>.compression_time (in milliseconds) and
+        # <event>.compression_ratio (uncompressed / compressed size).
+        self.compression = self.config.get('compression') or None
+        if self.compression is not None:
+            serialization.get_compression(self.compression)
+        self.compression_threshold = int(
+            self.config.get('compression_threshold', 4096))
+        # Event loop main runs on: 'uvloop', 'asyncio' or 'auto' for uvloop
+        # if it is installed and the asyncio one otherwise
+        self.loop_policy_name = self.config.get('loop', 'auto')
+        self.loop_policy()
+        self.queue_manager = queues.QueueManager(config_prefix,
+                                                 telemetry=telemetry)
+        # Samples the depth of the queues listened to every
+        # queue_sample_interval seconds, if set
+        self.queue_sampler = None
+        sample_interval = float(self.config.get('queue_sample_interval', 0))
+        if sample_interval > 0:
+            self.queue_sampler = queues.QueueSampler(
+                self.queue_manager, sample_interval, telemetry)
+
+
+    @staticmethod
+    def create_executor(kind: str, max_workers: int=None):
+        if kind is None:
+            return None
+        if kind == 'thread':
+            return concurrent.futures.ThreadPoolExecutor(max_workers)
+        if kind == 'process':
+            return concurrent.futures.ProcessPoolExecutor(max_workers)
+        raise ValueError(f'Unsupported executor {kind}')
+
+
+    def loop_policy(self):
+        name = self.loop_policy_name
+        if name == 'auto':
+            name = 'asyncio' if uvloop is None else 'uvloop'
+        if name == 'asyncio':
+            return asyncio.DefaultEventLoopPolicy()
+        if name == 'uvloop':
+            if uvloop is None:
+                raise ValueError('The uvloop loop needs uvloop installed')
+            return uvloop.EventLoopPolicy()
+        raise ValueError(f'Unsupported event loop {name}')
+
+
+    def new_event_loop(self):
+        """Set the configured loop policy and return a new current loop"""
+        asyncio.set_event_loop_policy(self.loop_policy())
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        return loop
+
+
+    def listen(self, event_name: str, event_group: str, callback,
+               prefetch_count: int=None, max_concurrency: int=None,
+               synchronous: bool=False):
+        """Register callback for the events with the given name.
+
+        prefetch_count limits the number of unacknowledged messages the broker
+        delivers to this listener. max_concurrency runs up to that many
+        callbacks concurrently instead of one after another; further
+        deliveries wait for a free slot. prefetch_count defaults to
+        max_concurrency, so the broker holds back what can not run yet.
+
+        With synchronous set, callback is a plain function, which is run in the
+        executor set with EVENT_BUS_EXECUTOR (or a thread of the default one).
+        The event is acked when it returns and rejected when it raises.
+        """
+        if prefetch_count is None:
+            prefetch_count = max_concurrency
+        self.event_listeners[event_name] = (
+            callback, event_group, prefetch_count, max_concurrency,
+            synchronous)
+
+
+    def listen_batch(self, event_name: str, event_group: str, callback,
+                     max_size: int, max_wait: float,
+                     prefetch_count: int=None):
+        """Register callback for lists of the events with the given name.
+
+        callback is called with up to max_size events, or with the events
+        received within max_wait seconds of the first one. Events it does not
+        settle itself are acked when it returns and rejected when it raises.
+        prefetch_count defaults to max_size, so a batch can fill up.
+        """
+        if prefetch_count is None:
+            prefetch_count = max_size
+        self.batch_listeners[event_name] = (
+            callback, event_group, max_size, max_wait, prefetch_count)
+
+
+    def listen_many(self, handlers: dict, queue_name: str,
+                    prefetch_count: int=None, max_concurrency: int=None):
+        """Register handlers for events of several names on one queue.
 
+        handlers maps event names to coroutine functions. The queue with the
+        given name is bound to all of them and every event is handed to the
+        handler of its name, read from the AMQP properties stamped by emit
+        without decoding the body. Events without a handler are dropped, so
+        the queue must not be shared with other services: its name is of the
+        format service.group. prefetch_count and max_concurrency are as in
+        listen.
+        """
+        assert "." in queue_name, \
+            "Queue names should be of format service.group"
+        if prefetch_count is None:
+            prefetch_count = max_concurrency
+        self.dispatch_listeners[queue_name] = (
+            dict(handlers), prefetch_count, max_concurrency)
 
-    def listen(self, event_name: str, event_group: str, callback):
-        self.event_listeners[event_name] = (callback, event_group)
+
+    def stream(self, event_name: str, event_group: str,
+               prefetch_count: int=100):
+        """Return an EventStream over the events with the given name.
+
+        At most prefetch_count events are buffered for the consumer.
+        """
+        stream = EventStream(self.queue_manager, event_name, event_group,
+                             prefetch_count, self.telemetry, self.executor)
+        self.streams.append(stream)
+        return stream
 
 
     async def start(self):
         await self.queue_manager.connect()
-        for event_name, (callback, group) in self.event_listeners.items():
-            await self.queue_manager.listen(event_name, group, MessageToEventAdapter(callback))
+        self.adapters = []
+        # The listeners are set up concurrently so the declarations they
+        # share and their round trips to the broker overlap.
+        await asyncio.gather(*[
+            self.start_listener(event_name, *listener)
+            for event_name, listener in self.event_listeners.items()], *[
+            self.start_batch_listener(event_name, *listener)
+            for event_name, listener in self.batch_listeners.items()], *[
+            self.start_dispatch_listener(queue_name, *listener)
+            for queue_name, listener in self.dispatch_listeners.items()], *[
+            # Streams listen once iterated over; on a reconnect they are
+            # started again.
+            stream.listen() for stream in self.streams
+            if stream.listening and not stream.closed])
+        if self.queue_sampler is not None:
+            await self.queue_sampler.start()
+
+
+    async def start_listener(self, event_name, callback, group,
+                             prefetch_count, max_concurrency, synchronous):
+        adapter = MessageToEventAdapter(callback, max_concurrency,
+                                        self.telemetry, self.ack_batch_size,
+                                        self.ack_batch_wait, self.executor,
+                                        synchronous)
+        self.adapters.append(adapter)
+        await self.queue_manager.listen(
+            event_name, group, adapter, prefetch_count=prefetch_count)
+
+
+    async def start_batch_listener(self, event_name, callback, group,
+                                   max_size, max_wait, prefetch_count):
+        adapter = MessagesToBatchAdapter(callback, max_size, max_wait,
+                                         self.telemetry, self.executor)
+        self.adapters.append(adapter)
+        await self.queue_manager.listen(
+            event_name, group, adapter, prefetch_count=prefetch_count)
+
+
+    async def start_dispatch_listener(self, queue_name, handlers,
+                                      prefetch_count, max_concurrency):
+        adapter = MessageToEventAdapter(EventDispatcher(handlers),
+                                        max_concurrency, self.telemetry,
+                                        self.ack_batch_size,
+                                        self.ack_batch_wait, self.executor)
+        self.adapters.append(adapter)
+        await self.queue_manager.listen_many(
+            list(handlers), queue_name, adapter,
+            prefetch_count=prefetch_count)
 
 
     async def emit(self, event):
         await self.queue_manager.connect()
-        data = event.to_json()
-        await self.queue_manager.emit(event.event_name, data)
+        return await self.queue_manager.emit(*self.message(event))
+
+
+    async def emit_many(self, events):
+        await self.queue_manager.connect()
+        messages = [self.message(event) for event in events]
+        return await self.queue_manager.emit_many(messages)
+
+
+    def message(self, event):
+        data = event.encode(self.content_type)
+        meta = event.meta
+        # Listeners read the name and metadata of the event from these
+        # without decoding the body, see Event
+        properties = {
+            'content_type': self.content_type,
+            'message_type': event.event_name,
+            'message_id': str(uuid.uuid4()),
+            'timestamp': datetime.datetime.now(datetime.timezone.utc),
+            'headers': {'schema_version': meta.version,
+                        'session_id': str(meta.session_id)},
+        }
+        if self.compression is not None and \
+           len(data) >= self.compression_threshold:
+            data = self.compress(data, properties)
+        return event.event_name, data, properties
+
+
+    def compress(self, data, properties):
+        started = time.perf_counter()
+        compressed = serialization.compress(data, self.compression)
+        if self.telemetry is not None:
+            self.telemetry.notify(self.telemetry.event.compression_time,
+                                  elapsed_ms(started))
+            self.telemetry.notify(self.telemetry.event.compression_ratio,
+                                  len(data) / len(compressed))
+        # Incompressible data is sent as is
+        if len(compressed) >= len(data):
+            return data
+        properties['content_encoding'] = self.compression
+        return compressed
+
+
+    async def wait_for_confirms(self):
+        await self.queue_manager.wait_for_confirms()
 
 
     async def main_task(self, aio_loop):
@@ -56,9 +668,49 @@ class EventBus:
 
 
     async def stop_on_queue_disconnect(self):
-        await asyncio.wait_for(self.queue_manager.closed_event.wait(), None)
-        if self.run_stop_on_queue_close:
-            await self.stop_main()
+        while True:
+            await asyncio.wait_for(self.queue_manager.closed_event.wait(),
+                                   None)
+            if not self.run_stop_on_queue_close:
+                return
+            if not self.reconnect:
+                await self.stop_main()
+                return
+            await self.recover()
+
+
+    async def recover(self):
+        lost_at = time.perf_counter()
+        logger.warning("Lost connection to the broker, reconnecting")
+        attempt = 0
+        while True:
+            await asyncio.sleep(backoff_delay(attempt,
+                                              self.reconnect_min_delay,
+                                              self.reconnect_max_delay))
+            try:
+                await self.queue_manager.reconnect()
+                await self.start()
+                await self.queue_manager.resume()
+                break
+            except Exception: # pylint: disable-msg=broad-except
+                logger.exception("Reconnect attempt %d failed", attempt + 1)
+                attempt += 1
+        recovery_time = elapsed_ms(lost_at)
+        logger.info("Reconnected to the broker after %.0fms", recovery_time)
+        if self.telemetry is not None:
+            self.telemetry.notify(self.telemetry.event.reconnect,
+                                  recovery_time)
+
+
+    async def join_adapters(self):
+        """Wait up to stop_timeout seconds for the running callbacks"""
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*[adapter.join() for adapter in self.adapters]),
+                self.stop_timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Callbacks still running after %.0fs, stopping "
+                           "anyway", self.stop_timeout)
 
 
     def signal_handler(self):
@@ -69,8 +721,25 @@ class EventBus:
         # The next two lines get rid of the stop_on_queue_disconnect task
         self.run_stop_on_queue_close = False
         self.queue_manager.closed_event.set()
+        if self.queue_sampler is not None:
+            await self.queue_sampler.stop()
+        for stream in self.streams:
+            stream.close()
+        for adapter in self.adapters:
+            adapter.close()
+        await self.join_adapters()
+        for adapter in self.adapters:
+            try:
+                await adapter.flush_acks()
+            except Exception: # pylint: disable-msg=broad-except
+                logger.exception("Error sending pending acks")
         await self.queue_manager.stop()
-        for task in asyncio.Task.all_tasks():
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        # asyncio.Task.all_tasks is gone since Python 3.9
+        all_tasks = getattr(asyncio, 'all_tasks', None) or \
+            asyncio.Task.all_tasks
+        for task in all_tasks():
             # Cancel all pending tasks (this should be only the current method
             # and the event listener in most cases). Make sure to not cancel
             # this method.
@@ -95,8 +764,12 @@ class EventBus:
             self.aio_loop.stop()
 
 
-    def main(self):
-        self.aio_loop = asyncio.get_event_loop()
+    def main(self, loop=None):
+        """Run the event bus until it is stopped.
+
+        Without a loop, a new one of the configured loop policy is used.
+        """
+        self.aio_loop = loop or self.new_event_loop()
         try:
             logger.info("Starting twyla.service main event loop")
             self.aio_loop.create_task(self.main_task(self.aio_loop))
@@ -1,26 +1,66 @@
-from concurrent.futures._base import CancelledError
 import asyncio
+import json
 import os
 
-import twyla.service.events as events
+from twyla.service import event
+from twyla.service.event_bus import EventBus
 
+an_event_content_schema = '''
+    {
+        "$schema": "http://json-schema.org/draft-06/schema#",
+        "title": "Content",
+        "description": "Some content",
+        "type": "object",
+        "properties": {
+            "emission": {
+                "description": "Some emission",
+                "type": "string"
+            }
+        }
+    }
+'''
 
-async def listener(event_name):
-    async for e in events.listen(event_name):
-        print(e.body)
+content_schema_set = {
+    'example.integration': json.loads(an_event_content_schema)
+}
+
+context_schema = '''
+    {
+        "$schema": "http://json-schema.org/draft-06/schema#",
+        "title": "Context",
+        "description": "Some context",
+        "type": "object",
+        "properties": {
+            "tenant": {
+                "description": "Some tenant",
+                "type": "string"
+            },
+            "channel-id": {
+                "description": "Some channel ID",
+                "type": "integer"
+            }
+        }
+    }
+'''
+
+# Accessing the payload of an event validates it against these
+event.set_schemata(content_schema_set, json.loads(context_schema))
+
+async def listener(event_bus, event_name):
+    async for e in event_bus.stream(event_name, 'example-consumer'):
+        print(e.payload.content)
         await e.ack()
 
 
-os.environ['TWYLA_RABBITMQ_HOST'] = 'localhost'
-os.environ['TWYLA_RABBITMQ_PORT'] = '5672'
-os.environ['TWYLA_RABBITMQ_USER'] = 'guest'
-os.environ['TWYLA_RABBITMQ_PASS'] = 'guest'
-os.environ['TWYLA_RABBITMQ_EXCHANGE'] = 'events_test'
-os.environ['TWYLA_RABBITMQ_VHOST'] = '/'
-os.environ['TWYLA_RABBITMQ_PREFIX'] = 'test-service'
+os.environ['TWYLA_AMQP_HOST'] = 'localhost'
+os.environ['TWYLA_AMQP_PORT'] = '5672'
+os.environ['TWYLA_AMQP_USER'] = 'guest'
+os.environ['TWYLA_AMQP_PASS'] = 'guest'
+os.environ['TWYLA_AMQP_VHOST'] = '/'
 
+event_bus = EventBus('TWYLA_')
 loop = asyncio.get_event_loop()
 try:
-    loop.run_until_complete(listener('my-events'))
-except CancelledError:
+    loop.run_until_complete(listener(event_bus, 'example.integration'))
+except asyncio.CancelledError:
     print('Lost connection. Done.')
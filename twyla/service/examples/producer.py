@@ -1,10 +1,11 @@
 import asyncio
+import json
 import os
 from datetime import datetime
 from uuid import uuid4
 
-import twyla.service.events as events
-import twyla.service.message as message
+from twyla.service import event
+from twyla.service.event_bus import EventBus
 
 an_event_content_schema = '''
     {
@@ -22,7 +23,7 @@ an_event_content_schema = '''
 '''
 
 content_schema_set = {
-    'an-event': an_event_content_schema
+    'example.integration': json.loads(an_event_content_schema)
 }
 
 context_schema = '''
@@ -44,12 +45,12 @@ context_schema = '''
     }
 '''
 
-message.set_schemata(content_schema_set, context_schema)
+event.set_schemata(content_schema_set, json.loads(context_schema))
 
-async def ticker(interval):
+async def ticker(event_bus, interval):
     while True:
-        event_payload = message.EventPayload(
-            event_name='integration',
+        event_payload = event.EventPayload(
+            event_name='example.integration',
             content={'emission': 'Hello, there'},
             context={
                 'tenant': 'test-tenant',
@@ -57,17 +58,15 @@ async def ticker(interval):
             }
         )
         await asyncio.sleep(interval)
-        await events.emit('my-events', event_payload.to_json())
+        await event_bus.emit(event_payload)
 
 
-os.environ['TWYLA_RABBITMQ_HOST'] = 'localhost'
-os.environ['TWYLA_RABBITMQ_PORT'] = '5672'
-os.environ['TWYLA_RABBITMQ_USER'] = 'guest'
-os.environ['TWYLA_RABBITMQ_PASS'] = 'guest'
-os.environ['TWYLA_RABBITMQ_EXCHANGE'] = 'events_test'
-os.environ['TWYLA_RABBITMQ_VHOST'] = '/'
-os.environ['TWYLA_RABBITMQ_PREFIX'] = 'test-service'
+os.environ['TWYLA_AMQP_HOST'] = 'localhost'
+os.environ['TWYLA_AMQP_PORT'] = '5672'
+os.environ['TWYLA_AMQP_USER'] = 'guest'
+os.environ['TWYLA_AMQP_PASS'] = 'guest'
+os.environ['TWYLA_AMQP_VHOST'] = '/'
 
 
 loop = asyncio.get_event_loop()
-loop.run_until_complete(ticker(2))
+loop.run_until_complete(ticker(EventBus('TWYLA_'), 2))
@@ -4,26 +4,140 @@ import uuid
 
 from json import JSONEncoder
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def twyla_default(self, obj):
-    # Builtin classes can not be monkey-patched
-    if isinstance(obj, datetime.datetime):
-        return obj.isoformat()
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+# Serializers for classes that can not be monkey-patched with __json__
+_SERIALIZERS = {
+    datetime.datetime: datetime.datetime.isoformat,
     # NOTE: this could be monkey patched UUID.__json__ = UUID.__str__
     # actually.. a decision has to be made whether monkey-patching or adding
     # here is the way to go for 3rd-party classes/modules
-    elif isinstance(obj, uuid.UUID):
-        return obj.__str__()
-    else:
-        # __methods__ are reserved for builtin protocols.. this is a drop in
-        # replacement of a future __json__ protocol as writing default
-        # functions or JSONEncoders for all things is annoying.
-        return getattr(obj.__class__, '__json__', twyla_default.default)(obj)
+    uuid.UUID: uuid.UUID.__str__,
+}
+
+# Maps the exact type of an object to its serializer, so the lookup is done
+# only once per type
+_dispatch_cache = {}
+
+
+def _not_serializable(obj):
+    raise TypeError(
+        f'Object of type {obj.__class__.__name__} is not JSON serializable')
+
+
+def _resolve(cls):
+    for base, serializer in _SERIALIZERS.items():
+        if issubclass(cls, base):
+            return serializer
+    # __methods__ are reserved for builtin protocols.. this is a drop in
+    # replacement of a future __json__ protocol as writing default
+    # functions or JSONEncoders for all things is annoying.
+    return getattr(cls, '__json__', _not_serializable)
+
+
+def default(obj):
+    cls = obj.__class__
+    try:
+        serializer = _dispatch_cache[cls]
+    except KeyError:
+        serializer = _dispatch_cache[cls] = _resolve(cls)
+    return serializer(obj)
+
+
+def twyla_default(self, obj):
+    # Builtin classes can not be monkey-patched
+    return default(obj)
 
 
-twyla_default.default = JSONEncoder().default
 JSONEncoder.default = twyla_default
 
 
+class StdlibCodec:
+    name = 'json'
+
+    @staticmethod
+    def encode(obj) -> bytes:
+        return json.dumps(obj, default=default).encode()
+
+    @staticmethod
+    def decode(data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return json.loads(data)
+
+
+class UjsonCodec:
+    name = 'ujson'
+
+    @staticmethod
+    def encode(obj) -> bytes:
+        return ujson.dumps(obj, default=default,
+                           ensure_ascii=False).encode()
+
+    @staticmethod
+    def decode(data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return ujson.loads(data)
+
+
+class OrjsonCodec:
+    name = 'orjson'
+
+    # orjson handles datetime and UUID natively and only calls default for
+    # other types.
+    @staticmethod
+    def encode(obj) -> bytes:
+        return orjson.dumps(obj, default=default,
+                            option=orjson.OPT_NON_STR_KEYS)
+
+    @staticmethod
+    def decode(data):
+        return orjson.loads(data)
+
+
+# Fastest first
+_CODECS = [(OrjsonCodec, orjson), (UjsonCodec, ujson), (StdlibCodec, json)]
+
+
+def available_codecs():
+    return [codec.name for codec, module in _CODECS if module is not None]
+
+
+def get_codec(name: str=None):
+    """Return the codec with the given name or the fastest available one"""
+    for codec, module in _CODECS:
+        if module is None:
+            continue
+        if name is None or codec.name == name:
+            return codec
+    raise ValueError(f'JSON codec {name} is not available')
+
+
+_codec = get_codec()
+
+
+def set_codec(name: str=None):
+    global _codec
+    _codec = get_codec(name)
+
+
+def encode(obj) -> bytes:
+    return _codec.encode(obj)
+
+
+def decode(data):
+    return _codec.decode(data)
+
+
 def dumps(obj):
     return json.dumps(obj)
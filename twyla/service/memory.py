@@ -0,0 +1,401 @@
+"""
+In-memory stand-in for an AMQP broker, for tests and benchmarks that should
+run without RabbitMQ.
+
+connect has the signature of aioamqp.connect and returns a protocol whose
+channels implement the part of the aioamqp channel API QueueManager uses:
+exchange and queue declarations, bindings with direct, fanout and topic
+routing, publishing (with publisher confirms), consuming with a prefetch
+count, acks and rejects. There is one broker per virtual host, shared by all
+connections of the process; reset drops them.
+
+QueueManager (and thus EventBus) use it with the transport set to 'memory':
+
+    EVENT_BUS_TRANSPORT=memory
+"""
+import asyncio
+import collections
+import itertools
+import logging
+from types import SimpleNamespace
+
+from aioamqp.envelope import Envelope
+from aioamqp.exceptions import AmqpClosedConnection, ChannelClosed
+from aioamqp.properties import Properties
+from aioamqp.protocol import CLOSED, OPEN
+
+logger = logging.getLogger(__name__)
+
+NOT_FOUND = 404
+PRECONDITION_FAILED = 406
+
+_BROKERS = {}
+
+
+def get_broker(virtualhost: str='/'):
+    broker = _BROKERS.get(virtualhost)
+    if broker is None:
+        broker = _BROKERS[virtualhost] = Broker()
+    return broker
+
+
+def reset():
+    """Drop all exchanges, queues and messages"""
+    _BROKERS.clear()
+
+
+# pylint: disable-msg=unused-argument
+async def connect(host='localhost', port=None, login='guest',
+                  password='guest', virtualhost='/', loop=None, **kwargs):
+    return None, Protocol(get_broker(virtualhost))
+
+
+def topic_matches(pattern: str, routing_key: str):
+    """Whether routing_key matches a topic binding pattern.
+
+    * matches exactly one word, # zero or more words.
+    """
+    return _words_match(pattern.split('.'), routing_key.split('.'))
+
+
+def _words_match(pattern, words):
+    if not pattern:
+        return not words
+    head, rest = pattern[0], pattern[1:]
+    if head == '#':
+        return any(_words_match(rest, words[index:])
+                   for index in range(len(words) + 1))
+    if not words or (head != '*' and head != words[0]):
+        return False
+    return _words_match(rest, words[1:])
+
+
+class Message:
+    __slots__ = ('body', 'properties', 'exchange_name', 'routing_key',
+                 'redelivered')
+
+    def __init__(self, body, properties, exchange_name, routing_key):
+        self.body = body
+        self.properties = properties
+        self.exchange_name = exchange_name
+        self.routing_key = routing_key
+        self.redelivered = False
+
+
+class Queue:
+
+    def __init__(self, name: str):
+        self.name = name
+        self.messages = collections.deque()
+        self.consumers = []
+        self.next_consumer = 0
+        self.dispatching = False
+
+    def put(self, message, front=False):
+        if front:
+            self.messages.appendleft(message)
+        else:
+            self.messages.append(message)
+        self.schedule_dispatch()
+
+    def schedule_dispatch(self):
+        # Deliveries are handed out from the loop, not from within publish
+        if not self.dispatching and self.messages and self.consumers:
+            self.dispatching = True
+            asyncio.get_event_loop().call_soon(self.dispatch)
+
+    def dispatch(self):
+        self.dispatching = False
+        consumers = self.consumers
+        while self.messages and consumers:
+            # Round robin over the consumers that can take a message
+            for offset in range(len(consumers)):
+                index = (self.next_consumer + offset) % len(consumers)
+                if consumers[index].channel.can_deliver():
+                    break
+            else:
+                return
+            self.next_consumer = (index + 1) % len(consumers)
+            consumers[index].deliver(self.messages.popleft())
+
+
+class Consumer:
+
+    def __init__(self, channel, tag: str, callback, queue, no_ack: bool):
+        self.channel = channel
+        self.tag = tag
+        self.callback = callback
+        self.queue = queue
+        self.no_ack = no_ack
+
+    def deliver(self, message):
+        self.channel.deliver(self, message)
+
+
+class Broker:
+
+    def __init__(self):
+        # name -> type
+        self.exchanges = {'': 'direct'}
+        self.queues = {}
+        # exchange name -> list of (routing key, queue name)
+        self.bindings = collections.defaultdict(list)
+        # (exchange name, routing key) -> queues, cleared on every change
+        self.routes = {}
+        self.queue_names = itertools.count(1)
+
+    def route(self, exchange_name: str, routing_key: str):
+        key = (exchange_name, routing_key)
+        queues = self.routes.get(key)
+        if queues is None:
+            queues = self.routes[key] = self.find_queues(exchange_name,
+                                                         routing_key)
+        return queues
+
+    def find_queues(self, exchange_name, routing_key):
+        if exchange_name == '':
+            queue = self.queues.get(routing_key)
+            return [queue] if queue is not None else []
+        exchange_type = self.exchanges[exchange_name]
+        names = []
+        for pattern, queue_name in self.bindings[exchange_name]:
+            if exchange_type == 'fanout' or \
+               (exchange_type == 'direct' and pattern == routing_key) or \
+               (exchange_type == 'topic' and
+                topic_matches(pattern, routing_key)):
+                if queue_name not in names:
+                    names.append(queue_name)
+        return [self.queues[name] for name in names]
+
+
+class Channel:
+
+    # pylint: disable-msg=too-many-instance-attributes
+    def __init__(self, protocol, channel_id: int):
+        self.protocol = protocol
+        self.broker = protocol.broker
+        self.channel_id = channel_id
+        self.is_open = True
+        self.publisher_confirms = False
+        self.confirming = False
+        self.publish_tags = itertools.count(1)
+        self.delivery_tags = itertools.count(1)
+        self.consumer_tags = itertools.count(1)
+        self.prefetch_count = 0
+        self.consumers = {}
+        # delivery tag -> (queue, message) of unacknowledged deliveries
+        self.unacked = collections.OrderedDict()
+        self.deliveries = collections.deque()
+        self.delivering = None
+
+    def check_open(self):
+        if not self.is_open:
+            raise ChannelClosed()
+
+    def fail(self, code, message):
+        # Like a broker, close the channel on errors
+        self.close_channel()
+        raise ChannelClosed(code, message)
+
+    async def exchange_declare(self, exchange_name, type_name, passive=False,
+                               durable=False, auto_delete=False,
+                               no_wait=False, arguments=None):
+        self.check_open()
+        exchanges = self.broker.exchanges
+        if exchange_name not in exchanges:
+            if passive:
+                self.fail(NOT_FOUND, f"no exchange '{exchange_name}'")
+            exchanges[exchange_name] = type_name
+        elif not passive and exchanges[exchange_name] != type_name:
+            self.fail(PRECONDITION_FAILED,
+                      f"exchange '{exchange_name}' is of another type")
+        return True
+
+    async def queue_declare(self, queue_name='', passive=False,
+                            durable=False, exclusive=False,
+                            auto_delete=False, no_wait=False,
+                            arguments=None):
+        self.check_open()
+        broker = self.broker
+        if not queue_name:
+            queue_name = f'amq.gen-{next(broker.queue_names)}'
+        queue = broker.queues.get(queue_name)
+        if queue is None:
+            if passive:
+                self.fail(NOT_FOUND, f"no queue '{queue_name}'")
+            queue = broker.queues[queue_name] = Queue(queue_name)
+            broker.routes.clear()
+        return {'queue': queue_name,
+                'message_count': len(queue.messages),
+                'consumer_count': len(queue.consumers)}
+
+    async def queue_bind(self, queue_name, exchange_name, routing_key,
+                         no_wait=False, arguments=None):
+        self.check_open()
+        broker = self.broker
+        if exchange_name not in broker.exchanges:
+            self.fail(NOT_FOUND, f"no exchange '{exchange_name}'")
+        if queue_name not in broker.queues:
+            self.fail(NOT_FOUND, f"no queue '{queue_name}'")
+        binding = (routing_key, queue_name)
+        if binding not in broker.bindings[exchange_name]:
+            broker.bindings[exchange_name].append(binding)
+            broker.routes.clear()
+        return True
+
+    async def publish(self, payload, exchange_name, routing_key,
+                      properties=None, mandatory=False, immediate=False):
+        self.check_open()
+        if isinstance(payload, str):
+            payload = payload.encode()
+        if exchange_name not in self.broker.exchanges:
+            self.fail(NOT_FOUND, f"no exchange '{exchange_name}'")
+        properties = properties or {}
+        for queue in self.broker.route(exchange_name, routing_key):
+            queue.put(Message(payload, properties, exchange_name,
+                              routing_key))
+        if self.confirming:
+            delivery_tag = next(self.publish_tags)
+            # aioamqp waits for the confirm if publisher_confirms is still
+            # set; every message is routed right away, so it is confirmed.
+            if not self.publisher_confirms:
+                frame = SimpleNamespace(delivery_tag=delivery_tag,
+                                        multiple=False)
+                asyncio.ensure_future(self.basic_server_ack(frame))
+
+    async def basic_server_ack(self, frame):
+        pass
+
+    async def confirm_select(self, no_wait=False):
+        self.check_open()
+        self.confirming = True
+        self.publisher_confirms = True
+
+    async def basic_qos(self, prefetch_size=0, prefetch_count=0,
+                        connection_global=False):
+        self.check_open()
+        self.prefetch_count = prefetch_count
+        for consumer in self.consumers.values():
+            consumer.queue.schedule_dispatch()
+
+    async def basic_consume(self, callback, queue_name='', consumer_tag='',
+                            no_local=False, no_ack=False, exclusive=False,
+                            no_wait=False, arguments=None):
+        self.check_open()
+        queue = self.broker.queues.get(queue_name)
+        if queue is None:
+            self.fail(NOT_FOUND, f"no queue '{queue_name}'")
+        consumer_tag = consumer_tag or \
+            f'ctag{self.channel_id}.{next(self.consumer_tags)}'
+        consumer = Consumer(self, consumer_tag, callback, queue, no_ack)
+        self.consumers[consumer_tag] = consumer
+        queue.consumers.append(consumer)
+        queue.schedule_dispatch()
+        return {'consumer_tag': consumer_tag}
+
+    async def basic_cancel(self, consumer_tag, no_wait=False):
+        consumer = self.consumers.pop(consumer_tag, None)
+        if consumer is not None:
+            consumer.queue.consumers.remove(consumer)
+        return {'consumer_tag': consumer_tag}
+
+    def can_deliver(self):
+        return self.prefetch_count == 0 or \
+            len(self.unacked) < self.prefetch_count
+
+    def deliver(self, consumer, message):
+        delivery_tag = next(self.delivery_tags)
+        if not consumer.no_ack:
+            self.unacked[delivery_tag] = (consumer.queue, message)
+        self.deliveries.append((consumer, delivery_tag, message))
+        if self.delivering is None:
+            self.delivering = asyncio.ensure_future(self.run_deliveries())
+
+    async def run_deliveries(self):
+        # Like aioamqp, callbacks of a channel are awaited one after another
+        try:
+            while self.deliveries and self.is_open:
+                consumer, delivery_tag, message = self.deliveries.popleft()
+                envelope = Envelope(consumer.tag, delivery_tag,
+                                    message.exchange_name,
+                                    message.routing_key, message.redelivered)
+                try:
+                    await consumer.callback(self, message.body, envelope,
+                                            Properties(**message.properties))
+                except Exception: # pylint: disable-msg=broad-except
+                    logger.exception("Error in consumer callback")
+        finally:
+            self.delivering = None
+
+    def settled(self, queues):
+        for queue in queues:
+            queue.schedule_dispatch()
+
+    async def basic_client_ack(self, delivery_tag, multiple=False):
+        self.check_open()
+        if multiple:
+            tags = [tag for tag in self.unacked if tag <= delivery_tag]
+        else:
+            tags = [delivery_tag]
+        queues = set()
+        for tag in tags:
+            if tag not in self.unacked:
+                self.fail(PRECONDITION_FAILED, f'unknown delivery tag {tag}')
+            queue, _ = self.unacked.pop(tag)
+            queues.add(queue)
+        self.settled(queues)
+
+    async def basic_reject(self, delivery_tag, requeue=False):
+        self.check_open()
+        if delivery_tag not in self.unacked:
+            self.fail(PRECONDITION_FAILED,
+                      f'unknown delivery tag {delivery_tag}')
+        queue, message = self.unacked.pop(delivery_tag)
+        if requeue:
+            message.redelivered = True
+            queue.put(message, front=True)
+        self.settled([queue])
+
+    def close_channel(self):
+        if not self.is_open:
+            return
+        self.is_open = False
+        for consumer_tag in list(self.consumers):
+            consumer = self.consumers.pop(consumer_tag)
+            consumer.queue.consumers.remove(consumer)
+        # Unacknowledged messages go back to their queues in order
+        for queue, message in reversed(list(self.unacked.values())):
+            message.redelivered = True
+            queue.put(message, front=True)
+        self.unacked.clear()
+        self.deliveries.clear()
+        self.protocol.channels.pop(self.channel_id, None)
+
+    async def close(self, reply_code=0, reply_text='Normal Shutdown'):
+        self.close_channel()
+
+
+class Protocol:
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.state = OPEN
+        self.channels = {}
+        self.channel_ids = itertools.count(1)
+        self.closed = asyncio.Event()
+
+    async def channel(self):
+        if self.state != OPEN:
+            raise AmqpClosedConnection()
+        channel = Channel(self, next(self.channel_ids))
+        self.channels[channel.channel_id] = channel
+        return channel
+
+    async def close(self, no_wait=False, timeout=None):
+        for channel in list(self.channels.values()):
+            channel.close_channel()
+        self.state = CLOSED
+        self.closed.set()
+
+    async def wait_closed(self, timeout=None):
+        await self.closed.wait()
@@ -1,82 +1,633 @@
 import asyncio
-import json
+import collections
 import logging
+import time
 
-import aioamqp
+from aioamqp.exceptions import (AmqpClosedConnection, ChannelClosed,
+                                PublishFailed)
 from aioamqp.protocol import OPEN
 
 import twyla.service.configuration as config
+import twyla.service.jsontool as jsontool
+import twyla.service.serialization as serialization
+import twyla.service.transports as transports
 from twyla.service.event import Event, split_event_name
+from twyla.service.telemetry import elapsed_ms
+
+logger = logging.getLogger(__name__)
+
+
+class PublishBuffer:
+    """Coalesces messages and hands them to publish_batch in batches.
+
+    A batch is written once max_size messages are pending or max_wait seconds
+    after the first message of the batch was added, whichever comes first.
+    batch_sizes counts how often a batch of each size was written.
+    """
+
+    def __init__(self, publish_batch, max_size: int, max_wait: float,
+                 loop=None):
+        assert max_size > 0, "max_size should be positive"
+        self.publish_batch = publish_batch
+        self.max_size = max_size
+        self.max_wait = max_wait
+        # The running loop, if not given
+        self.loop = loop
+        self.pending = []
+        self.timer = None
+        # Created on first use, so it belongs to the loop that is running then
+        self.lock = None
+        self.flushes = set()
+        self.batch_sizes = collections.Counter()
+
+
+    @property
+    def batches(self):
+        return sum(self.batch_sizes.values())
+
+
+    @property
+    def messages(self):
+        return sum(size * count for size, count in self.batch_sizes.items())
+
+
+    async def add(self, message):
+        self.pending.append(message)
+        if len(self.pending) >= self.max_size:
+            await self.flush()
+        elif self.timer is None:
+            loop = self.loop or asyncio.get_event_loop()
+            self.timer = loop.call_later(self.max_wait, self.flush_later)
+
+
+    def flush_later(self):
+        self.timer = None
+        task = asyncio.ensure_future(self.flush())
+        self.flushes.add(task)
+        task.add_done_callback(self.flush_done)
+
+
+    def flush_done(self, task):
+        self.flushes.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Error publishing buffered messages",
+                         exc_info=task.exception())
+
+
+    async def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        # The lock keeps batches in order if a size triggered flush happens
+        # while a timed one is still writing.
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if not batch:
+                return
+            self.batch_sizes[len(batch)] += 1
+            await self.publish_batch(batch)
+
+
+class ConfirmTracker:
+    """Tracks publisher confirms of a channel without waiting for each one.
+
+    aioamqp waits for the broker to confirm every single message when
+    publisher confirms are enabled. Instead, the tracker numbers the published
+    messages itself and hands out a future per message that is resolved once
+    the broker acks (or nacks) the delivery tag, including acks for multiple
+    tags at once. At most window messages can be outstanding; publishing more
+    waits until confirms come in.
+    """
+
+    def __init__(self, window: int, loop):
+        assert window > 0, "window should be positive"
+        self.window = window
+        self.loop = loop
+        self.slots = asyncio.Semaphore(window)
+        self.outstanding = collections.OrderedDict()
+        self.next_tag = 1
+
+
+    async def attach(self, channel):
+        await channel.confirm_select()
+        # Confirms are handled here, so aioamqp must not wait for them. The
+        # handlers are looked up on the instance when frames are dispatched.
+        channel.publisher_confirms = False
+        channel.basic_server_ack = self.on_ack
+        channel.basic_server_nack = self.on_nack
+
+
+    async def reserve(self):
+        """Wait for a free slot and return the future of the next message.
+
+        Must be called right before publishing, without awaiting anything else
+        in between, so the delivery tags match the order of publishes.
+        """
+        await self.slots.acquire()
+        confirmed = self.loop.create_future()
+        self.outstanding[self.next_tag] = confirmed
+        self.next_tag += 1
+        return confirmed
+
+
+    def cancel(self, confirmed):
+        """Give up the slot of a message that failed to be published"""
+        for tag, future in self.outstanding.items():
+            if future is confirmed:
+                del self.outstanding[tag]
+                self.slots.release()
+                return
+
+
+    def resolved_tags(self, delivery_tag, multiple):
+        if not multiple:
+            return [delivery_tag] if delivery_tag in self.outstanding else []
+        return [tag for tag in self.outstanding if tag <= delivery_tag]
+
+
+    def resolve(self, tags, error=None):
+        for tag in tags:
+            confirmed = self.outstanding.pop(tag)
+            self.slots.release()
+            if confirmed.done():
+                continue
+            if error is None:
+                confirmed.set_result(True)
+            else:
+                confirmed.set_exception(error(tag))
+
+
+    async def on_ack(self, frame):
+        self.resolve(self.resolved_tags(frame.delivery_tag, frame.multiple))
+
+
+    async def on_nack(self, frame, delivery_tag=None):
+        tags = self.resolved_tags(frame.delivery_tag, frame.multiple)
+        self.resolve(tags, error=PublishFailed)
+
+
+    def fail_all(self, error):
+        for tag in list(self.outstanding):
+            self.resolve([tag], error=lambda tag: error)
+
+
+    async def wait(self):
+        """Wait until all outstanding messages are confirmed.
+
+        Raises PublishFailed if any of them was nacked.
+        """
+        if self.outstanding:
+            await asyncio.gather(*self.outstanding.values())
+
+
+def chain_future(source, target):
+    def copy_result(source):
+        if target.done():
+            return
+        if source.cancelled():
+            target.cancel()
+        elif source.exception() is not None:
+            target.set_exception(source.exception())
+        else:
+            target.set_result(source.result())
+    source.add_done_callback(copy_result)
+
+
+class QueueSampler:
+    """Samples the depth of the queues a QueueManager consumes from.
+
+    Every interval seconds, each queue bound by the queue manager is declared
+    passively, which returns its message and consumer counts without changing
+    it. The declarations use a channel of their own, as the broker closes the
+    channel if a queue is gone, and that must not take down the topology
+    channel of the queue manager. The latest counts are kept in counts for
+    in-process users (e.g. autoscaling or adaptive prefetch) and, if a
+    Telemetry instance is given, sent as <event>.queue_messages and
+    <event>.queue_consumers, both notified with the queue name and the count.
+    """
+
+    def __init__(self, queue_manager, interval: float, telemetry=None):
+        self.queue_manager = queue_manager
+        self.interval = interval
+        self.telemetry = telemetry
+        # queue name -> (message count, consumer count)
+        self.counts = {}
+        self._sampler = None
+        self._channel = None
+
+
+    def message_count(self, queue_name):
+        return self.counts.get(queue_name, (None, None))[0]
+
+
+    def consumer_count(self, queue_name):
+        return self.counts.get(queue_name, (None, None))[1]
+
+
+    def total_message_count(self):
+        return sum(messages for messages, _ in self.counts.values())
+
+
+    async def channel(self):
+        """The channel of the sampler, opened again if it was closed"""
+        channel = self._channel
+        if channel is None or not channel.is_open:
+            channel = await self.queue_manager.protocol.channel()
+            self._channel = channel
+        return channel
+
+
+    async def sample(self):
+        if self.queue_manager.protocol is None or \
+           self.queue_manager.channel is None:
+            return
+        for queue_name in list(self.queue_manager.bound_queues):
+            channel = await self.channel()
+            try:
+                result = await channel.queue_declare(queue_name, passive=True)
+            except ChannelClosed:
+                logger.warning("Queue %s is gone, not sampling it",
+                               queue_name)
+                self.counts.pop(queue_name, None)
+                self._channel = None
+                continue
+            messages = result['message_count']
+            consumers = result['consumer_count']
+            self.counts[queue_name] = (messages, consumers)
+            if self.telemetry is not None:
+                self.telemetry.notify(self.telemetry.event.queue_messages,
+                                      queue_name, messages)
+                self.telemetry.notify(self.telemetry.event.queue_consumers,
+                                      queue_name, consumers)
+
+
+    async def start(self):
+        if self._sampler is None:
+            self._sampler = asyncio.ensure_future(self._run())
+
+
+    async def stop(self):
+        if self._sampler is not None:
+            self._sampler.cancel()
+            try:
+                await self._sampler
+            except asyncio.CancelledError:
+                pass
+            self._sampler = None
+        channel, self._channel = self._channel, None
+        if channel is not None and channel.is_open:
+            await channel.close()
+
+
+    async def _run(self):
+        while True:
+            try:
+                await self.sample()
+            except Exception: # pylint: disable-msg=broad-except
+                logger.warning("Error sampling queue depths", exc_info=True)
+            await asyncio.sleep(self.interval)
 
 
 class QueueManager:
 
-    def __init__(self, configuration_prefix):
+    def __init__(self, configuration_prefix, telemetry=None):
         self.config = config.from_env(configuration_prefix)
+        # See twyla.service.transports
+        self.transport = transports.get_transport(self.config.get('transport'))
+        # Notified with the duration of publishes in milliseconds as
+        # <event>.publish
+        self.telemetry = telemetry
         self.protocol = None
+        # Topology (exchange and queue) declarations use this channel, so they
+        # are not held up by slow consumers or flow controlled publishes.
         self.channel = None
-        self.closed_event = asyncio.Event()
-        self.loop = asyncio.get_event_loop()
+        # Publishes are distributed round robin over these channels. They are
+        # opened with the connection: a handler that emits runs inside the
+        # frame reader of aioamqp, which could not read the reply to opening
+        # a channel then.
+        self.publishers = []
+        self.publisher_count = int(self.config.get('publisher_channels', 1))
+        assert self.publisher_count > 0, "publisher_channels should be positive"
+        self.next_publisher = 0
+        self.publishers_lock = None
+        # Every consumer gets a channel of its own with its own QoS
+        self.consumer_channels = []
+        # Declarations done on the current connection, see declare_once
+        self.topology = {}
+        # Names of the queues consumed from, see QueueSampler
+        self.bound_queues = set()
+        # While reconnecting, emitted messages are kept here until the
+        # connection is back; see reconnect and resume.
+        self.reconnecting = False
+        self.pending_emits = []
+        self.pending_emits_limit = int(
+            self.config.get('reconnect_buffer_size', 1000))
+        # The loop is the one running when the connection is opened, not the
+        # one at construction, so a loop policy set later (see EventBus.main)
+        # applies. The same goes for the asyncio primitives, which are bound
+        # to the loop they are created on (up to Python 3.9).
+        self.loop = None
+        self._closed_event = None
+        self.publisher_confirms = self.config.get(
+            'publisher_confirms', '').lower() in ('1', 'true')
+        self.publish_buffer = None
+        buffer_size = int(self.config.get('publish_buffer_size', 0))
+        if buffer_size > 0:
+            self.publish_buffer = PublishBuffer(
+                self.publish_batch,
+                max_size=buffer_size,
+                max_wait=float(self.config.get('publish_buffer_wait', 0.05)))
+
+    @property
+    def closed_event(self):
+        """Set when the connection to the broker is lost"""
+        if self._closed_event is None:
+            self._closed_event = asyncio.Event()
+        return self._closed_event
+
 
     async def connect(self):
         if self.protocol is not None and self.channel is not None:
             return
-        _, protocol = await aioamqp.connect(
-            self.config['amqp_host'],
-            self.config['amqp_port'],
-            self.config['amqp_user'],
-            self.config['amqp_pass'],
-            self.config['amqp_vhost'],
-            loop=self.loop
-        )
-        self.protocol = protocol
+        if self.reconnecting:
+            # The reconnecting task takes care of it, emits are buffered
+            return
+        return await self.open_connection()
+
+
+    async def open_connection(self):
+        self.loop = asyncio.get_event_loop()
+        self.protocol = await self.transport.connect(self.config, self.loop)
         self.channel = await self.protocol.channel()
-        return asyncio.ensure_future(self.signal_on_disconnect())
+        self.topology = {}
+        await self.open_publishers()
+        return asyncio.ensure_future(self.signal_on_disconnect(self.protocol))
 
 
-    async def signal_on_disconnect(self):
-        await self.protocol.wait_closed()
+    async def signal_on_disconnect(self, protocol):
+        await protocol.wait_closed()
+        if protocol is not self.protocol:
+            # Closed by reconnect, which replaced it with a new connection
+            return
+        self.fail_confirms()
         self.closed_event.set()
 
 
+    def fail_confirms(self):
+        for _, tracker in self.publishers:
+            if tracker is not None:
+                tracker.fail_all(AmqpClosedConnection('Connection closed'))
+
+
+    async def reconnect(self):
+        """Drop the state of the lost connection and open a new one.
+
+        Emits are buffered from the first call until resume is called.
+        """
+        self.reconnecting = True
+        protocol, self.protocol = self.protocol, None
+        self.fail_confirms()
+        if protocol is not None and protocol.state is OPEN:
+            try:
+                await protocol.close()
+            except Exception: # pylint: disable-msg=broad-except
+                logger.debug("Error closing stale connection", exc_info=True)
+        self.channel = None
+        self.publishers = []
+        self.next_publisher = 0
+        self.consumer_channels = []
+        self.closed_event.clear()
+        return await self.open_connection()
+
+
+    async def resume(self):
+        """Publish the messages emitted while reconnecting"""
+        self.reconnecting = False
+        pending, self.pending_emits = self.pending_emits, []
+        await self.publish_batch(pending)
+
+
+    async def open_publishers(self):
+        if self.publishers_lock is None:
+            self.publishers_lock = asyncio.Lock()
+        async with self.publishers_lock:
+            while len(self.publishers) < self.publisher_count:
+                channel = await self.protocol.channel()
+                tracker = None
+                if self.publisher_confirms:
+                    tracker = ConfirmTracker(
+                        window=int(self.config.get('confirm_window', 1000)),
+                        loop=self.loop)
+                    await tracker.attach(channel)
+                self.publishers.append((channel, tracker))
+
+
+    async def publisher(self):
+        """Return the next (channel, confirm tracker) pair for publishing"""
+        if len(self.publishers) < self.publisher_count:
+            await self.open_publishers()
+        index = self.next_publisher
+        self.next_publisher = (index + 1) % self.publisher_count
+        return self.publishers[index]
+
+
+    async def declare_once(self, key, declare):
+        """Run the declaration coroutine function declare once per connection.
+
+        Concurrent callers with the same key wait for the same declaration. A
+        failed declaration is forgotten so it can be retried.
+        """
+        declaration = self.topology.get(key)
+        if declaration is None:
+            declaration = asyncio.ensure_future(declare())
+            self.topology[key] = declaration
+
+            def forget_failed(declaration):
+                if declaration.cancelled() or declaration.exception():
+                    if self.topology.get(key) is declaration:
+                        del self.topology[key]
+            declaration.add_done_callback(forget_failed)
+        # Do not cancel the declaration other callers may be waiting for
+        return await asyncio.shield(declaration)
+
+
     # Binding queues is only relevant for listeners, publishing will be done to
     # the exchange.
     async def bind_queue(self, event_name, event_group):
         domain, event_type = split_event_name(event_name)
         queue_name = f'{domain}.{event_type}.{event_group}'
-        await self.declare_exchange(domain)
-        await self.channel.queue_declare(queue_name, durable=True)
-        await self.channel.queue_bind(
-            exchange_name=domain,
-            queue_name=queue_name,
-            routing_key=event_type)
+        await self.bind_events(queue_name, [event_name])
         return queue_name
 
 
+    async def bind_events(self, queue_name, event_names):
+        """Declare the queue and bind it to the events with the given names"""
+        bindings = [split_event_name(event_name) for event_name in event_names]
+        domains = sorted({domain for domain, _ in bindings})
+        await asyncio.gather(
+            *[self.declare_exchange(domain) for domain in domains],
+            self.declare_once(
+                ('queue', queue_name),
+                lambda: self.channel.queue_declare(queue_name, durable=True)))
+        await asyncio.gather(*[
+            self.declare_once(
+                ('binding', domain, queue_name, event_type),
+                # Bind the loop variables now, not when the lambda is called
+                lambda domain=domain, event_type=event_type:
+                self.channel.queue_bind(exchange_name=domain,
+                                        queue_name=queue_name,
+                                        routing_key=event_type))
+            for domain, event_type in bindings])
+        self.bound_queues.add(queue_name)
+
+
     async def stop(self):
-        if self.channel is not None and self.channel.is_open:
-            await self.channel.close()
+        if self.publish_buffer is not None:
+            if self.publish_buffer.pending:
+                # Emits may have been buffered before connecting
+                await self.connect()
+            await self.publish_buffer.flush()
+        channels = [channel for channel, _ in self.publishers]
+        channels.extend(self.consumer_channels)
+        channels.append(self.channel)
+        for channel in channels:
+            if channel is not None and channel.is_open:
+                await channel.close()
         if self.protocol is not None and self.protocol.state is OPEN:
             await self.protocol.close()
 
 
     async def declare_exchange(self, exchange_name):
-        await self.channel.exchange_declare(exchange_name=exchange_name,
-                                            type_name='topic',
-                                            durable=True)
+        await self.declare_once(
+            ('exchange', exchange_name),
+            lambda: self.channel.exchange_declare(exchange_name=exchange_name,
+                                                  type_name='topic',
+                                                  durable=True))
+
+
+    async def emit(self, event_name, payload, properties=None):
+        """Publish payload to the exchange of the event.
+
+        properties are the AMQP basic properties of the message. With
+        publisher confirms enabled, this returns a future that is resolved
+        when the broker confirms the message; otherwise None.
+        """
+        if self.publish_buffer is None and not self.reconnecting:
+            return await self.publish(event_name, payload, properties)
+        confirmed = None
+        if self.publisher_confirms:
+            confirmed = self.loop.create_future()
+        message = (event_name, payload, properties, confirmed)
+        if self.reconnecting:
+            if len(self.pending_emits) >= self.pending_emits_limit:
+                raise RuntimeError(
+                    'Not connected and the reconnect buffer is full')
+            self.pending_emits.append(message)
+        else:
+            await self.publish_buffer.add(message)
+        return confirmed
+
+
+    async def emit_many(self, messages):
+        """Emit an iterable of (event_name, payload) or
+        (event_name, payload, properties) tuples.
 
+        Returns a list with the result of emit for every message.
+        """
+        if self.publish_buffer is None and not self.reconnecting:
+            return await self.publish_many(messages)
+        return [await self.emit(*message) for message in messages]
 
-    async def emit(self, event_name, payload):
-        # Try to json.dumps if the payload is not a string or bytes
+
+    async def wait_for_confirms(self):
+        """Wait until the broker confirmed all messages published so far"""
+        if self.publish_buffer is not None:
+            await self.publish_buffer.flush()
+        for _, tracker in self.publishers:
+            if tracker is not None:
+                await tracker.wait()
+
+
+    async def publish_many(self, messages):
+        return [await self.publish(*message) for message in messages]
+
+
+    async def publish_batch(self, batch):
+        # Publishes a batch of buffered messages and hands the confirms on to
+        # the futures returned by emit.
+        if self.reconnecting:
+            # Messages accepted by the publish buffer are kept even if that
+            # exceeds the limit of the reconnect buffer.
+            self.pending_emits.extend(batch)
+            return
+        for index, (event_name, payload, properties, confirmed) in \
+                enumerate(batch):
+            try:
+                confirm = await self.publish(event_name, payload, properties)
+            except Exception as err:
+                for *_, pending in batch[index:]:
+                    if pending is not None:
+                        pending.set_exception(err)
+                raise
+            if confirmed is not None:
+                chain_future(confirm, confirmed)
+
+
+    async def publish(self, event_name, payload, properties=None):
+        properties = dict(properties or {})
+        # Encode to JSON if the payload is not a string or bytes
         if not isinstance(payload, str) and not isinstance(payload, bytes):
-            payload = json.dumps(payload)
+            payload = jsontool.encode(payload)
+            properties.setdefault('content_type', serialization.JSON)
         domain, event_type = split_event_name(event_name)
-        retval = await self.channel.publish(
-            payload=payload,
-            exchange_name=domain,
-            routing_key=event_type)
+        channel, tracker = await self.publisher()
+        confirmed = None
+        if tracker is not None:
+            confirmed = await tracker.reserve()
+        telemetry = self.telemetry
+        timed = telemetry is not None and telemetry.active
+        if timed:
+            started = time.perf_counter()
+        try:
+            await channel.publish(
+                payload=payload,
+                exchange_name=domain,
+                routing_key=event_type,
+                properties=properties)
+            if timed:
+                telemetry.notify(telemetry.event.publish, elapsed_ms(started))
+        except Exception:
+            if confirmed is not None:
+                tracker.cancel(confirmed)
+            raise
+        return confirmed
 
-    async def listen(self, event_name, event_group, callback):
+    async def listen(self, event_name, event_group, callback,
+                     prefetch_count=None):
         queue_name = await self.bind_queue(event_name, event_group)
-        await self.channel.basic_consume(callback=callback,
-                                         queue_name=queue_name)
+        await self.consume(queue_name, callback, prefetch_count)
+
+
+    async def listen_many(self, event_names, queue_name, callback,
+                          prefetch_count=None):
+        """Consume the events with the given names from one queue.
+
+        The queue is not shared by event and group like the ones of listen, so
+        its name should be namespaced by the service, as in service.group.
+        """
+        assert "." in queue_name, \
+            "Queue names should be of format service.group"
+        await self.bind_events(queue_name, event_names)
+        await self.consume(queue_name, callback, prefetch_count)
+
+
+    async def consume(self, queue_name, callback, prefetch_count=None):
+        channel = await self.protocol.channel()
+        self.consumer_channels.append(channel)
+        if prefetch_count is not None:
+            await channel.basic_qos(prefetch_count=prefetch_count,
+                                    connection_global=False)
+        await channel.basic_consume(callback=callback,
+                                    queue_name=queue_name)
@@ -0,0 +1,178 @@
+"""
+Wire formats for event payloads, keyed by the AMQP content type, and
+compressions, keyed by the AMQP content encoding.
+
+JSON is always available. MessagePack is available if the msgpack package is
+installed. Types without a native representation in a format are serialized
+with jsontool.default, so they arrive as the same strings as in JSON.
+
+Deflate (zlib) compression is always available, zstd and lz4 if the zstandard
+and lz4 packages are installed.
+"""
+import zlib
+
+import twyla.service.jsontool as jsontool
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+
+
+class MsgpackCodec:
+    name = 'msgpack'
+
+    @staticmethod
+    def encode(obj) -> bytes:
+        return msgpack.packb(obj, default=jsontool.default, use_bin_type=True)
+
+    @staticmethod
+    def decode(data):
+        return msgpack.unpackb(data, raw=False)
+
+
+class _JSONCodec:
+    # Delegates to whichever codec jsontool currently uses
+    name = 'json'
+
+    @staticmethod
+    def encode(obj) -> bytes:
+        return jsontool.encode(obj)
+
+    @staticmethod
+    def decode(data):
+        return jsontool.decode(data)
+
+
+_FORMATS = {
+    JSON: (_JSONCodec, jsontool),
+    MSGPACK: (MsgpackCodec, msgpack),
+}
+
+
+def available_content_types():
+    return [content_type for content_type, (_, module) in _FORMATS.items()
+            if module is not None]
+
+
+def get_codec(content_type: str=None):
+    """Return the codec for content_type; JSON if it is not set"""
+    codec, module = _FORMATS.get(content_type or JSON, (None, None))
+    if module is None:
+        raise ValueError(f'Unsupported content type {content_type}')
+    return codec
+
+
+def payload_content_type(content_type: str=None):
+    """Return the content type to decode a payload of content_type with.
+
+    Parameters like charset are ignored. Other publishers label JSON in many
+    ways (text/plain, application/vnd.api+json, ...), so anything that is not
+    one of the wire formats above is decoded as JSON.
+    """
+    if not content_type:
+        return JSON
+    media_type = content_type.split(';', 1)[0].strip().lower()
+    if media_type in _FORMATS:
+        return media_type
+    return JSON
+
+
+def encode(obj, content_type: str=None) -> bytes:
+    return get_codec(content_type).encode(obj)
+
+
+def decode(data, content_type: str=None):
+    return get_codec(content_type).decode(data)
+
+
+DEFLATE = 'deflate'
+ZSTD = 'zstd'
+LZ4 = 'lz4'
+
+
+class DeflateCompression:
+    name = DEFLATE
+
+    @staticmethod
+    def compress(data: bytes) -> bytes:
+        return zlib.compress(data)
+
+    @staticmethod
+    def decompress(data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+class ZstdCompression:
+    name = ZSTD
+
+    @staticmethod
+    def compress(data: bytes) -> bytes:
+        return zstandard.ZstdCompressor().compress(data)
+
+    @staticmethod
+    def decompress(data: bytes) -> bytes:
+        return zstandard.ZstdDecompressor().decompress(data)
+
+
+class LZ4Compression:
+    name = LZ4
+
+    @staticmethod
+    def compress(data: bytes) -> bytes:
+        return lz4.frame.compress(data)
+
+    @staticmethod
+    def decompress(data: bytes) -> bytes:
+        return lz4.frame.decompress(data)
+
+
+_COMPRESSIONS = {
+    DEFLATE: (DeflateCompression, zlib),
+    ZSTD: (ZstdCompression, zstandard),
+    LZ4: (LZ4Compression, lz4),
+}
+
+
+def available_content_encodings():
+    return [encoding for encoding, (_, module) in _COMPRESSIONS.items()
+            if module is not None]
+
+
+def get_compression(content_encoding: str):
+    compression, module = _COMPRESSIONS.get(content_encoding, (None, None))
+    if module is None:
+        raise ValueError(f'Unsupported content encoding {content_encoding}')
+    return compression
+
+
+def compress(data: bytes, content_encoding: str) -> bytes:
+    return get_compression(content_encoding).compress(data)
+
+
+def decompress(data: bytes, content_encoding: str=None) -> bytes:
+    """Decompress data.
+
+    Data without a content encoding, or with one that is not a compression
+    (other publishers commonly set 'utf-8'), is returned as is.
+    """
+    if not content_encoding:
+        return data
+    content_encoding = content_encoding.strip().lower()
+    if content_encoding not in _COMPRESSIONS:
+        return data
+    return get_compression(content_encoding).decompress(data)
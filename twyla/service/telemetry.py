@@ -22,9 +22,17 @@ Usage example:
     # prints 1 2 telemetry.incoming
 """
 
-import socket
+import asyncio
+import collections
+import logging
+import math
+import pickle
+import struct
+import sys
 import time
 
+logger = logging.getLogger(__name__)
+
 
 # Event is a support class illustrated in the introductory usage example.
 class Event:
@@ -32,36 +40,53 @@ class Event:
         self.name = name
 
     def __getattr__(self, attr_name):
-        return '.'.join([self.name, attr_name])
+        # Leave the lookup of special methods (copy, pickle) alone
+        if attr_name.startswith('__'):
+            raise AttributeError(attr_name)
+        # The interned name is cached as an attribute, so __getattr__ is only
+        # called on the first access and later lookups don't allocate.
+        event_name = sys.intern('.'.join([self.name, attr_name]))
+        setattr(self, attr_name, event_name)
+        return event_name
 
 
 class Telemetry:
     def __init__(self, event: Event=Event('telemetry')):
-        # The registry maps handlers to event classes
+        # The registry maps event classes to tuples of handlers. It is never
+        # modified in place but replaced on every change, so notify can
+        # iterate it without copying even if handlers change the registry.
         self._registry = {}
+        # False as long as no handler is registered. Instrumented code can
+        # check it to skip collecting data nobody listens to.
+        self.active = False
         self.event = event
 
+    def _update(self, event_class, handlers):
+        registry = dict(self._registry)
+        registry[event_class] = handlers
+        self._registry = registry
+        self.active = any(registry.values())
+
     def register(self, event_class, func):
         if not callable(func):
             raise TypeError('{} is not callable'.format(func))
 
-        if event_class in self._registry.keys():
-            self._registry[event_class].append(func)
-        else:
-            self._registry[event_class] = [func]
+        self._update(event_class,
+                     self._registry.get(event_class, ()) + (func,))
 
     def deregister(self, event_class, func):
-        if event_class in self._registry.keys():
+        if event_class in self._registry:
             # Remove all instances of func
-            self._registry[event_class] = [f for f in
-                                           self._registry[event_class]
-                                           if f != func]
+            self._update(event_class,
+                         tuple(f for f in self._registry[event_class]
+                               if f != func))
 
     def notify(self, event_class, *event):
+        if not self.active:
+            return
         # Do nothing if the event class is unknown
-        if event_class in self._registry.keys():
-            for func in self._registry[event_class]:
-                func(*event)
+        for func in self._registry.get(event_class, ()):
+            func(*event)
 
     def register_ticker(self, callback, attr: str):
         # Basic check if the callback is actually callable. Skipping signature
@@ -95,23 +120,345 @@ class Telemetry:
 
         self.register(name, call)
 
+    def register_duration(self, callback, attr: str):
+        # Like register_timer, but the notifier measures the duration itself
+        # (usually with a monotonic clock, see elapsed_ms) and passes it on in
+        # milliseconds:
+        #
+        # t.register_duration(g.send, 'test')
+        # t.notify(t.event.test, elapsed_ms(started))
+        if not callable(callback):
+            raise TypeError('The provided callback is not callable')
+
+        name = getattr(self.event, attr)
+        self.register(name, lambda milli_seconds: callback(name,
+                                                            milli_seconds))
+
+    def register_gauge(self, callback, attr: str):
+        # t.register_gauge(g.send, 'in_flight')
+        # t.notify(t.event.in_flight, 3)
+        if not callable(callback):
+            raise TypeError('The provided callback is not callable')
+
+        name = getattr(self.event, attr)
+        self.register(name, lambda value: callback(name, value))
+
+
+def elapsed_ms(started: float):
+    """Milliseconds since started, a time.perf_counter() value"""
+    return (time.perf_counter() - started) * 1000
+
+
+class Histogram:
+    """Fixed memory sketch of a distribution of non-negative values.
+
+    Values are counted in logarithmic buckets, so percentiles have a relative
+    error of at most relative_accuracy. If there are more than max_buckets
+    buckets, the lowest ones are merged, which only affects the accuracy of
+    the lowest percentiles. Count, sum, min and max are exact.
+    """
+
+    def __init__(self, relative_accuracy: float=0.01, max_buckets: int=1024):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_buckets = max_buckets
+        self.buckets = {}
+        self.zeros = 0
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if value <= 0:
+            self.zeros += 1
+            return
+        index = math.ceil(math.log(value) / self.log_gamma)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        if len(self.buckets) > self.max_buckets:
+            lowest, second = sorted(self.buckets)[:2]
+            self.buckets[second] += self.buckets.pop(lowest)
+
+    def merge(self, other):
+        """Add the values of another histogram with the same accuracy"""
+        if not other.count:
+            return
+        self.count += other.count
+        self.sum += other.sum
+        self.zeros += other.zeros
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        while len(self.buckets) > self.max_buckets:
+            lowest, second = sorted(self.buckets)[:2]
+            self.buckets[second] += self.buckets.pop(lowest)
+
+    def percentile(self, percentile: float):
+        if not self.count:
+            return None
+        if percentile >= 100:
+            return self.max
+        rank = percentile / 100 * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                value = 2 * self.gamma ** index / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+
+class Aggregator:
+    """Aggregates metrics in memory and sends them once per flush interval.
+
+    count, gauge and timing have the callback signature of register_ticker and
+    register_timer, so an aggregator can be put between telemetry and, for
+    example, Graphite:
+
+        graphite = Graphite()
+        aggregator = Aggregator(graphite.send)
+        t.register_ticker(aggregator.count, 'incoming')
+        t.register_timer(aggregator.timing, 'handler')
+        await aggregator.start()
+
+    Per interval, counters are sent as their sum, gauges as their last value
+    and timers as <name>.count, .sum, .min, .max and .p<percentile>.
+    """
+
+    #pylint: disable-msg=bad-whitespace
+    def __init__(self, callback, flush_interval: float=10.0,
+                 percentiles=(50, 90, 99), relative_accuracy: float=0.01):
+        if not callable(callback):
+            raise TypeError('The provided callback is not callable')
+        self.callback = callback
+        self.flush_interval = flush_interval
+        self.percentiles = percentiles
+        self.relative_accuracy = relative_accuracy
+        self.counters = {}
+        self.gauges = {}
+        self.timers = {}
+        self._flusher = None
+
+    def count(self, name: str, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name: str, value):
+        self.gauges[name] = value
+
+    def timing(self, name: str, value):
+        histogram = self.timers.get(name)
+        if histogram is None:
+            histogram = self.timers[name] = Histogram(self.relative_accuracy)
+        histogram.add(value)
+
+    def take(self):
+        """Return the counters, gauges and timers and start over"""
+        counters, self.counters = self.counters, {}
+        gauges, self.gauges = self.gauges, {}
+        timers, self.timers = self.timers, {}
+        return counters, gauges, timers
+
+    def merge(self, counters, gauges, timers, source: str=None):
+        """Add metrics taken from another aggregator.
+
+        Counters and timers are added up. A gauge is a value of its source at
+        one point in time, so with a source given (e.g. the worker process it
+        comes from), the gauges are kept apart as <name>.<source>.
+        """
+        for name, value in counters.items():
+            self.count(name, value)
+        for name, value in gauges.items():
+            if source is not None:
+                name = f'{name}.{source}'
+            self.gauges[name] = value
+        for name, other in timers.items():
+            histogram = self.timers.get(name)
+            if histogram is None:
+                self.timers[name] = other
+            else:
+                histogram.merge(other)
+
+    def flush(self):
+        timestamp = int(time.time())
+        counters, gauges, timers = self.take()
+        for name, value in counters.items():
+            self.callback(name, value, timestamp)
+        for name, value in gauges.items():
+            self.callback(name, value, timestamp)
+        for name, histogram in timers.items():
+            self.callback(name + '.count', histogram.count, timestamp)
+            self.callback(name + '.sum', histogram.sum, timestamp)
+            self.callback(name + '.min', histogram.min, timestamp)
+            self.callback(name + '.max', histogram.max, timestamp)
+            for percentile in self.percentiles:
+                self.callback('{}.p{}'.format(name, percentile),
+                              histogram.percentile(percentile), timestamp)
+
+    async def start(self):
+        if self._flusher is None:
+            self._flusher = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self.flush()
+
 
 class Graphite:
-    def __init__(self, graphite_host: str='localhost', graphite_port: int=2003):
-        super().__init__()
-        self._graphite_server = (graphite_host, graphite_port)
+    """Buffered, asyncio based Graphite client.
 
-    def _get_socket(self):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect(self._graphite_server)
+    send only queues the metric, so it is safe to call from telemetry
+    callbacks running in the event loop. Once started, the queued metrics are
+    written in batches every flush_interval seconds, or as soon as batch_size
+    metrics are queued, over a long-lived connection that is re-established
+    when it breaks. At most buffer_size metrics are kept; the oldest ones are
+    dropped (and counted in dropped) when the buffer is full.
 
-        return sock
+    protocol is one of 'plaintext' (TCP, port 2003), 'pickle' (TCP, port
+    2004) or 'udp' (plaintext over UDP).
+    """
+    PROTOCOLS = ('plaintext', 'pickle', 'udp')
+    # Keep datagrams below the usual MTU
+    MAX_DATAGRAM_SIZE = 1400
+
+    #pylint: disable-msg=bad-whitespace
+    def __init__(self, graphite_host: str='localhost', graphite_port: int=2003,
+                 protocol: str='plaintext', buffer_size: int=10000,
+                 batch_size: int=500, flush_interval: float=1.0):
+        super().__init__()
+        if protocol not in self.PROTOCOLS:
+            raise ValueError('Unknown Graphite protocol {}'.format(protocol))
+        self._graphite_server = (graphite_host, graphite_port)
+        self.protocol = protocol
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = collections.deque(maxlen=buffer_size)
+        self.dropped = 0
+        self._transport = None
+        self._writer = None
+        self._flusher = None
+        self._flush_now = None
 
     #pylint: disable-msg=bad-whitespace
     def send(self, name: str, value: int=0, timestamp: int=0):
         if not timestamp:
             timestamp = int(time.time())
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+        self.buffer.append((name, value, timestamp))
+        if len(self.buffer) >= self.batch_size and self._flush_now is not None:
+            self._flush_now.set()
+
+    async def start(self):
+        if self._flusher is None:
+            self._flush_now = asyncio.Event()
+            self._flusher = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+            self._flush_now = None
+        await self.flush()
+        self._close()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(),
+                                       self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+            await self.flush()
+
+    async def flush(self):
+        while self.buffer:
+            batch = [self.buffer.popleft()
+                     for _ in range(min(self.batch_size, len(self.buffer)))]
+            try:
+                await self._write(batch)
+            except (OSError, asyncio.TimeoutError):
+                logger.warning('Error sending metrics to Graphite',
+                               exc_info=True)
+                self._close()
+                # Put the batch back for the next try, as far as there is room
+                for metric in reversed(batch):
+                    if len(self.buffer) == self.buffer.maxlen:
+                        self.dropped += 1
+                        break
+                    self.buffer.appendleft(metric)
+                return
+
+    @staticmethod
+    def format_plaintext(batch):
+        return ''.join('%s %s %d\n' % metric for metric in batch).encode(
+            'ascii')
+
+    @staticmethod
+    def format_pickle(batch):
+        payload = pickle.dumps(
+            [(name, (timestamp, value)) for name, value, timestamp in batch],
+            protocol=2)
+        return struct.pack('!L', len(payload)) + payload
+
+    async def _write(self, batch):
+        if self.protocol == 'udp':
+            if self._transport is None:
+                loop = asyncio.get_event_loop()
+                self._transport, _ = await loop.create_datagram_endpoint(
+                    asyncio.DatagramProtocol,
+                    remote_addr=self._graphite_server)
+            datagram = []
+            size = 0
+            for metric in batch:
+                line = self.format_plaintext([metric])
+                if size + len(line) > self.MAX_DATAGRAM_SIZE and datagram:
+                    self._transport.sendto(b''.join(datagram))
+                    datagram, size = [], 0
+                datagram.append(line)
+                size += len(line)
+            self._transport.sendto(b''.join(datagram))
+            return
+
+        if self._writer is None:
+            _, self._writer = await asyncio.open_connection(
+                *self._graphite_server)
+        if self.protocol == 'pickle':
+            self._writer.write(self.format_pickle(batch))
+        else:
+            self._writer.write(self.format_plaintext(batch))
+        await self._writer.drain()
 
-        sock = self._get_socket()
-        sock.sendall(bytes("%s %d %d\n" % (name, value, timestamp), 'ascii'))
-        sock.close()
\ No newline at end of file
+    def _close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
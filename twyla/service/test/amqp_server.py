@@ -0,0 +1,203 @@
+"""
+Serves the in-memory broker of twyla.service.memory over AMQP 0-9-1, so the
+network transports can be tested without RabbitMQ. Frames are encoded and
+decoded with pamqp, independently of twyla.service.amqp.
+
+    server = await amqp_server.serve()
+    port = server.sockets[0].getsockname()[1]
+"""
+import asyncio
+
+from aioamqp.exceptions import ChannelClosed
+from aioamqp.properties import Properties, from_pamqp
+from pamqp import body, commands, frame, header
+from pamqp.exceptions import UnmarshalingException
+
+import twyla.service.memory as memory
+
+FRAME_MAX = 4096
+
+
+class ServerProtocol(asyncio.Protocol):
+
+    def __init__(self, broker):
+        self.connection = memory.Protocol(broker)
+        self.transport = None
+        self.data = bytearray()
+        self.frames = asyncio.Queue()
+        self.worker = None
+        # channel id -> memory channel
+        self.channels = {}
+        # channel id -> [basic.publish, properties, body size, body]
+        self.content = {}
+        self.frame_max = FRAME_MAX
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.worker = asyncio.ensure_future(self.work())
+
+    def connection_lost(self, exc):
+        self.worker.cancel()
+        asyncio.ensure_future(self.connection.close())
+
+    def data_received(self, data):
+        self.data.extend(data)
+        while self.data:
+            try:
+                consumed, channel_id, value = frame.unmarshal(
+                    bytes(self.data))
+            except UnmarshalingException:
+                return
+            del self.data[:consumed]
+            self.frames.put_nowait((channel_id, value))
+
+    def send(self, channel_id, value):
+        if not self.transport.is_closing():
+            self.transport.write(frame.marshal(value, channel_id))
+
+    async def work(self):
+        while True:
+            channel_id, value = await self.frames.get()
+            if channel_id == 0:
+                self.handle_connection(value)
+                continue
+            try:
+                await self.handle_channel(channel_id, value)
+            except ChannelClosed as err:
+                # The memory channel closed itself
+                self.channels.pop(channel_id, None)
+                self.send(channel_id, commands.Channel.Close(
+                    reply_code=err.code, reply_text=err.message,
+                    class_id=0, method_id=0))
+
+    def handle_connection(self, value):
+        if value.name == 'ProtocolHeader':
+            self.send(0, commands.Connection.Start(server_properties={
+                'product': 'twyla.service.memory',
+                'capabilities': {'publisher_confirms': True,
+                                 'basic.nack': True,
+                                 'consumer_cancel_notify': True}}))
+        elif isinstance(value, commands.Connection.StartOk):
+            self.send(0, commands.Connection.Tune(
+                channel_max=2047, frame_max=FRAME_MAX, heartbeat=0))
+        elif isinstance(value, commands.Connection.TuneOk):
+            self.frame_max = value.frame_max or FRAME_MAX
+        elif isinstance(value, commands.Connection.Open):
+            self.send(0, commands.Connection.OpenOk())
+        elif isinstance(value, commands.Connection.Close):
+            self.send(0, commands.Connection.CloseOk())
+            self.transport.close()
+
+    async def handle_channel(self, channel_id, value):
+        # pylint: disable-msg=too-many-branches
+        if isinstance(value, commands.Channel.Open):
+            self.channels[channel_id] = await self.connection.channel()
+            self.send(channel_id, commands.Channel.OpenOk())
+            return
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            return
+        if isinstance(value, commands.Basic.Publish):
+            self.content[channel_id] = [value, None, 0, bytearray()]
+        elif isinstance(value, header.ContentHeader):
+            content = self.content[channel_id]
+            content[1] = message_properties(value.properties)
+            content[2] = value.body_size
+            if value.body_size == 0:
+                await self.publish(channel, channel_id)
+        elif isinstance(value, body.ContentBody):
+            content = self.content[channel_id]
+            content[3].extend(value.value)
+            if len(content[3]) >= content[2]:
+                await self.publish(channel, channel_id)
+        elif isinstance(value, commands.Basic.Ack):
+            await channel.basic_client_ack(value.delivery_tag, value.multiple)
+        elif isinstance(value, commands.Basic.Reject):
+            await channel.basic_reject(value.delivery_tag, value.requeue)
+        elif isinstance(value, commands.Exchange.Declare):
+            await channel.exchange_declare(value.exchange, value.exchange_type,
+                                           passive=value.passive)
+            self.reply(channel_id, value, commands.Exchange.DeclareOk())
+        elif isinstance(value, commands.Queue.Declare):
+            result = await channel.queue_declare(value.queue,
+                                                 passive=value.passive)
+            self.reply(channel_id, value,
+                       commands.Queue.DeclareOk(**result))
+        elif isinstance(value, commands.Queue.Bind):
+            await channel.queue_bind(value.queue, value.exchange,
+                                     value.routing_key)
+            self.reply(channel_id, value, commands.Queue.BindOk())
+        elif isinstance(value, commands.Basic.Qos):
+            await channel.basic_qos(prefetch_count=value.prefetch_count)
+            self.send(channel_id, commands.Basic.QosOk())
+        elif isinstance(value, commands.Basic.Consume):
+            result = await channel.basic_consume(
+                self.deliver(channel_id), queue_name=value.queue,
+                consumer_tag=value.consumer_tag, no_ack=value.no_ack)
+            self.reply(channel_id, value, commands.Basic.ConsumeOk(
+                consumer_tag=result['consumer_tag']))
+        elif isinstance(value, commands.Basic.Cancel):
+            await channel.basic_cancel(value.consumer_tag)
+            self.reply(channel_id, value, commands.Basic.CancelOk(
+                consumer_tag=value.consumer_tag))
+        elif isinstance(value, commands.Confirm.Select):
+            await channel.confirm_select()
+            channel.publisher_confirms = False
+            channel.basic_server_ack = self.confirm(channel_id)
+            self.reply(channel_id, value, commands.Confirm.SelectOk())
+        elif isinstance(value, commands.Channel.Close):
+            await channel.close()
+            del self.channels[channel_id]
+            self.send(channel_id, commands.Channel.CloseOk())
+
+    def reply(self, channel_id, method, reply):
+        if not getattr(method, 'nowait', False):
+            self.send(channel_id, reply)
+
+    async def publish(self, channel, channel_id):
+        method, properties, _, payload = self.content.pop(channel_id)
+        await channel.publish(bytes(payload), method.exchange,
+                              method.routing_key, properties=properties)
+
+    def confirm(self, channel_id):
+        async def basic_server_ack(frame_value):
+            self.send(channel_id, commands.Basic.Ack(
+                frame_value.delivery_tag, frame_value.multiple))
+        return basic_server_ack
+
+    def deliver(self, channel_id):
+        async def callback(channel, payload, envelope, properties):
+            self.send(channel_id, commands.Basic.Deliver(
+                consumer_tag=envelope.consumer_tag,
+                delivery_tag=envelope.delivery_tag,
+                redelivered=envelope.is_redeliver,
+                exchange=envelope.exchange_name,
+                routing_key=envelope.routing_key))
+            self.send(channel_id, header.ContentHeader(
+                body_size=len(payload),
+                properties=commands.Basic.Properties(
+                    **message_properties(properties))))
+            chunk_size = self.frame_max - 8
+            for start in range(0, len(payload), chunk_size):
+                self.send(channel_id, body.ContentBody(
+                    payload[start:start + chunk_size]))
+        return callback
+
+
+def message_properties(properties):
+    """The set properties of pamqp or aioamqp properties as a dict"""
+    if not isinstance(properties, Properties):
+        properties = from_pamqp(properties)
+    values = {}
+    for name in Properties.__slots__:
+        value = getattr(properties, name)
+        if value is not None and value != '':
+            values[name] = value
+    return values
+
+
+async def serve(broker=None, host='127.0.0.1', port=0):
+    """Start serving broker (the one of the default virtual host if None)"""
+    broker = broker or memory.get_broker()
+    return await asyncio.get_event_loop().create_server(
+        lambda: ServerProtocol(broker), host, port)
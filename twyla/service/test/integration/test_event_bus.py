@@ -161,3 +161,18 @@ class TestQueues(unittest.TestCase):
         assert loop.remove_signal_handler(signal.SIGINT)
         assert loop.remove_signal_handler(signal.SIGTERM)
         assert len(received) == 1
+
+
+class TestQueuesAmqpTransport(TestQueues):
+    """The same tests with the client of twyla.service.amqp"""
+
+    def setUp(self):
+        super().setUp()
+        self.transport_patcher = mock.patch.dict(
+            os.environ, {'TWYLA_TRANSPORT': 'amqp'})
+        self.transport_patcher.start()
+
+
+    def tearDown(self):
+        self.transport_patcher.stop()
+        super().tearDown()
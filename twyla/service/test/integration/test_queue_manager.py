@@ -72,3 +72,18 @@ class TestQueues(unittest.TestCase):
         loop.run_until_complete(doit())
         exchanges = self.rabbit.exchanges()
         assert 'emit-domain' in [x['name'] for x in exchanges]
+
+
+class TestQueuesAmqpTransport(TestQueues):
+    """The same tests with the client of twyla.service.amqp"""
+
+    def setUp(self):
+        super().setUp()
+        self.transport_patcher = mock.patch.dict(
+            os.environ, {'TWYLA_TRANSPORT': 'amqp'})
+        self.transport_patcher.start()
+
+
+    def tearDown(self):
+        self.transport_patcher.stop()
+        super().tearDown()
@@ -0,0 +1,166 @@
+import asyncio
+import datetime
+import unittest
+import unittest.mock as mock
+
+from pamqp import body, commands, frame, header
+
+from twyla.service import amqp
+from twyla.service.test import helpers
+
+
+def unmarshal_all(data):
+    data = bytes(data)
+    frames = []
+    while data:
+        consumed, channel_id, value = frame.unmarshal(data)
+        frames.append((channel_id, value))
+        data = data[consumed:]
+    return frames
+
+
+def feed(protocol, data, step):
+    # Hands data to the protocol like a transport, at most step bytes at once
+    position = 0
+    while position < len(data):
+        buffer = protocol.get_buffer(-1)
+        size = min(step, len(buffer), len(data) - position)
+        buffer[:size] = data[position:position + size]
+        protocol.buffer_updated(size)
+        position += size
+
+
+class FrameEncoderTests(unittest.TestCase):
+
+    def test_publish_decodes_with_pamqp(self):
+        encoder = amqp.FrameEncoder(size=64)
+        timestamp = datetime.datetime(2020, 1, 2, 3, 4, 5,
+                                      tzinfo=datetime.timezone.utc)
+        payload = bytes(range(256)) * 3
+        properties = {'message_type': 'a-domain.an-event',
+                      'content_type': 'application/json',
+                      'headers': {'session': 'a-session', 'version': 2},
+                      'timestamp': timestamp,
+                      'delivery_mode': 2}
+        data = encoder.encode_publish(3, 'a-domain', 'an-event', payload,
+                                      properties, frame_max=200)
+        frames = unmarshal_all(data)
+        assert {channel_id for channel_id, _ in frames} == {3}
+        method, content_header = frames[0][1], frames[1][1]
+        assert isinstance(method, commands.Basic.Publish)
+        assert method.exchange == 'a-domain'
+        assert method.routing_key == 'an-event'
+        assert content_header.body_size == len(payload)
+        decoded = content_header.properties
+        assert decoded.message_type == 'a-domain.an-event'
+        assert decoded.content_type == 'application/json'
+        assert decoded.headers == {'session': 'a-session', 'version': 2}
+        assert decoded.timestamp == timestamp
+        assert decoded.delivery_mode == 2
+        chunks = [value.value for _, value in frames[2:]]
+        assert max(len(chunk) for chunk in chunks) == 200 - 8
+        assert b''.join(chunks) == payload
+
+    def test_buffer_is_reused_until_released(self):
+        encoder = amqp.FrameEncoder(size=1024)
+        first = encoder.encode_publish(1, 'a', 'b', b'1', None, 4096)
+        buffer = encoder.buffer
+        second = encoder.encode_publish(1, 'a', 'b', b'2', None, 4096)
+        assert encoder.buffer is buffer
+        encoder.release()
+        third = encoder.encode_publish(1, 'a', 'b', b'3', None, 4096)
+        assert encoder.buffer is not buffer
+        assert len(encoder.buffer) < 1024
+        # The second message was written over the first
+        assert bytes(first) == bytes(second)
+        assert unmarshal_all(third)[2][1].value == b'3'
+
+
+class ProtocolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.protocol = amqp.Protocol('guest', 'guest', '/', 0, self.loop,
+                                      buffer_size=64)
+        self.protocol.transport = mock.Mock()
+        self.received = []
+
+        async def callback(channel, payload, envelope, properties):
+            self.received.append((payload, envelope, properties))
+        self.channel = amqp.Channel(self.protocol, 1)
+        self.channel.is_open = True
+        self.channel.consumers['a-consumer'] = callback
+        self.protocol.channels[1] = self.channel
+
+    def deliver(self, delivery_tag, payload, frame_max=100,
+                consumer_tag='a-consumer', **properties):
+        frames = [
+            commands.Basic.Deliver(consumer_tag=consumer_tag,
+                                   delivery_tag=delivery_tag,
+                                   redelivered=True, exchange='a-domain',
+                                   routing_key='an-event'),
+            header.ContentHeader(body_size=len(payload),
+                                 properties=commands.Basic.Properties(
+                                     **properties))]
+        for start in range(0, len(payload), frame_max - 8):
+            frames.append(body.ContentBody(
+                payload[start:start + frame_max - 8]))
+        return b''.join(frame.marshal(value, 1) for value in frames)
+
+    def test_deliveries_in_pieces(self):
+        data = self.deliver(1, b'{"a": 1}', message_type='a-domain.an-event',
+                            headers={'version': 2})
+        data += frame.marshal(commands.Basic.Ack(delivery_tag=7), 1)
+        data += self.deliver(2, b'x' * 1000, content_type='text/plain')
+        data += self.deliver(3, b'')
+        self.channel.basic_server_ack = mock.Mock(
+            side_effect=lambda frame: asyncio.sleep(0))
+        for step in (3, 50, 4096):
+            self.received.clear()
+            feed(self.protocol, data, step)
+            helpers.aio_run(asyncio.sleep(0.01))
+            assert [payload for payload, *_ in self.received] == \
+                [b'{"a": 1}', b'x' * 1000, b'']
+            payload, envelope, properties = self.received[0]
+            assert isinstance(payload, bytes)
+            assert envelope.delivery_tag == 1
+            assert envelope.is_redeliver
+            assert envelope.routing_key == 'an-event'
+            assert properties.message_type == 'a-domain.an-event'
+            assert properties.headers == {'version': 2}
+            assert self.received[1][2].content_type == 'text/plain'
+        ack_frame = self.channel.basic_server_ack.call_args[0][0]
+        assert ack_frame.delivery_tag == 7
+        assert not ack_frame.multiple
+        assert self.protocol.start == self.protocol.end == 0
+
+    def test_deliveries_in_the_read_of_consume_ok(self):
+        async def callback(channel, payload, envelope, properties):
+            self.received.append(envelope.delivery_tag)
+
+        async def doit():
+            consuming = asyncio.ensure_future(self.channel.basic_consume(
+                callback, queue_name='a-queue'))
+            await asyncio.sleep(0)
+            consume = unmarshal_all(
+                self.protocol.transport.write.call_args[0][0])[0][1]
+            data = frame.marshal(commands.Basic.ConsumeOk(
+                consumer_tag=consume.consumer_tag), 1)
+            data += self.deliver(1, b'{}',
+                                 consumer_tag=consume.consumer_tag)
+            feed(self.protocol, data, 4096)
+            await consuming
+            await asyncio.sleep(0.01)
+        helpers.aio_run(doit())
+        assert self.received == [1]
+
+    def test_acks_and_rejects(self):
+        helpers.aio_run(self.channel.basic_client_ack(5, multiple=True))
+        helpers.aio_run(self.channel.basic_reject(6, requeue=True))
+        written = b''.join(call[0][0] for call in
+                           self.protocol.transport.write.call_args_list)
+        (_, ack), (_, reject) = unmarshal_all(written)
+        assert isinstance(ack, commands.Basic.Ack)
+        assert (ack.delivery_tag, ack.multiple) == (5, True)
+        assert isinstance(reject, commands.Basic.Reject)
+        assert (reject.delivery_tag, reject.requeue) == (6, True)
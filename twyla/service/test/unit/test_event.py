@@ -1,18 +1,28 @@
+import asyncio
+import concurrent.futures
 import json
+import multiprocessing
+import pickle
 import unittest
 import unittest.mock as mock
+import uuid
+from datetime import datetime, timezone
 from types import SimpleNamespace as Bunch
 
+import jsonschema
 import pydantic
 import pytest
 
 from twyla.service import event as event_module
-from twyla.service.event import (Event,
+from twyla.service.event import (AckCoalescer,
+                                 Event,
                                  EventPayload,
                                  Meta,
                                  set_schemata,
                                  get_schemata,
+                                 peek_event_name,
                                  split_event_name)
+from twyla.service import serialization, telemetry
 import twyla.service.test.helpers as helpers
 import twyla.service.test.common as common
 
@@ -44,9 +54,13 @@ class MockChannel:
         self.acked = []
         self.rejected = []
         self.dropoped = []
+        self.multiple_acked = []
 
-    async def basic_client_ack(self, delivery_tag):
-        self.acked.append(delivery_tag)
+    async def basic_client_ack(self, delivery_tag, multiple=False):
+        if multiple:
+            self.multiple_acked.append(delivery_tag)
+        else:
+            self.acked.append(delivery_tag)
 
     async def basic_reject(self, delivery_tag, requeue):
         self.rejected.append((delivery_tag, requeue))
@@ -96,6 +110,39 @@ class PayloadTest(unittest.TestCase):
         assert context_schema == self.context_schema
 
 
+    def test_set_schemata_compiles_validators(self):
+        set_schemata(self.content_schema_set, self.context_schema)
+        content_validators, context_validator = event_module.get_validators()
+        assert set(content_validators) == set(self.content_schema_set)
+        assert callable(context_validator)
+        # The validators are reused between validations
+        EventPayload.from_json(EVENT_PAYLOAD)
+        assert event_module.get_validators()[0] is content_validators
+
+
+    def test_validation_error_with_compiled_validators(self):
+        set_schemata(self.content_schema_set, self.context_schema)
+        payload = json.loads(EVENT_PAYLOAD)
+        payload['content']['name'] = 42
+        with pytest.raises(jsonschema.ValidationError):
+            EventPayload.from_json(json.dumps(payload))
+
+
+    def test_invalid_schema_raises_on_validation(self):
+        set_schemata({'a-domain.an-event': {'type': 'no-such-type'}},
+                     self.context_schema)
+        with pytest.raises(jsonschema.SchemaError):
+            EventPayload.from_json(EVENT_PAYLOAD)
+
+
+    def test_set_schemata_fast_falls_back_without_backend(self):
+        with mock.patch.object(event_module, 'fastjsonschema', None):
+            set_schemata(self.content_schema_set, self.context_schema,
+                         fast=True)
+            payload = EventPayload.from_json(EVENT_PAYLOAD)
+        assert payload.event_name == 'a-domain.an-event'
+
+
     def test_payload_from_json(self):
         set_schemata(self.content_schema_set, self.context_schema)
         payload = EventPayload.from_json(EVENT_PAYLOAD)
@@ -179,6 +226,24 @@ class EventTests(unittest.TestCase):
         assert mock_channel.rejected[0] == (12345, False)
 
 
+    def test_event_telemetry(self):
+        t = telemetry.Telemetry()
+        sent = []
+        for tick in ('ack', 'reject', 'drop'):
+            t.register_ticker(lambda name, value: sent.append(name), tick)
+        t.register_duration(lambda name, value: sent.append(name), 'validate')
+        event = Event(channel=MockChannel(),
+                      body=EVENT_PAYLOAD,
+                      envelope=Bunch(delivery_tag=12345),
+                      telemetry=t)
+        event.validate()
+        helpers.aio_run(event.ack())
+        helpers.aio_run(event.reject())
+        helpers.aio_run(event.drop())
+        assert sent == ['telemetry.validate', 'telemetry.ack',
+                        'telemetry.reject', 'telemetry.drop']
+
+
     def test_event_class_bad_body(self):
         event = Event(channel=helpers.AsyncMock(),
                       body=INVALID_PAYLOAD,
@@ -186,3 +251,253 @@ class EventTests(unittest.TestCase):
 
         with pytest.raises(pydantic.ValidationError):
             helpers.aio_run(event.validate())
+
+
+    def test_payload_is_decoded_on_access(self):
+        event = Event(channel=None,
+                      body=EVENT_PAYLOAD.encode(),
+                      envelope=Bunch(delivery_tag=1))
+        assert event._payload is None
+        assert event.content['name'] == 'test-name'
+        assert isinstance(event.payload, EventPayload)
+        assert event.context['channel'] == 'test-channel'
+
+
+    def test_event_name_from_properties(self):
+        event = Event(channel=None,
+                      body=INVALID_PAYLOAD,
+                      envelope=Bunch(delivery_tag=1),
+                      properties=Bunch(message_type='a-domain.an-event'))
+        assert event.event_name == 'a-domain.an-event'
+        assert event.domain == 'a-domain'
+        assert event.event_type == 'an-event'
+        # The body was not touched
+        assert event._payload is None
+
+
+    def test_metadata_from_properties(self):
+        session_id = uuid.uuid4()
+        timestamp = datetime.now(timezone.utc)
+        event = Event(channel=None,
+                      body=INVALID_PAYLOAD,
+                      envelope=Bunch(delivery_tag=1),
+                      properties=Bunch(
+                          message_type='a-domain.an-event',
+                          message_id='a-message', timestamp=timestamp,
+                          headers={'schema_version': 2,
+                                   'session_id': str(session_id)}))
+        assert event.message_id == 'a-message'
+        assert event.timestamp == timestamp
+        assert event.schema_version == 2
+        assert event.session_id == session_id
+        assert event.header('missing', 'default') == 'default'
+        assert event._payload is None
+
+
+    def test_metadata_from_payload(self):
+        payload = EventPayload.from_json(EVENT_PAYLOAD)
+        event = Event(channel=None, body=EVENT_PAYLOAD.encode(),
+                      envelope=Bunch(delivery_tag=1),
+                      properties=Bunch(message_id=None, timestamp=None,
+                                       headers=None))
+        assert event.message_id is None
+        assert event.timestamp == payload.meta.timestamp
+        assert event.schema_version == payload.meta.version
+        assert event.session_id == payload.meta.session_id
+
+
+    def test_event_name_from_envelope(self):
+        event = Event(channel=None,
+                      body=INVALID_PAYLOAD,
+                      envelope=Bunch(delivery_tag=1,
+                                     exchange_name='a-domain',
+                                     routing_key='an-event'),
+                      properties=Bunch(message_type=None))
+        assert event.event_name == 'a-domain.an-event'
+        assert event._payload is None
+
+
+    def test_event_name_from_body_prefix(self):
+        body = memoryview(EVENT_PAYLOAD.encode())
+        event = Event(channel=None, body=body,
+                      envelope=Bunch(delivery_tag=1))
+        assert event.event_name == 'a-domain.an-event'
+        assert event._payload is None
+        event.validate()
+        assert event.payload.content['name'] == 'test-name'
+
+
+    def test_peek_event_name(self):
+        assert peek_event_name(EVENT_PAYLOAD) == 'a-domain.an-event'
+        assert peek_event_name(EVENT_PAYLOAD.encode()) == 'a-domain.an-event'
+        assert peek_event_name('{"content": {}, "event_name": "a.b"}') is None
+        assert peek_event_name({}) is None
+
+
+    def test_event_name_falls_back_to_decoding(self):
+        body = json.dumps({'content': json.loads(EVENT_PAYLOAD)['content'],
+                           'context': json.loads(EVENT_PAYLOAD)['context'],
+                           'event_name': 'a-domain.an-event'})
+        event = Event(channel=None, body=body,
+                      envelope=Bunch(delivery_tag=1))
+        assert event.event_name == 'a-domain.an-event'
+        assert event._payload is not None
+
+
+    @pytest.mark.skipif(serialization.msgpack is None,
+                        reason='msgpack is not installed')
+    def test_msgpack_roundtrip(self):
+        payload = EventPayload.from_json(EVENT_PAYLOAD)
+        body = payload.encode(serialization.MSGPACK)
+        event = Event(channel=None, body=body,
+                      envelope=Bunch(delivery_tag=1),
+                      properties=Bunch(message_type=None,
+                                       content_type=serialization.MSGPACK))
+        assert event.payload.content == payload.content
+        assert event.payload.meta.session_id == payload.meta.session_id
+        assert event.payload.meta.timestamp == payload.meta.timestamp
+        assert event.event_name == 'a-domain.an-event'
+
+
+    def test_other_content_types_are_json(self):
+        for content_type in ('application/json; charset=utf-8',
+                             'Application/JSON', 'text/plain', 'text/csv'):
+            event = Event(channel=None, body=EVENT_PAYLOAD.encode(),
+                          envelope=Bunch(delivery_tag=1),
+                          properties=Bunch(message_type=None,
+                                           content_type=content_type))
+            assert event.payload.content['name'] == 'test-name'
+        assert serialization.payload_content_type(
+            'application/msgpack; x=y') == serialization.MSGPACK
+
+
+    def test_compressed_body(self):
+        for encoding in serialization.available_content_encodings():
+            body = serialization.compress(EVENT_PAYLOAD.encode(), encoding)
+            event = Event(channel=None, body=body,
+                          envelope=Bunch(delivery_tag=1),
+                          properties=Bunch(message_type=None,
+                                           content_type='application/json',
+                                           content_encoding=encoding))
+            assert event.payload.content['name'] == 'test-name'
+
+
+    def test_other_content_encodings_are_not_decompressed(self):
+        for encoding in ('utf-8', 'identity'):
+            event = Event(channel=None, body=EVENT_PAYLOAD.encode(),
+                          envelope=Bunch(delivery_tag=1),
+                          properties=Bunch(message_type=None,
+                                           content_type='application/json',
+                                           content_encoding=encoding))
+            assert event.payload.content['name'] == 'test-name'
+
+
+    def test_validate_async_in_executors(self):
+        executors = [
+            concurrent.futures.ThreadPoolExecutor(1),
+            concurrent.futures.ProcessPoolExecutor(
+                1, mp_context=multiprocessing.get_context('fork')),
+        ]
+        for executor in executors:
+            with executor:
+                event = Event(channel=None,
+                              body=memoryview(EVENT_PAYLOAD.encode()),
+                              envelope=Bunch(delivery_tag=1),
+                              executor=executor)
+                helpers.aio_run(event.validate_async())
+                assert event._payload.content['name'] == 'test-name'
+                assert event.event_name == 'a-domain.an-event'
+
+
+    def test_validate_async_without_executor(self):
+        event = Event(channel=None, body=EVENT_PAYLOAD,
+                      envelope=Bunch(delivery_tag=1))
+        helpers.aio_run(event.validate_async())
+        assert event._payload is not None
+
+
+    def test_pickled_event_has_no_channel(self):
+        event = Event(channel=MockChannel(),
+                      body=memoryview(EVENT_PAYLOAD.encode()),
+                      envelope=Bunch(delivery_tag=1),
+                      telemetry=telemetry.Telemetry())
+        copy = pickle.loads(pickle.dumps(event))
+        assert copy.channel is None
+        assert copy.telemetry is None
+        assert copy.content['name'] == 'test-name'
+        helpers.aio_run(copy.ack())
+        assert event.channel.acked == []
+
+
+class AckCoalescerTests(unittest.TestCase):
+
+    def test_contiguous_acks_are_sent_as_one(self):
+        channel = MockChannel()
+        acks = AckCoalescer(channel, max_count=3, max_delay=10)
+        for tag in (1, 2, 3):
+            acks.delivered(tag)
+
+        async def go():
+            for tag in (1, 2, 3):
+                await acks.ack(tag)
+        helpers.aio_run(go())
+
+        assert channel.multiple_acked == [3]
+        assert channel.acked == []
+        assert not acks.unsettled
+
+
+    def test_acks_above_a_gap_are_sent_singly(self):
+        channel = MockChannel()
+        acks = AckCoalescer(channel, max_count=2, max_delay=10)
+        for tag in (1, 2, 3):
+            acks.delivered(tag)
+
+        async def go():
+            await acks.ack(1)
+            await acks.ack(3)
+        helpers.aio_run(go())
+
+        assert channel.multiple_acked == [1]
+        assert channel.acked == [3]
+        assert list(acks.unsettled) == [2]
+
+
+    def test_rejects_are_not_covered(self):
+        channel = MockChannel()
+        acks = AckCoalescer(channel, max_count=10, max_delay=10)
+        for tag in (1, 2, 3):
+            acks.delivered(tag)
+
+        async def go():
+            await acks.ack(1)
+            await acks.reject(2, requeue=True)
+            await acks.ack(3)
+            await acks.flush()
+        helpers.aio_run(go())
+
+        assert channel.rejected == [(2, True)]
+        assert channel.multiple_acked == [3]
+
+
+    def test_acks_are_flushed_after_delay(self):
+        channel = MockChannel()
+        acks = AckCoalescer(channel, max_count=10, max_delay=0.01)
+        acks.delivered(1)
+
+        async def go():
+            await acks.ack(1)
+            await asyncio.sleep(0.05)
+        helpers.aio_run(go())
+
+        assert channel.multiple_acked == [1]
+
+
+    def test_event_acks_through_coalescer(self):
+        channel = MockChannel()
+        acks = AckCoalescer(channel, max_count=1, max_delay=10)
+        acks.delivered(7)
+        event = Event(channel=channel, body=EVENT_PAYLOAD,
+                      envelope=Bunch(delivery_tag=7), acks=acks)
+        helpers.aio_run(event.ack())
+        assert channel.multiple_acked == [7]
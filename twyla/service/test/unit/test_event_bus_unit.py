@@ -1,22 +1,71 @@
 import asyncio
+import concurrent.futures
+import os
+import threading
 import unittest
 import unittest.mock as mock
+import zlib
+from types import SimpleNamespace as Bunch
 
 from twyla.service.test import helpers
-from twyla.service import event_bus
+from twyla.service import event_bus, telemetry
+from twyla.service.event import Meta
 
 
 class QueueMock:
 
     def __init__(self):
         self.listeners = []
+        self.emitted = []
         self.connected = False
+        self.reconnects = 0
+        self.resumed = False
+        self.resume_failures = 0
+        self.closed_event = asyncio.Event()
 
     async def connect(self):
         self.connected = True
 
-    async def listen(self, event_name, event_group, callback):
-        self.listeners.append((event_name, event_group, callback))
+    async def reconnect(self):
+        self.reconnects += 1
+        if self.reconnects == 1:
+            raise ConnectionError('broker still down')
+        self.closed_event.clear()
+
+    async def resume(self):
+        if self.resume_failures:
+            self.resume_failures -= 1
+            raise ConnectionError('publishing failed')
+        self.resumed = True
+
+    async def listen(self, event_name, event_group, callback,
+                     prefetch_count=None):
+        self.listeners.append(
+            (event_name, event_group, callback, prefetch_count))
+
+    async def listen_many(self, event_names, queue_name, callback,
+                          prefetch_count=None):
+        self.listeners.append(
+            (event_names, queue_name, callback, prefetch_count))
+
+    async def emit(self, event_name, payload, properties=None):
+        self.emitted.append((event_name, payload, properties))
+
+    async def emit_many(self, messages):
+        self.emitted.extend(messages)
+
+
+class AckChannel:
+
+    def __init__(self):
+        self.acked = []
+        self.rejected = []
+
+    async def basic_client_ack(self, delivery_tag, multiple=False):
+        self.acked.append((delivery_tag, multiple))
+
+    async def basic_reject(self, delivery_tag, requeue):
+        self.rejected.append((delivery_tag, requeue))
 
 
 class EventsTests(unittest.TestCase):
@@ -39,6 +88,403 @@ class EventsTests(unittest.TestCase):
         assert passed_event.channel is channel
         assert passed_event.envelope is envelope
 
+    def test_message_to_event_adapter_bounded_concurrency(self):
+        running = 0
+        max_running = 0
+        done = []
+
+        async def msg_callback(event):
+            nonlocal running, max_running
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+            done.append(event)
+        adapter = event_bus.MessageToEventAdapter(msg_callback,
+                                                  max_concurrency=2)
+
+        async def doit():
+            for _ in range(5):
+                await adapter(object(), {}, object(), None)
+            # Deliveries are handed off without waiting for a free slot
+            assert len(adapter.tasks) == 5
+            await adapter.join()
+        helpers.aio_run(doit())
+        assert len(done) == 5
+        assert max_running == 2
+        assert not adapter.tasks
+
+
+    def test_message_to_event_adapter_close_and_join(self):
+        release = None
+        handled = []
+
+        async def msg_callback(event):
+            await release.wait()
+            handled.append(event.envelope.delivery_tag)
+        channel = AckChannel()
+        adapter = event_bus.MessageToEventAdapter(msg_callback)
+
+        async def doit():
+            nonlocal release
+            release = asyncio.Event()
+            # Handled inline, like aioamqp calls it from its reader
+            running = asyncio.ensure_future(
+                adapter(channel, {}, Bunch(delivery_tag=1), None))
+            await asyncio.sleep(0)
+            adapter.close()
+            await adapter(channel, {}, Bunch(delivery_tag=2), None)
+            joined = asyncio.ensure_future(adapter.join())
+            await asyncio.sleep(0.01)
+            assert not joined.done()
+            release.set()
+            await joined
+            await running
+        helpers.aio_run(doit())
+        # The delivery after closing is left for the broker to redeliver
+        assert handled == [1]
+        assert channel.acked == channel.rejected == []
+
+
+    @mock.patch.dict(os.environ, {'TWYLA_STOP_TIMEOUT': '0.01'})
+    @mock.patch('twyla.service.event_bus.queues')
+    def test_join_adapters_times_out(self, mock_queues):
+        mock_queues.QueueManager.return_value = QueueMock()
+        bus = event_bus.EventBus('TWYLA_')
+
+        async def msg_callback(event):
+            await asyncio.sleep(1)
+        adapter = event_bus.MessageToEventAdapter(msg_callback)
+        bus.adapters = [adapter]
+
+        async def doit():
+            running = asyncio.ensure_future(
+                adapter(object(), {}, object(), None))
+            await asyncio.sleep(0)
+            with self.assertLogs('twyla.service.event_bus', 'WARNING'):
+                await bus.join_adapters()
+            running.cancel()
+        helpers.aio_run(doit())
+
+
+    def test_message_to_event_adapter_telemetry(self):
+        t = telemetry.Telemetry()
+        sent = []
+        t.register_ticker(lambda name, value: sent.append(name), 'received')
+        t.register_gauge(lambda name, value: sent.append((name, value)),
+                         'in_flight')
+        t.register_duration(lambda name, value: sent.append(name), 'handler')
+        passed_event = None
+
+        async def msg_callback(event):
+            nonlocal passed_event
+            passed_event = event
+        adapter = event_bus.MessageToEventAdapter(msg_callback, telemetry=t)
+        helpers.aio_run(adapter(object(), {}, object(), None))
+        assert passed_event.telemetry is t
+        assert sent == ['telemetry.received',
+                        ('telemetry.in_flight', 1),
+                        'telemetry.handler',
+                        ('telemetry.in_flight', 0)]
+
+
+    def test_message_to_event_adapter_coalesces_acks(self):
+        acked = []
+
+        class Channel:
+            async def basic_client_ack(self, delivery_tag, multiple=False):
+                acked.append((delivery_tag, multiple))
+
+        async def msg_callback(event):
+            await event.ack()
+        adapter = event_bus.MessageToEventAdapter(msg_callback,
+                                                  ack_batch_size=10)
+        channel = Channel()
+
+        async def doit():
+            for tag in (1, 2, 3):
+                await adapter(channel, {}, mock.Mock(delivery_tag=tag), None)
+            await adapter.flush_acks()
+        helpers.aio_run(doit())
+        assert acked == [(3, True)]
+
+
+    def test_batch_adapter_full_batch(self):
+        batches = []
+
+        async def callback(events):
+            batches.append([event.envelope.delivery_tag for event in events])
+        adapter = event_bus.MessagesToBatchAdapter(callback, max_size=3,
+                                                   max_wait=10)
+        channel = AckChannel()
+
+        async def doit():
+            for tag in range(1, 7):
+                await adapter(channel, {}, mock.Mock(delivery_tag=tag), None)
+        helpers.aio_run(doit())
+        assert batches == [[1, 2, 3], [4, 5, 6]]
+        assert channel.acked == [(3, True), (6, True)]
+        assert adapter.timer is None
+
+
+    def test_batch_adapter_max_wait(self):
+        batches = []
+
+        async def callback(events):
+            batches.append(len(events))
+        adapter = event_bus.MessagesToBatchAdapter(callback, max_size=10,
+                                                   max_wait=0.01)
+        channel = AckChannel()
+
+        async def doit():
+            await adapter(channel, {}, mock.Mock(delivery_tag=1), None)
+            await adapter(channel, {}, mock.Mock(delivery_tag=2), None)
+            await asyncio.sleep(0.05)
+            await adapter.join()
+        helpers.aio_run(doit())
+        assert batches == [2]
+        assert channel.acked == [(2, True)]
+
+
+    def test_batch_adapter_settles_per_event(self):
+        async def callback(events):
+            await events[1].drop()
+        adapter = event_bus.MessagesToBatchAdapter(callback, max_size=3,
+                                                   max_wait=10)
+        channel = AckChannel()
+
+        async def doit():
+            for tag in (1, 2, 3):
+                await adapter(channel, {}, mock.Mock(delivery_tag=tag), None)
+        helpers.aio_run(doit())
+        assert channel.rejected == [(2, False)]
+        # The reject went out first, so one multiple-ack covers 1 and 3
+        assert channel.acked == [(3, True)]
+
+
+    def test_batch_adapter_rejects_on_error(self):
+        async def callback(events):
+            raise ValueError('database down')
+        adapter = event_bus.MessagesToBatchAdapter(callback, max_size=2,
+                                                   max_wait=10)
+        channel = AckChannel()
+
+        async def doit():
+            for tag in (1, 2):
+                await adapter(channel, {}, mock.Mock(delivery_tag=tag), None)
+        helpers.aio_run(doit())
+        assert channel.rejected == [(1, True), (2, True)]
+        assert channel.acked == []
+
+
+    @mock.patch('twyla.service.event_bus.queues')
+    def test_listen_batch(self, mock_queues):
+        qm = QueueMock()
+        mock_queues.QueueManager.return_value = qm
+        bus = event_bus.EventBus('TWYLA_')
+
+        async def callback(events):
+            pass
+
+        bus.listen_batch('a-domain.an-event', 'testing', callback,
+                         max_size=50, max_wait=0.5)
+        helpers.aio_run(bus.start())
+        event_name, _, adapter, prefetch_count = qm.listeners[0]
+        assert event_name == 'a-domain.an-event'
+        assert isinstance(adapter, event_bus.MessagesToBatchAdapter)
+        assert adapter.max_size == 50
+        assert prefetch_count == 50
+
+
+    def test_stream(self):
+        qm = QueueMock()
+        stream = event_bus.EventStream(qm, 'a-domain.an-event', 'testing',
+                                       prefetch_count=2)
+        received = []
+
+        async def consume():
+            async for event in stream:
+                received.append(event.envelope.delivery_tag)
+
+        async def doit():
+            consumer = asyncio.ensure_future(consume())
+            await asyncio.sleep(0)
+            assert qm.connected
+            event_name, _, deliver, prefetch_count = qm.listeners[0]
+            assert event_name == 'a-domain.an-event'
+            assert prefetch_count == 2
+            for tag in (1, 2, 3):
+                await deliver(object(), {}, mock.Mock(delivery_tag=tag), None)
+            await asyncio.sleep(0)
+            stream.close()
+            await consumer
+        helpers.aio_run(doit())
+        assert received == [1, 2, 3]
+
+
+    def test_stream_backpressure(self):
+        qm = QueueMock()
+        stream = event_bus.EventStream(qm, 'a-domain.an-event', 'testing',
+                                       prefetch_count=2)
+
+        async def doit():
+            await stream.listen()
+            deliver = qm.listeners[0][2]
+            for tag in (1, 2):
+                await deliver(object(), {}, mock.Mock(delivery_tag=tag), None)
+            blocked = asyncio.ensure_future(
+                deliver(object(), {}, mock.Mock(delivery_tag=3), None))
+            await asyncio.sleep(0.01)
+            assert not blocked.done()
+            event = await stream.__anext__()
+            assert event.envelope.delivery_tag == 1
+            await asyncio.sleep(0)
+            assert blocked.done()
+        helpers.aio_run(doit())
+
+
+    def test_stream_batches(self):
+        qm = QueueMock()
+        stream = event_bus.EventStream(qm, 'a-domain.an-event', 'testing',
+                                       prefetch_count=10)
+        batches = []
+
+        async def consume():
+            async for batch in stream.batches(max_size=3, max_wait=0.01):
+                batches.append([e.envelope.delivery_tag for e in batch])
+
+        async def doit():
+            await stream.listen()
+            deliver = qm.listeners[0][2]
+            for tag in range(1, 6):
+                await deliver(object(), {}, mock.Mock(delivery_tag=tag), None)
+            consumer = asyncio.ensure_future(consume())
+            await asyncio.sleep(0.05)
+            stream.close()
+            await consumer
+        helpers.aio_run(doit())
+        assert batches == [[1, 2, 3], [4, 5]]
+
+
+    @mock.patch('twyla.service.event_bus.queues')
+    def test_stream_registered_and_closed(self, mock_queues):
+        qm = QueueMock()
+        mock_queues.QueueManager.return_value = qm
+        bus = event_bus.EventBus('TWYLA_')
+        stream = bus.stream('a-domain.an-event', 'testing')
+        assert bus.streams == [stream]
+        stream.close()
+
+        async def doit():
+            return [event async for event in stream]
+        assert helpers.aio_run(doit()) == []
+
+
+    def test_synchronous_callback_runs_in_executor(self):
+        handled = []
+
+        def callback(event):
+            handled.append(threading.current_thread())
+            if event.envelope.delivery_tag == 2:
+                raise ValueError('bad event')
+        channel = AckChannel()
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            adapter = event_bus.MessageToEventAdapter(callback,
+                                                      executor=executor,
+                                                      synchronous=True)
+
+            async def doit():
+                await adapter(channel, {}, mock.Mock(delivery_tag=1), None)
+                with self.assertRaises(ValueError):
+                    await adapter(channel, {}, mock.Mock(delivery_tag=2),
+                                  None)
+            helpers.aio_run(doit())
+        assert threading.main_thread() not in handled
+        assert channel.acked == [(1, False)]
+        assert channel.rejected == [(2, True)]
+
+
+    def test_callable_returning_a_coroutine(self):
+        handled = []
+
+        async def handler(event, extra):
+            handled.append(extra)
+            await event.ack()
+        channel = AckChannel()
+        adapter = event_bus.MessageToEventAdapter(
+            lambda event: handler(event, 'extra'),
+            executor=concurrent.futures.ThreadPoolExecutor(1))
+        helpers.aio_run(adapter(channel, {}, Bunch(delivery_tag=1), None))
+        adapter.executor.shutdown()
+        assert handled == ['extra']
+        assert channel.acked == [(1, False)]
+
+
+    @mock.patch('twyla.service.event_bus.queues')
+    def test_listen_synchronous(self, mock_queues):
+        qm = QueueMock()
+        mock_queues.QueueManager.return_value = qm
+        bus = event_bus.EventBus('TWYLA_')
+        bus.listen('a-domain.an-event', 'testing', print, synchronous=True)
+        bus.listen('a-domain.other-event', 'testing', print)
+        helpers.aio_run(bus.start())
+        assert [adapter.synchronous for _, _, adapter, _ in qm.listeners] == \
+            [True, False]
+
+
+    def test_adapter_validates_in_executor(self):
+        validated = []
+
+        async def callback(event):
+            validated.append(event._payload is not None)
+        executor = mock.Mock()
+        adapter = event_bus.MessageToEventAdapter(callback, executor=executor)
+        assert not adapter.synchronous
+
+        async def validate_async(event):
+            event._payload = object()
+        with mock.patch.object(event_bus.Event, 'validate_async',
+                               validate_async):
+            helpers.aio_run(adapter(object(), {}, object(), None))
+        assert validated == [True]
+
+
+    @mock.patch.dict(os.environ, {'TWYLA_EXECUTOR': 'thread',
+                                  'TWYLA_EXECUTOR_WORKERS': '3'})
+    @mock.patch('twyla.service.event_bus.queues')
+    def test_executor_from_config(self, mock_queues):
+        bus = event_bus.EventBus('TWYLA_')
+        assert isinstance(bus.executor, concurrent.futures.ThreadPoolExecutor)
+        assert bus.executor._max_workers == 3
+        bus.executor.shutdown()
+        with self.assertRaises(ValueError):
+            event_bus.EventBus.create_executor('fibers')
+
+
+    @mock.patch('twyla.service.event_bus.queues')
+    def test_listen_with_prefetch_and_concurrency(self, mock_queues):
+        qm = QueueMock()
+        mock_queues.QueueManager.return_value = qm
+        bus = event_bus.EventBus('TWYLA_')
+
+        async def callback(*args, **kwargs):
+            pass
+
+        bus.listen('a-domain.an-event', 'testing', callback,
+                   prefetch_count=10, max_concurrency=4)
+        helpers.aio_run(bus.start())
+        _, _, adapter, prefetch_count = qm.listeners[0]
+        assert prefetch_count == 10
+        assert adapter.max_concurrency == 4
+
+        # The prefetch count defaults to the concurrency
+        bus.listen('a-domain.other-event', 'testing', callback,
+                   max_concurrency=4)
+        helpers.aio_run(bus.start())
+        _, _, adapter, prefetch_count = qm.listeners[-1]
+        assert prefetch_count == 4
+
+
     @mock.patch('twyla.service.event_bus.queues')
     def test_listen(self, mock_queues):
         qm = QueueMock()
@@ -58,10 +504,199 @@ class EventsTests(unittest.TestCase):
         assert isinstance(event_callback, event_bus.MessageToEventAdapter)
 
 
+    @mock.patch('twyla.service.event_bus.queues')
+    def test_emit_many(self, mock_queues):
+        qm = QueueMock()
+        mock_queues.QueueManager.return_value = qm
+        bus = event_bus.EventBus('TWYLA_')
+        meta = Meta(version=2)
+        events = [mock.Mock(event_name='a-domain.an-event', meta=meta,
+                            **{'encode.return_value': str(i)})
+                  for i in range(3)]
+        helpers.aio_run(bus.emit_many(events))
+        assert qm.connected
+        assert [(name, data) for name, data, _ in qm.emitted] == [
+            ('a-domain.an-event', '0'),
+            ('a-domain.an-event', '1'),
+            ('a-domain.an-event', '2')]
+        for event in events:
+            event.encode.assert_called_once_with('application/json')
+        # The name and metadata are stamped into the properties
+        message_ids = set()
+        for _, _, properties in qm.emitted:
+            assert properties['content_type'] == 'application/json'
+            assert properties['message_type'] == 'a-domain.an-event'
+            assert properties['headers'] == {
+                'schema_version': 2, 'session_id': str(meta.session_id)}
+            assert properties['timestamp'].tzinfo is not None
+            message_ids.add(properties['message_id'])
+        assert len(message_ids) == 3
+
+
+    @mock.patch('twyla.service.event_bus.queues')
+    def test_listen_many(self, mock_queues):
+        qm = QueueMock()
+        mock_queues.QueueManager.return_value = qm
+        bus = event_bus.EventBus('TWYLA_')
+        handled = []
+
+        async def created(event):
+            handled.append(('created', event.envelope.delivery_tag))
+
+        async def deleted(event):
+            handled.append(('deleted', event.envelope.delivery_tag))
+        bus.listen_many({'users.created': created, 'users.deleted': deleted},
+                        'a-service.audit', prefetch_count=10)
+        with self.assertRaises(AssertionError):
+            bus.listen_many({'users.created': created}, 'audit')
+        helpers.aio_run(bus.start())
+        (event_names, queue_name, adapter, prefetch_count), = qm.listeners
+        assert sorted(event_names) == ['users.created', 'users.deleted']
+        assert queue_name == 'a-service.audit'
+        assert prefetch_count == 10
+
+        channel = AckChannel()
+
+        async def deliver(delivery_tag, event_name):
+            # The body is not valid, so it must not be decoded
+            await adapter(channel, b'not json', Bunch(
+                delivery_tag=delivery_tag, exchange_name='',
+                routing_key='a-service.audit'), Bunch(message_type=event_name))
+        helpers.aio_run(deliver(1, 'users.deleted'))
+        helpers.aio_run(deliver(2, 'users.created'))
+        with self.assertLogs('twyla.service.event_bus', 'WARNING'):
+            helpers.aio_run(deliver(3, 'users.renamed'))
+        assert handled == [('deleted', 1), ('created', 2)]
+        assert channel.rejected == [(3, False)]
+
+
+    @mock.patch.dict(os.environ, {'TWYLA_COMPRESSION': 'deflate',
+                                  'TWYLA_COMPRESSION_THRESHOLD': '100'})
+    @mock.patch('twyla.service.event_bus.queues')
+    def test_emit_compression(self, mock_queues):
+        qm = QueueMock()
+        mock_queues.QueueManager.return_value = qm
+        notified = []
+        t = telemetry.Telemetry()
+        t.register(t.event.compression_ratio, notified.append)
+        bus = event_bus.EventBus('TWYLA_', telemetry=t)
+        small = mock.Mock(event_name='a-domain.an-event',
+                          **{'encode.return_value': b'x' * 99})
+        large = mock.Mock(event_name='a-domain.an-event',
+                          **{'encode.return_value': b'x' * 1000})
+        helpers.aio_run(bus.emit(small))
+        helpers.aio_run(bus.emit(large))
+
+        (_, small_data, small_props), (_, large_data, large_props) = \
+            qm.emitted
+        assert small_data == b'x' * 99
+        assert 'content_encoding' not in small_props
+        assert large_props['content_encoding'] == 'deflate'
+        assert zlib.decompress(large_data) == b'x' * 1000
+        assert len(notified) == 1
+        assert notified[0] == 1000 / len(large_data)
+
+
+    def test_backoff_delay(self):
+        for attempt in range(10):
+            delay = event_bus.backoff_delay(attempt, 0.5, 4)
+            assert 0 <= delay <= min(4, 0.5 * 2 ** attempt)
+
+
+    @mock.patch.dict(os.environ, {'TWYLA_RECONNECT': 'true',
+                                  'TWYLA_RECONNECT_MIN_DELAY': '0.001',
+                                  'TWYLA_RECONNECT_MAX_DELAY': '0.002'})
+    @mock.patch('twyla.service.event_bus.queues')
+    def test_reconnect_on_queue_disconnect(self, mock_queues):
+        qm = QueueMock()
+        mock_queues.QueueManager.return_value = qm
+        recovery_times = []
+        t = telemetry.Telemetry()
+        t.register_duration(lambda name, value: recovery_times.append(name),
+                            'reconnect')
+        bus = event_bus.EventBus('TWYLA_', telemetry=t)
+
+        async def callback(*args, **kwargs):
+            pass
+        bus.listen('a-domain.an-event', 'testing', callback)
+
+        async def doit():
+            watcher = asyncio.ensure_future(bus.stop_on_queue_disconnect())
+            qm.closed_event.set()
+            while not qm.resumed:
+                await asyncio.sleep(0.001)
+            # Stopping ends the watcher instead of reconnecting again
+            bus.run_stop_on_queue_close = False
+            qm.closed_event.set()
+            await watcher
+        helpers.aio_run(doit())
+        # The first attempt failed, the second one re-registered the listener
+        assert qm.reconnects == 2
+        assert len(qm.listeners) == 1
+        assert recovery_times == ['telemetry.reconnect']
+
+
+    @mock.patch.dict(os.environ, {'TWYLA_RECONNECT': 'true',
+                                  'TWYLA_RECONNECT_MIN_DELAY': '0.001',
+                                  'TWYLA_RECONNECT_MAX_DELAY': '0.002'})
+    @mock.patch('twyla.service.event_bus.queues')
+    def test_reconnect_retries_failed_resume(self, mock_queues):
+        qm = QueueMock()
+        qm.reconnects = 1
+        qm.resume_failures = 1
+        mock_queues.QueueManager.return_value = qm
+        bus = event_bus.EventBus('TWYLA_')
+
+        async def doit():
+            watcher = asyncio.ensure_future(bus.stop_on_queue_disconnect())
+            qm.closed_event.set()
+            while not qm.resumed:
+                await asyncio.sleep(0.001)
+            # The watcher survived the failure and still handles disconnects
+            assert not watcher.done()
+            bus.run_stop_on_queue_close = False
+            qm.closed_event.set()
+            await watcher
+        with self.assertLogs('twyla.service.event_bus', 'ERROR'):
+            helpers.aio_run(doit())
+        assert qm.reconnects == 3
+
+
+    @mock.patch('twyla.service.event_bus.queues')
+    def test_loop_policy(self, mock_queues):
+        with mock.patch.dict(os.environ, {'TWYLA_LOOP': 'asyncio'}):
+            bus = event_bus.EventBus('TWYLA_')
+        assert isinstance(bus.loop_policy(), asyncio.DefaultEventLoopPolicy)
+        with mock.patch.object(event_bus, 'uvloop', None):
+            bus = event_bus.EventBus('TWYLA_')
+            assert isinstance(bus.loop_policy(),
+                              asyncio.DefaultEventLoopPolicy)
+            with mock.patch.dict(os.environ, {'TWYLA_LOOP': 'uvloop'}):
+                with self.assertRaises(ValueError):
+                    event_bus.EventBus('TWYLA_')
+        with mock.patch.dict(os.environ, {'TWYLA_LOOP': 'trio'}):
+            with self.assertRaises(ValueError):
+                event_bus.EventBus('TWYLA_')
+
+
+    @unittest.skipIf(event_bus.uvloop is None, 'uvloop is not installed')
+    @mock.patch('twyla.service.event_bus.queues')
+    def test_uvloop_loop(self, mock_queues):
+        bus = event_bus.EventBus('TWYLA_')
+        policy = asyncio.get_event_loop_policy()
+        try:
+            loop = bus.new_event_loop()
+            assert isinstance(loop, event_bus.uvloop.Loop)
+            loop.close()
+        finally:
+            asyncio.set_event_loop_policy(policy)
+            asyncio.set_event_loop(asyncio.new_event_loop())
+
+
     @mock.patch('twyla.service.event_bus.atexit')
     @mock.patch('twyla.service.event_bus.asyncio')
     def test_main(self, mock_aio, mock_atexit):
-        loop = mock_aio.get_event_loop.return_value
+        loop = mock_aio.new_event_loop.return_value
         bus = event_bus.EventBus('TWYLA_')
         bus.main()
         assert loop.create_task.call_count == 1
@@ -72,7 +707,7 @@ class EventsTests(unittest.TestCase):
 
     @mock.patch('twyla.service.event_bus.asyncio')
     def test_main_stop_loop_on_exception(self, mock_aio):
-        loop = mock_aio.get_event_loop.return_value
+        loop = mock_aio.new_event_loop.return_value
         loop.create_task.side_effect = AssertionError()
         bus = event_bus.EventBus('TWYLA_')
         bus.main()
@@ -1,7 +1,10 @@
 import datetime
+import json
 import unittest
 import uuid
 
+import pytest
+
 import twyla.service.jsontool as jsontool
 
 
@@ -43,3 +46,55 @@ class JSONToolTest(unittest.TestCase):
         }
         expected = '{"obj": "this is a test"}'
         assert jsontool.dumps(data) == expected
+
+
+class CodecTest(unittest.TestCase):
+    def setUp(self):
+        class TestObj:
+            def __json__(self):
+                return 'this is a test'
+
+        self.data = {
+            'key': 'value',
+            'time': datetime.datetime(2018, 2, 2, 14, 16, 44, 329322),
+            'uuid': uuid.UUID('67b97d2e-b2b4-43e4-9c50-674c62d11313'),
+            'obj': TestObj(),
+        }
+        self.expected = {
+            'key': 'value',
+            'time': '2018-02-02T14:16:44.329322',
+            'uuid': '67b97d2e-b2b4-43e4-9c50-674c62d11313',
+            'obj': 'this is a test',
+        }
+
+
+    def tearDown(self):
+        jsontool.set_codec()
+
+
+    def test_codecs_roundtrip(self):
+        for name in jsontool.available_codecs():
+            jsontool.set_codec(name)
+            encoded = jsontool.encode(self.data)
+            assert isinstance(encoded, bytes)
+            assert json.loads(encoded) == self.expected
+            assert jsontool.decode(encoded) == self.expected
+            assert jsontool.decode(memoryview(encoded)) == self.expected
+
+
+    def test_stdlib_codec_is_always_available(self):
+        assert 'json' in jsontool.available_codecs()
+        with pytest.raises(ValueError):
+            jsontool.get_codec('no-such-codec')
+
+
+    def test_default_dispatch_cache(self):
+        class Unknown:
+            pass
+
+        assert jsontool.default(self.data['uuid']) == self.expected['uuid']
+        assert jsontool._dispatch_cache[uuid.UUID] is uuid.UUID.__str__
+        with pytest.raises(TypeError):
+            jsontool.default(Unknown())
+        with pytest.raises(TypeError):
+            jsontool.encode({'unknown': Unknown()})
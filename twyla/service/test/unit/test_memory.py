@@ -0,0 +1,186 @@
+import asyncio
+import os
+import unittest
+import unittest.mock as mock
+
+import pytest
+from aioamqp.exceptions import ChannelClosed
+
+from twyla.service import memory, queues
+from twyla.service.event import EventPayload, set_schemata
+from twyla.service.event_bus import EventBus
+from twyla.service.test import common, helpers
+
+
+class Recorder:
+
+    def __init__(self, ack=True):
+        self.ack = ack
+        self.received = []
+
+    async def __call__(self, channel, body, envelope, properties):
+        self.received.append((body, envelope, properties))
+        if self.ack:
+            await channel.basic_client_ack(envelope.delivery_tag)
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+async def topology(channel, exchange_type='topic', routing_key='an-event'):
+    await channel.exchange_declare('a-domain', exchange_type)
+    await channel.queue_declare('a-queue')
+    await channel.queue_bind('a-queue', 'a-domain', routing_key)
+
+
+class MemoryBrokerTests(unittest.TestCase):
+
+    def setUp(self):
+        memory.reset()
+
+    def tearDown(self):
+        memory.reset()
+
+    def test_topic_matches(self):
+        assert memory.topic_matches('an-event', 'an-event')
+        assert not memory.topic_matches('an-event', 'other-event')
+        assert memory.topic_matches('*.created', 'user.created')
+        assert not memory.topic_matches('*.created', 'user.x.created')
+        assert memory.topic_matches('user.#', 'user')
+        assert memory.topic_matches('user.#', 'user.a.b')
+        assert memory.topic_matches('#.created', 'a.b.created')
+        assert memory.topic_matches('#', 'anything.at.all')
+        assert not memory.topic_matches('user.*', 'user')
+
+    def test_routing(self):
+        recorder = Recorder()
+
+        async def doit():
+            _, protocol = await memory.connect()
+            channel = await protocol.channel()
+            await topology(channel, routing_key='user.*')
+            await channel.basic_consume(recorder, queue_name='a-queue')
+            await channel.publish(b'one', 'a-domain', 'user.created',
+                                  properties={'content_type': 'text/plain'})
+            await channel.publish(b'two', 'a-domain', 'order.created')
+            await settle()
+        helpers.aio_run(doit())
+        assert len(recorder.received) == 1
+        body, envelope, properties = recorder.received[0]
+        assert body == b'one'
+        assert envelope.exchange_name == 'a-domain'
+        assert envelope.routing_key == 'user.created'
+        assert properties.content_type == 'text/plain'
+
+    def test_prefetch_and_ack(self):
+        recorder = Recorder(ack=False)
+
+        async def doit():
+            _, protocol = await memory.connect()
+            channel = await protocol.channel()
+            await topology(channel)
+            await channel.basic_qos(prefetch_count=2)
+            await channel.basic_consume(recorder, queue_name='a-queue')
+            for index in range(5):
+                await channel.publish(str(index), 'a-domain', 'an-event')
+            await settle()
+            assert len(recorder.received) == 2
+            result = await channel.queue_declare('a-queue', passive=True)
+            assert result['message_count'] == 3
+            assert result['consumer_count'] == 1
+            await channel.basic_client_ack(2, multiple=True)
+            await settle()
+            assert len(recorder.received) == 4
+        helpers.aio_run(doit())
+
+    def test_reject_and_close_requeue(self):
+        recorder = Recorder(ack=False)
+
+        async def doit():
+            _, protocol = await memory.connect()
+            channel = await protocol.channel()
+            await topology(channel)
+            await channel.basic_consume(recorder, queue_name='a-queue')
+            await channel.publish(b'one', 'a-domain', 'an-event')
+            await channel.publish(b'two', 'a-domain', 'an-event')
+            await settle()
+            await channel.basic_reject(1, requeue=False)
+            await channel.close()
+
+            other = await protocol.channel()
+            await other.basic_consume(recorder, queue_name='a-queue')
+            await settle()
+        helpers.aio_run(doit())
+        bodies = [body for body, *_ in recorder.received]
+        assert bodies == [b'one', b'two', b'two']
+        assert recorder.received[-1][1].is_redeliver
+
+    def test_errors_close_the_channel(self):
+        async def doit():
+            _, protocol = await memory.connect()
+            channel = await protocol.channel()
+            with pytest.raises(ChannelClosed):
+                await channel.queue_declare('missing', passive=True)
+            assert not channel.is_open
+            channel = await protocol.channel()
+            await channel.exchange_declare('a-domain', 'topic')
+            with pytest.raises(ChannelClosed):
+                await channel.exchange_declare('a-domain', 'direct')
+            channel = await protocol.channel()
+            with pytest.raises(ChannelClosed):
+                await channel.basic_client_ack(1)
+        helpers.aio_run(doit())
+
+
+@mock.patch.dict(os.environ, {'TWYLA_TRANSPORT': 'memory',
+                              'TWYLA_PUBLISHER_CONFIRMS': 'true'})
+class MemoryTransportTests(unittest.TestCase):
+
+    def setUp(self):
+        memory.reset()
+        set_schemata(*common.schemata_fixtures())
+
+    def tearDown(self):
+        memory.reset()
+
+    def test_queue_manager_confirms(self):
+        qm = queues.QueueManager('TWYLA_')
+
+        async def doit():
+            await qm.connect()
+            await qm.bind_queue('a-domain.an-event', 'testing')
+            confirmed = await qm.emit('a-domain.an-event', {'a': 1})
+            assert await confirmed is True
+            sampler = queues.QueueSampler(qm, interval=1)
+            await sampler.sample()
+            await qm.stop()
+            await settle()
+            return sampler
+        sampler = helpers.aio_run(doit())
+        assert sampler.message_count('a-domain.an-event.testing') == 1
+
+    def test_event_bus_end_to_end(self):
+        received = []
+
+        async def callback(event):
+            received.append(event.content['name'])
+            await event.ack()
+        bus = EventBus('TWYLA_')
+        bus.listen('a-domain.an-event', 'testing', callback)
+        payload = EventPayload(
+            event_name='a-domain.an-event',
+            content={'name': 'test-name', 'text': 'test-text'},
+            context={'channel': 'test-channel',
+                     'channel_user': {'name': 'test-user', 'id': 24}})
+
+        async def doit():
+            await bus.start()
+            await bus.emit_many([payload, payload])
+            await bus.wait_for_confirms()
+            await settle()
+            await bus.queue_manager.stop()
+            await settle()
+        helpers.aio_run(doit())
+        assert received == ['test-name', 'test-name']
@@ -4,9 +4,12 @@ import unittest
 import unittest.mock as mock
 
 import pytest
+import aioamqp
 from aioamqp.protocol import OPEN
+from types import SimpleNamespace as Bunch
 
 import twyla.service.queues as queues
+import twyla.service.telemetry as telemetry
 import twyla.service.test.helpers as helpers
 
 
@@ -16,17 +19,38 @@ class MockChannel:
         self.queue_declare_calls = 0
         self.queue_bind_calls = 0
         self.close_calls = 0
+        self.qos_calls = []
+        self.consume_calls = []
+        self.published = []
+        self.confirm_select_calls = 0
+        self.publisher_confirms = False
         self.is_open = True
 
     async def exchange_declare(self, *args, **kwargs):
         self.exchange_declare_calls += 1
 
-    async def queue_declare(self, *args, **kwargs):
+    async def queue_declare(self, queue_name, **kwargs):
         self.queue_declare_calls += 1
+        return {'queue': queue_name,
+                'message_count': len(queue_name),
+                'consumer_count': 1}
 
     async def queue_bind(self, *args, **kwargs):
         self.queue_bind_calls += 1
 
+    async def basic_qos(self, **kwargs):
+        self.qos_calls.append(kwargs)
+
+    async def basic_consume(self, **kwargs):
+        self.consume_calls.append(kwargs)
+
+    async def confirm_select(self):
+        self.confirm_select_calls += 1
+        self.publisher_confirms = True
+
+    async def publish(self, **kwargs):
+        self.published.append(kwargs)
+
     async def close(self):
         self.close_calls += 1
 
@@ -83,7 +107,7 @@ class QueueManagerTests(unittest.TestCase):
         self.patcher.stop()
 
 
-    @mock.patch('twyla.service.queues.aioamqp', new_callable=MockAioamqp)
+    @mock.patch('twyla.service.transports.aioamqp', new_callable=MockAioamqp)
     def test_queue_manager_basic(self, mock_aioamqp):
         qm = queues.QueueManager('TWYLA_')
         helpers.aio_run(qm.connect())
@@ -93,7 +117,8 @@ class QueueManagerTests(unittest.TestCase):
         assert isinstance(qm.protocol, MockProtocol)
         assert isinstance(qm.channel, MockChannel)
 
-        assert qm.protocol.channel_calls == 1
+        # The topology channel and a publisher channel
+        assert qm.protocol.channel_calls == 2
         # no exchanges or queues called yet
         assert qm.channel.exchange_declare_calls == 0
         assert qm.channel.queue_declare_calls == 0
@@ -103,3 +128,349 @@ class QueueManagerTests(unittest.TestCase):
 
         assert qm.protocol.close_calls == 1
         assert qm.channel.close_calls == 1
+
+
+    @mock.patch('twyla.service.transports.aioamqp', new_callable=MockAioamqp)
+    def test_listen_sets_prefetch_count(self, mock_aioamqp):
+        qm = queues.QueueManager('TWYLA_')
+        helpers.aio_run(qm.connect())
+        helpers.aio_run(qm.listen('a-domain.an-event', 'testing', None,
+                                  prefetch_count=5))
+        helpers.aio_run(qm.listen('a-domain.other-event', 'testing', None))
+
+        # Every consumer has a channel of its own, topology is declared on
+        # the main channel
+        first, second = qm.consumer_channels
+        assert qm.channel.queue_declare_calls == 2
+        assert qm.channel.consume_calls == []
+        assert first.qos_calls == [{'prefetch_count': 5,
+                                    'connection_global': False}]
+        assert second.qos_calls == []
+        assert first.consume_calls[0]['queue_name'] == \
+            'a-domain.an-event.testing'
+        assert second.consume_calls[0]['queue_name'] == \
+            'a-domain.other-event.testing'
+        helpers.aio_run(qm.stop())
+        assert first.close_calls == 1
+        assert second.close_calls == 1
+
+
+    @mock.patch('twyla.service.transports.aioamqp', new_callable=MockAioamqp)
+    def test_listen_many_binds_one_queue(self, mock_aioamqp):
+        qm = queues.QueueManager('TWYLA_')
+        helpers.aio_run(qm.connect())
+        helpers.aio_run(qm.listen_many(
+            ['a-domain.an-event', 'a-domain.other-event', 'b-domain.event'],
+            'a-service.audit', None, prefetch_count=5))
+
+        consumer, = qm.consumer_channels
+        assert qm.channel.exchange_declare_calls == 2
+        assert qm.channel.queue_declare_calls == 1
+        assert qm.channel.queue_bind_calls == 3
+        assert consumer.qos_calls == [{'prefetch_count': 5,
+                                       'connection_global': False}]
+        assert consumer.consume_calls[0]['queue_name'] == 'a-service.audit'
+        helpers.aio_run(qm.stop())
+        # The queue is not named after the events, so it needs a namespace
+        with pytest.raises(AssertionError):
+            helpers.aio_run(qm.listen_many(['a-domain.an-event'], 'audit',
+                                           None))
+
+
+    @mock.patch('twyla.service.transports.aioamqp', new_callable=MockAioamqp)
+    def test_emit_many(self, mock_aioamqp):
+        qm = queues.QueueManager('TWYLA_')
+        helpers.aio_run(qm.connect())
+        helpers.aio_run(qm.emit_many([
+            ('a-domain.an-event', 'one', {'content_type': 'text/plain'}),
+            ('b-domain.other-event', {'a': 1})]))
+
+        channel, _ = qm.publishers[0]
+        assert channel is not qm.channel
+        assert channel.published == [
+            {'payload': 'one', 'exchange_name': 'a-domain',
+             'routing_key': 'an-event',
+             'properties': {'content_type': 'text/plain'}},
+            {'payload': b'{"a":1}', 'exchange_name': 'b-domain',
+             'routing_key': 'other-event',
+             'properties': {'content_type': 'application/json'}}]
+
+
+    @mock.patch('twyla.service.transports.aioamqp', new_callable=MockAioamqp)
+    def test_publish_buffer_by_size(self, mock_aioamqp):
+        with mock.patch.dict(os.environ, {'TWYLA_PUBLISH_BUFFER_SIZE': '3',
+                                          'TWYLA_PUBLISH_BUFFER_WAIT': '10'}):
+            qm = queues.QueueManager('TWYLA_')
+        helpers.aio_run(qm.connect())
+
+        for i in range(4):
+            helpers.aio_run(qm.emit('a-domain.an-event', str(i)))
+        # The first three were written in one batch, the last one is pending
+        channel, _ = qm.publishers[0]
+        assert [p['payload'] for p in channel.published] == ['0', '1', '2']
+        assert qm.publish_buffer.batch_sizes == {3: 1}
+
+        # Stopping flushes the rest
+        helpers.aio_run(qm.stop())
+        assert len(channel.published) == 4
+        assert qm.publish_buffer.batch_sizes == {3: 1, 1: 1}
+        assert qm.publish_buffer.batches == 2
+        assert qm.publish_buffer.messages == 4
+
+
+    @mock.patch('twyla.service.transports.aioamqp', new_callable=MockAioamqp)
+    def test_stop_flushes_emits_buffered_before_connecting(self,
+                                                          mock_aioamqp):
+        with mock.patch.dict(os.environ, {'TWYLA_PUBLISH_BUFFER_SIZE': '3',
+                                          'TWYLA_PUBLISH_BUFFER_WAIT': '10'}):
+            qm = queues.QueueManager('TWYLA_')
+
+        async def doit():
+            await qm.emit('a-domain.an-event', 'one')
+            await qm.stop()
+        helpers.aio_run(doit())
+        channel, _ = qm.publishers[0]
+        assert [p['payload'] for p in channel.published] == ['one']
+        assert qm.publish_buffer.batches == 1
+
+
+    @mock.patch('twyla.service.transports.aioamqp', new_callable=MockAioamqp)
+    def test_publish_buffer_by_time(self, mock_aioamqp):
+        with mock.patch.dict(os.environ, {'TWYLA_PUBLISH_BUFFER_SIZE': '100',
+                                          'TWYLA_PUBLISH_BUFFER_WAIT': '0.01'}):
+            qm = queues.QueueManager('TWYLA_')
+        helpers.aio_run(qm.connect())
+
+        async def doit():
+            await qm.emit_many([('a-domain.an-event', 'one'),
+                                ('a-domain.an-event', 'two')])
+            channel, _ = qm.publishers[0]
+            assert channel.published == []
+            await asyncio.sleep(0.05)
+        helpers.aio_run(doit())
+        channel, _ = qm.publishers[0]
+        assert len(channel.published) == 2
+        assert qm.publish_buffer.batch_sizes == {2: 1}
+
+
+    @mock.patch('twyla.service.transports.aioamqp', new_callable=MockAioamqp)
+    def test_publisher_confirms(self, mock_aioamqp):
+        with mock.patch.dict(os.environ, {'TWYLA_PUBLISHER_CONFIRMS': 'true',
+                                          'TWYLA_CONFIRM_WINDOW': '10'}):
+            qm = queues.QueueManager('TWYLA_')
+        helpers.aio_run(qm.connect())
+
+        async def doit():
+            futures = await qm.emit_many(
+                [('a-domain.an-event', str(i)) for i in range(4)])
+            channel, _ = qm.publishers[0]
+            assert channel.confirm_select_calls == 1
+            assert not channel.publisher_confirms
+            # Ack the first three at once, then nack the last one
+            await channel.basic_server_ack(
+                Bunch(delivery_tag=3, multiple=True))
+            assert [f.done() for f in futures] == [True, True, True, False]
+            await channel.basic_server_nack(
+                Bunch(delivery_tag=4, multiple=False))
+            return futures
+        futures = helpers.aio_run(doit())
+        assert [f.result() for f in futures[:3]] == [True, True, True]
+        with pytest.raises(aioamqp.PublishFailed):
+            futures[3].result()
+        _, tracker = qm.publishers[0]
+        assert not tracker.outstanding
+
+
+    @mock.patch('twyla.service.transports.aioamqp', new_callable=MockAioamqp)
+    def test_publisher_channels_round_robin(self, mock_aioamqp):
+        with mock.patch.dict(os.environ, {'TWYLA_PUBLISHER_CHANNELS': '2'}):
+            qm = queues.QueueManager('TWYLA_')
+        helpers.aio_run(qm.connect())
+        helpers.aio_run(qm.emit_many(
+            [('a-domain.an-event', str(i)) for i in range(3)]))
+
+        assert qm.protocol.channel_calls == 3
+        (first, _), (second, _) = qm.publishers
+        assert [p['payload'] for p in first.published] == ['0', '2']
+        assert [p['payload'] for p in second.published] == ['1']
+
+
+    def test_confirm_window(self):
+        loop = asyncio.get_event_loop()
+        tracker = queues.ConfirmTracker(window=2, loop=loop)
+
+        async def doit():
+            first = await tracker.reserve()
+            await tracker.reserve()
+            third = asyncio.ensure_future(tracker.reserve())
+            await asyncio.sleep(0)
+            # The window is full until a confirm comes in
+            assert not third.done()
+            await tracker.on_ack(Bunch(delivery_tag=1, multiple=False))
+            await third
+            assert first.result()
+            assert list(tracker.outstanding) == [2, 3]
+            waiter = asyncio.ensure_future(tracker.wait())
+            await tracker.on_ack(Bunch(delivery_tag=3, multiple=True))
+            await waiter
+        helpers.aio_run(doit())
+        assert not tracker.outstanding
+
+
+    @mock.patch('twyla.service.transports.aioamqp', new_callable=MockAioamqp)
+    def test_loop_resolved_on_connect(self, mock_aioamqp):
+        qm = queues.QueueManager('TWYLA_')
+        assert qm.loop is None
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(qm.connect())
+        finally:
+            loop.close()
+        assert qm.loop is loop
+
+
+    @mock.patch('twyla.service.transports.aioamqp', new_callable=MockAioamqp)
+    def test_topology_declared_once_per_connection(self, mock_aioamqp):
+        qm = queues.QueueManager('TWYLA_')
+        helpers.aio_run(qm.connect())
+
+        async def doit():
+            await asyncio.gather(
+                qm.bind_queue('a-domain.an-event', 'testing'),
+                qm.bind_queue('a-domain.other-event', 'testing'),
+                qm.bind_queue('a-domain.an-event', 'testing'))
+        helpers.aio_run(doit())
+        assert qm.channel.exchange_declare_calls == 1
+        assert qm.channel.queue_declare_calls == 2
+        assert qm.channel.queue_bind_calls == 2
+
+        # A new connection declares everything again
+        qm.channel = None
+        helpers.aio_run(qm.connect())
+        helpers.aio_run(qm.bind_queue('a-domain.an-event', 'testing'))
+        assert qm.channel.exchange_declare_calls == 1
+        assert qm.channel.queue_declare_calls == 1
+        assert qm.channel.queue_bind_calls == 1
+
+
+    @mock.patch('twyla.service.transports.aioamqp', new_callable=MockAioamqp)
+    def test_failed_declaration_is_retried(self, mock_aioamqp):
+        qm = queues.QueueManager('TWYLA_')
+        helpers.aio_run(qm.connect())
+        calls = []
+
+        async def declare():
+            calls.append(1)
+            if len(calls) == 1:
+                raise RuntimeError('declaration failed')
+
+        with pytest.raises(RuntimeError):
+            helpers.aio_run(qm.declare_once('key', declare))
+        helpers.aio_run(qm.declare_once('key', declare))
+        helpers.aio_run(qm.declare_once('key', declare))
+        assert len(calls) == 2
+
+
+    @mock.patch('twyla.service.transports.aioamqp', new_callable=MockAioamqp)
+    def test_emits_buffered_while_reconnecting(self, mock_aioamqp):
+        with mock.patch.dict(os.environ,
+                             {'TWYLA_RECONNECT_BUFFER_SIZE': '2'}):
+            qm = queues.QueueManager('TWYLA_')
+        helpers.aio_run(qm.connect())
+        helpers.aio_run(qm.bind_queue('a-domain.an-event', 'testing'))
+        old_protocol = qm.protocol
+
+        async def doit():
+            qm.reconnecting = True
+            await qm.connect()
+            await qm.emit_many([('a-domain.an-event', 'one'),
+                                ('a-domain.an-event', 'two')])
+            with pytest.raises(RuntimeError):
+                await qm.emit('a-domain.an-event', 'three')
+            await qm.reconnect()
+            assert qm.protocol is not old_protocol
+            channel, _ = qm.publishers[0]
+            assert channel.published == []
+            await qm.bind_queue('a-domain.an-event', 'testing')
+            await qm.resume()
+        helpers.aio_run(doit())
+
+        assert old_protocol.close_calls == 1
+        # Topology is declared again on the new connection
+        assert qm.channel.exchange_declare_calls == 1
+        channel, _ = qm.publishers[0]
+        assert [p['payload'] for p in channel.published] == ['one', 'two']
+        assert not qm.reconnecting
+
+
+    @mock.patch('twyla.service.transports.aioamqp', new_callable=MockAioamqp)
+    def test_replaced_connection_does_not_signal_disconnect(self,
+                                                            mock_aioamqp):
+        class ClosingProtocol(MockProtocol):
+            def __init__(self):
+                super().__init__()
+                self.closed = asyncio.Event()
+
+            async def close(self):
+                await super().close()
+                self.closed.set()
+
+            async def wait_closed(self):
+                await self.closed.wait()
+
+        async def connect(*args, **kwargs):
+            return None, ClosingProtocol()
+        mock_aioamqp.connect = connect
+        qm = queues.QueueManager('TWYLA_')
+
+        async def doit():
+            await qm.open_connection()
+            old_protocol = qm.protocol
+            # Let the watcher of the connection start waiting
+            await asyncio.sleep(0)
+            await qm.reconnect()
+            assert old_protocol.closed.is_set()
+            await asyncio.sleep(0.01)
+            return qm.closed_event.is_set()
+        assert not helpers.aio_run(doit())
+
+
+    @mock.patch('twyla.service.transports.aioamqp', new_callable=MockAioamqp)
+    def test_publish_telemetry(self, mock_aioamqp):
+        t = telemetry.Telemetry()
+        durations = []
+        t.register_duration(lambda name, value: durations.append(value),
+                            'publish')
+        qm = queues.QueueManager('TWYLA_', telemetry=t)
+        helpers.aio_run(qm.connect())
+        helpers.aio_run(qm.emit('a-domain.an-event', 'one'))
+        assert len(durations) == 1
+        assert durations[0] >= 0
+
+
+    @mock.patch('twyla.service.transports.aioamqp', new_callable=MockAioamqp)
+    def test_queue_sampler(self, mock_aioamqp):
+        t = telemetry.Telemetry()
+        sent = []
+        t.register(t.event.queue_messages,
+                   lambda queue, count: sent.append((queue, count)))
+        qm = queues.QueueManager('TWYLA_')
+        sampler = queues.QueueSampler(qm, interval=0.01, telemetry=t)
+        # Nothing to sample before connecting
+        helpers.aio_run(sampler.sample())
+
+        helpers.aio_run(qm.connect())
+        helpers.aio_run(qm.bind_queue('a-domain.an-event', 'testing'))
+        helpers.aio_run(qm.bind_queue('a-domain.other-event', 'testing'))
+
+        async def doit():
+            await sampler.start()
+            await asyncio.sleep(0.03)
+            await sampler.stop()
+        helpers.aio_run(doit())
+
+        assert sampler.message_count('a-domain.an-event.testing') == 25
+        assert sampler.consumer_count('a-domain.an-event.testing') == 1
+        assert sampler.message_count('unknown') is None
+        assert sampler.total_message_count() == 25 + 28
+        assert ('a-domain.other-event.testing', 28) in sent
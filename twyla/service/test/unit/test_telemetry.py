@@ -1,8 +1,12 @@
 # pylint: disable-msg=protected-access
+import asyncio
+import pickle
+import struct
 import unittest
 import unittest.mock
 
 import twyla.service.telemetry as telemetry
+import twyla.service.test.helpers as helpers
 
 
 class TelemetryTestCase(unittest.TestCase):
@@ -113,6 +117,40 @@ class TelemetryTestCase(unittest.TestCase):
         self.assertEqual(self.result, 'event1')
         self.assertEqual(self.result2, 'event2')
 
+    def test_notify_inactive(self):
+        t = telemetry.Telemetry()
+        self.assertFalse(t.active)
+        t.notify(TelemetryTestCase.TestEvent, 'event1')
+
+        t.register(TelemetryTestCase.TestEvent, self.test_recorder)
+        self.assertTrue(t.active)
+        t.deregister(TelemetryTestCase.TestEvent, self.test_recorder)
+        self.assertFalse(t.active)
+        t.notify(TelemetryTestCase.TestEvent, 'event1')
+        self.assertIsNone(self.result)
+
+    def test_register_during_notify(self):
+        t = telemetry.Telemetry()
+        calls = []
+
+        def register_more(event):
+            calls.append(event)
+            t.register(TelemetryTestCase.TestEvent, register_more)
+
+        t.register(TelemetryTestCase.TestEvent, register_more)
+        t.notify(TelemetryTestCase.TestEvent, 'event1')
+        # The handler registered during notify is only called next time
+        self.assertEqual(calls, ['event1'])
+
+    def test_event_names_are_cached(self):
+        event = telemetry.Event('chat')
+        name = event.incoming
+        self.assertEqual(name, 'chat.incoming')
+        self.assertIs(event.incoming, name)
+        self.assertIn('incoming', vars(event))
+        with self.assertRaises(AttributeError):
+            event.__deepcopy__
+
     def test_notify_multi_args(self):
         class Events():
             def __init__(self, name):
@@ -130,33 +168,239 @@ class TelemetryTestCase(unittest.TestCase):
         self.assertEqual(self.result3, [1, 2, 3])
 
 
+class HistogramTestCase(unittest.TestCase):
+    def test_percentiles(self):
+        histogram = telemetry.Histogram(relative_accuracy=0.01)
+        for value in range(1, 10001):
+            histogram.add(value)
+        self.assertEqual(histogram.count, 10000)
+        self.assertEqual(histogram.min, 1)
+        self.assertEqual(histogram.max, 10000)
+        for percentile in (50, 90, 99):
+            expected = percentile * 100
+            self.assertAlmostEqual(histogram.percentile(percentile), expected,
+                                   delta=expected * 0.02)
+
+    def test_fixed_memory(self):
+        histogram = telemetry.Histogram(max_buckets=10)
+        for value in range(1, 10001):
+            histogram.add(value)
+        self.assertEqual(len(histogram.buckets), 10)
+        self.assertEqual(histogram.percentile(100), 10000)
+
+    def test_zeros_and_empty(self):
+        histogram = telemetry.Histogram()
+        self.assertIsNone(histogram.percentile(50))
+        histogram.add(0)
+        histogram.add(0)
+        histogram.add(5)
+        self.assertEqual(histogram.percentile(50), 0)
+        self.assertAlmostEqual(histogram.percentile(100), 5)
+
+    def test_merge(self):
+        low, high = telemetry.Histogram(), telemetry.Histogram()
+        for value in range(1, 5001):
+            low.add(value)
+        for value in range(5001, 10001):
+            high.add(value)
+        low.merge(high)
+        self.assertEqual(low.count, 10000)
+        self.assertEqual(low.min, 1)
+        self.assertEqual(low.max, 10000)
+        self.assertAlmostEqual(low.percentile(90), 9000, delta=180)
+
+
+class AggregatorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sent = {}
+
+        def send(name, value, timestamp):
+            self.sent[name] = value
+
+        self.aggregator = telemetry.Aggregator(send, percentiles=(50,))
+
+    def test_flush(self):
+        t = telemetry.Telemetry()
+        t.register_ticker(self.aggregator.count, 'incoming')
+        for _ in range(1000):
+            t.notify(t.event.incoming)
+        self.aggregator.gauge('queue.depth', 3)
+        self.aggregator.gauge('queue.depth', 5)
+        for value in (10, 20, 30):
+            self.aggregator.timing('handler', value)
+
+        self.assertEqual(self.sent, {})
+        self.aggregator.flush()
+        self.assertEqual(self.sent['telemetry.incoming'], 1000)
+        self.assertEqual(self.sent['queue.depth'], 5)
+        self.assertEqual(self.sent['handler.count'], 3)
+        self.assertEqual(self.sent['handler.sum'], 60)
+        self.assertEqual(self.sent['handler.min'], 10)
+        self.assertEqual(self.sent['handler.max'], 30)
+        self.assertAlmostEqual(self.sent['handler.p50'], 20, delta=0.5)
+
+        # Everything is reset after flushing
+        self.sent = {}
+        self.aggregator.flush()
+        self.assertEqual(self.sent, {})
+
+    def test_merge(self):
+        worker = telemetry.Aggregator(lambda *args: None)
+        worker.count('incoming', 2)
+        worker.gauge('queue.depth', 7)
+        worker.timing('handler', 10)
+        self.aggregator.count('incoming')
+        self.aggregator.timing('handler', 30)
+        self.aggregator.merge(*pickle.loads(pickle.dumps(worker.take())))
+        self.assertEqual(worker.take(), ({}, {}, {}))
+
+        self.aggregator.flush()
+        self.assertEqual(self.sent['incoming'], 3)
+        self.assertEqual(self.sent['queue.depth'], 7)
+        self.assertEqual(self.sent['handler.count'], 2)
+        self.assertEqual(self.sent['handler.max'], 30)
+
+    def test_merge_gauges_per_source(self):
+        for source, depth in (('worker-0', 3), ('worker-1', 4)):
+            self.aggregator.merge({}, {'queue.depth': depth}, {}, source)
+        self.aggregator.flush()
+        self.assertEqual(self.sent['queue.depth.worker-0'], 3)
+        self.assertEqual(self.sent['queue.depth.worker-1'], 4)
+        self.assertNotIn('queue.depth', self.sent)
+
+    def test_flush_interval(self):
+        aggregator = telemetry.Aggregator(
+            lambda *args: self.sent.setdefault(args[0], args[1]),
+            flush_interval=0.01)
+
+        async def doit():
+            await aggregator.start()
+            aggregator.count('ticks')
+            await asyncio.sleep(0.05)
+            await aggregator.stop()
+        helpers.aio_run(doit())
+        self.assertEqual(self.sent['ticks'], 1)
+
+
 class GraphiteTestCase(unittest.TestCase):
-    class SocketRecorder:
+    class WriterRecorder:
+        def __init__(self):
+            self.recv = b''
+            self.closed = False
+
+        def write(self, b: bytes):
+            self.recv += b
+
+        async def drain(self):
+            pass
+
+        def close(self):
+            self.closed = True
+
+    class TransportRecorder:
         def __init__(self):
-            self.recv = None
+            self.datagrams = []
 
-        def sendall(self, b: bytes):
-            self.recv = b
+        def sendto(self, b: bytes):
+            self.datagrams.append(b)
 
         def close(self):
             pass
 
     def setUp(self):
-        self.sock = GraphiteTestCase.SocketRecorder()
+        self.writer = GraphiteTestCase.WriterRecorder()
 
     def test_sending_data(self):
         client = telemetry.Graphite('localhost', 1234)
-        client._get_socket = unittest.mock.MagicMock(
-            return_value=self.sock)
         data = {
             'with_timestamp': ['metric.test', 1234, 1234],
             'without_timestamp': ['metric.test', 5678],
         }
 
         client.send(*data['with_timestamp'])
-        self.assertEqual(self.sock.recv, b'metric.test 1234 1234\n')
-
         client.send(*data['without_timestamp'])
-        self.assertTrue(self.sock.recv.startswith(b'metric.test 5678 '))
-        self.assertFalse(self.sock.recv.endswith(b' 0\n'))
-
+        # Nothing is sent before flushing
+        self.assertEqual(len(client.buffer), 2)
+
+        with unittest.mock.patch('asyncio.open_connection',
+                                 helpers.AsyncMock(
+                                     return_value=(None, self.writer))):
+            helpers.aio_run(client.flush())
+        lines = self.writer.recv.split(b'\n')
+        self.assertEqual(lines[0], b'metric.test 1234 1234')
+        self.assertTrue(lines[1].startswith(b'metric.test 5678 '))
+        self.assertFalse(lines[1].endswith(b' 0'))
+        self.assertEqual(len(client.buffer), 0)
+
+    def test_connection_is_reused(self):
+        client = telemetry.Graphite('localhost', 1234, batch_size=1)
+        connect = helpers.AsyncMock(return_value=(None, self.writer))
+        with unittest.mock.patch('asyncio.open_connection', connect):
+            client.send('metric.test', 1, 1)
+            client.send('metric.test', 2, 2)
+            helpers.aio_run(client.flush())
+            client.send('metric.test', 3, 3)
+            helpers.aio_run(client.flush())
+        self.assertEqual(connect.call_count, 1)
+        self.assertEqual(self.writer.recv,
+                         b'metric.test 1 1\nmetric.test 2 2\n'
+                         b'metric.test 3 3\n')
+
+    def test_metrics_kept_on_error(self):
+        client = telemetry.Graphite('localhost', 1234)
+        client.send('metric.test', 1, 1)
+        with unittest.mock.patch('asyncio.open_connection',
+                                 helpers.AsyncMock(
+                                     side_effect=ConnectionRefusedError())):
+            helpers.aio_run(client.flush())
+        self.assertEqual(list(client.buffer), [('metric.test', 1, 1)])
+
+    def test_bounded_buffer(self):
+        client = telemetry.Graphite('localhost', 1234, buffer_size=2)
+        for value in range(3):
+            client.send('metric.test', value, 1)
+        self.assertEqual([m[1] for m in client.buffer], [1, 2])
+        self.assertEqual(client.dropped, 1)
+
+    def test_pickle_protocol(self):
+        client = telemetry.Graphite('localhost', 2004, protocol='pickle')
+        client.send('metric.test', 1234, 1234)
+        with unittest.mock.patch('asyncio.open_connection',
+                                 helpers.AsyncMock(
+                                     return_value=(None, self.writer))):
+            helpers.aio_run(client.flush())
+        length, = struct.unpack('!L', self.writer.recv[:4])
+        self.assertEqual(length, len(self.writer.recv) - 4)
+        self.assertEqual(pickle.loads(self.writer.recv[4:]),
+                         [('metric.test', (1234, 1234))])
+
+    def test_udp_protocol(self):
+        client = telemetry.Graphite('localhost', 2003, protocol='udp')
+        transport = GraphiteTestCase.TransportRecorder()
+        client._transport = transport
+        for value in range(100):
+            client.send('metric.test', value, 1234)
+        helpers.aio_run(client.flush())
+        self.assertGreater(len(transport.datagrams), 1)
+        for datagram in transport.datagrams:
+            self.assertLessEqual(len(datagram),
+                                 telemetry.Graphite.MAX_DATAGRAM_SIZE)
+        lines = b''.join(transport.datagrams).splitlines()
+        self.assertEqual(len(lines), 100)
+
+    def test_flush_on_size(self):
+        client = telemetry.Graphite('localhost', 1234, batch_size=2,
+                                    flush_interval=100)
+        with unittest.mock.patch('asyncio.open_connection',
+                                 helpers.AsyncMock(
+                                     return_value=(None, self.writer))):
+            async def doit():
+                await client.start()
+                client.send('metric.test', 1, 1)
+                client.send('metric.test', 2, 2)
+                await asyncio.sleep(0.01)
+                self.assertEqual(self.writer.recv,
+                                 b'metric.test 1 1\nmetric.test 2 2\n')
+                await client.stop()
+            helpers.aio_run(doit())
+        self.assertTrue(self.writer.closed)
@@ -0,0 +1,350 @@
+import asyncio
+import datetime
+import os
+import signal
+import unittest
+import unittest.mock as mock
+
+import pytest
+from aioamqp.exceptions import ChannelClosed
+
+from twyla.service import memory, queues, transports
+from twyla.service.event import EventPayload, set_schemata
+from twyla.service.event_bus import EventBus
+from twyla.service.test import amqp_server, common, helpers
+
+
+async def settle(until=None, timeout=2.0):
+    # Network transports need a few more loop iterations than memory
+    if until is None:
+        await asyncio.sleep(0.01)
+        return
+    deadline = asyncio.get_event_loop().time() + timeout
+    while not until() and asyncio.get_event_loop().time() < deadline:
+        await asyncio.sleep(0.005)
+
+
+class Recorder:
+
+    def __init__(self, ack=True):
+        self.ack = ack
+        self.received = []
+
+    async def __call__(self, channel, body, envelope, properties):
+        self.received.append((body, envelope, properties))
+        if self.ack:
+            await channel.basic_client_ack(envelope.delivery_tag)
+
+
+class TransportTests:
+    """Behaviour shared by all transports, run against the memory broker"""
+
+    transport = None
+
+    def setUp(self):
+        memory.reset()
+        set_schemata(*common.schemata_fixtures())
+        self.server = helpers.aio_run(amqp_server.serve())
+        port = self.server.sockets[0].getsockname()[1]
+        self.patcher = mock.patch.dict(
+            os.environ,
+            {'TWYLA_TRANSPORT': self.transport,
+             'TWYLA_AMQP_HOST': '127.0.0.1',
+             'TWYLA_AMQP_PORT': str(port),
+             'TWYLA_AMQP_USER': 'guest',
+             'TWYLA_AMQP_PASS': 'guest',
+             'TWYLA_AMQP_VHOST': '/'})
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.server.close()
+        helpers.aio_run(self.server.wait_closed())
+        memory.reset()
+
+    def run_with_queue_manager(self, test):
+        qm = queues.QueueManager('TWYLA_')
+        assert qm.transport.name == self.transport
+
+        async def doit():
+            await qm.connect()
+            try:
+                return await test(qm)
+            finally:
+                await qm.stop()
+                await settle()
+        return helpers.aio_run(doit())
+
+    def test_declare_and_sample(self):
+        async def test(qm):
+            await qm.bind_queue('a-domain.an-event', 'testing')
+            await qm.emit('a-domain.an-event', {'a': 1})
+            await qm.emit('a-domain.other-event', {'a': 1})
+            sampler = queues.QueueSampler(qm, interval=1)
+            await settle(lambda: memory.get_broker().queues[
+                'a-domain.an-event.testing'].messages)
+            await sampler.sample()
+            return sampler
+        sampler = self.run_with_queue_manager(test)
+        assert sampler.message_count('a-domain.an-event.testing') == 1
+        assert sampler.consumer_count('a-domain.an-event.testing') == 0
+
+    def test_sampling_a_missing_queue(self):
+        async def test(qm):
+            await qm.bind_queue('a-domain.an-event', 'testing')
+            # Like a queue deleted by someone else
+            qm.bound_queues.add('missing')
+            sampler = queues.QueueSampler(qm, interval=1)
+            with self.assertLogs('twyla.service.queues', 'WARNING'):
+                await sampler.sample()
+            await sampler.sample()
+            # The topology channel is still usable
+            await qm.bind_queue('a-domain.other-event', 'testing')
+            await sampler.stop()
+            return sampler
+        sampler = self.run_with_queue_manager(test)
+        assert sampler.message_count('a-domain.an-event.testing') == 0
+        assert sampler.message_count('missing') is None
+
+    def test_properties_round_trip(self):
+        recorder = Recorder()
+        timestamp = datetime.datetime(2020, 1, 2, 3, 4, 5,
+                                      tzinfo=datetime.timezone.utc)
+
+        async def test(qm):
+            await qm.listen('a-domain.an-event', 'testing', recorder)
+            await qm.emit('a-domain.an-event', b'{}', properties={
+                'content_type': 'application/json',
+                'message_type': 'a-domain.an-event',
+                'message_id': 'a-message',
+                'timestamp': timestamp,
+                'delivery_mode': 2,
+                'headers': {'schema_version': 3, 'session': 'a-session'}})
+            await settle(lambda: recorder.received)
+        self.run_with_queue_manager(test)
+        body, envelope, properties = recorder.received[0]
+        assert body == b'{}'
+        assert envelope.exchange_name == 'a-domain'
+        assert envelope.routing_key == 'an-event'
+        assert not envelope.is_redeliver
+        assert properties.content_type == 'application/json'
+        assert properties.message_type == 'a-domain.an-event'
+        assert properties.message_id == 'a-message'
+        assert properties.timestamp == timestamp
+        assert properties.delivery_mode == 2
+        assert properties.headers == {'schema_version': 3,
+                                      'session': 'a-session'}
+
+    def test_bodies_larger_than_a_frame(self):
+        recorder = Recorder()
+        bodies = [b'', b'x' * amqp_server.FRAME_MAX,
+                  bytes(range(256)) * 100]
+
+        async def test(qm):
+            await qm.listen('a-domain.an-event', 'testing', recorder)
+            for body in bodies:
+                await qm.emit('a-domain.an-event', body)
+            await settle(lambda: len(recorder.received) == len(bodies))
+        self.run_with_queue_manager(test)
+        assert [body for body, *_ in recorder.received] == bodies
+
+    def test_prefetch_and_requeue(self):
+        recorder = Recorder(ack=False)
+
+        async def test(qm):
+            await qm.listen('a-domain.an-event', 'testing', recorder,
+                            prefetch_count=2)
+            for index in range(3):
+                await qm.emit('a-domain.an-event', str(index).encode())
+            await settle(lambda: len(recorder.received) == 2)
+            await asyncio.sleep(0.02)
+            assert len(recorder.received) == 2
+            channel = qm.consumer_channels[0]
+            await channel.basic_reject(1, requeue=True)
+            await channel.basic_client_ack(2)
+            await settle(lambda: len(recorder.received) == 4)
+        self.run_with_queue_manager(test)
+        bodies = [body for body, *_ in recorder.received]
+        assert bodies == [b'0', b'1', b'0', b'2']
+        assert recorder.received[2][1].is_redeliver
+
+    @mock.patch.dict(os.environ, {'TWYLA_PUBLISHER_CONFIRMS': 'true'})
+    def test_publisher_confirms(self):
+        async def test(qm):
+            await qm.bind_queue('a-domain.an-event', 'testing')
+            confirms = await qm.emit_many(
+                [('a-domain.an-event', {'a': index}) for index in range(5)])
+            await qm.wait_for_confirms()
+            return [confirmed.result() for confirmed in confirms]
+        assert self.run_with_queue_manager(test) == [True] * 5
+
+    def test_handler_emits_before_acking(self):
+        handled = []
+
+        async def test(qm):
+            async def callback(channel, body, envelope, properties):
+                # Runs inside the frame reader of the aioamqp connection
+                await qm.emit('a-domain.other-event', body)
+                handled.append(body)
+                await channel.basic_client_ack(envelope.delivery_tag)
+            queues_ = memory.get_broker().queues
+            await qm.bind_queue('a-domain.an-event', 'testing')
+            await qm.bind_queue('a-domain.other-event', 'testing')
+            for index in range(3):
+                # Queued without emitting, so the handler emits first
+                await qm.channel.publish(str(index).encode(), 'a-domain',
+                                         'an-event')
+            await qm.listen('a-domain.an-event', 'testing', callback)
+            await settle(lambda: len(queues_[
+                'a-domain.other-event.testing'].messages) == 3)
+        self.run_with_queue_manager(test)
+        assert handled == [b'0', b'1', b'2']
+
+    @mock.patch.dict(os.environ, {'TWYLA_PUBLISHER_CONFIRMS': 'true',
+                                  'TWYLA_CONFIRM_WINDOW': '2'})
+    def test_handler_waits_for_confirms(self):
+        handled = []
+
+        async def test(qm):
+            async def callback(channel, body, envelope, properties):
+                # Waits for the broker, beyond the confirm window
+                confirmed = await qm.emit('a-domain.other-event', body)
+                await confirmed
+                await qm.wait_for_confirms()
+                handled.append(body)
+                await channel.basic_client_ack(envelope.delivery_tag)
+            await qm.bind_queue('a-domain.an-event', 'testing')
+            await qm.bind_queue('a-domain.other-event', 'testing')
+            for index in range(20):
+                await qm.channel.publish(str(index).encode(), 'a-domain',
+                                         'an-event')
+            await qm.listen('a-domain.an-event', 'testing', callback)
+            await settle(lambda: len(handled) == 20)
+        self.run_with_queue_manager(test)
+        assert handled == [str(index).encode() for index in range(20)]
+
+    def test_errors_close_the_channel(self):
+        async def test(qm):
+            channel = await qm.protocol.channel()
+            with pytest.raises(ChannelClosed):
+                await channel.queue_declare('missing', passive=True)
+            await settle(lambda: not channel.is_open)
+            assert not channel.is_open
+            # The connection and its other channels are still usable
+            await qm.bind_queue('a-domain.an-event', 'testing')
+        self.run_with_queue_manager(test)
+
+    def test_event_bus_end_to_end(self):
+        received = []
+
+        async def callback(event):
+            received.append(event.content['name'])
+            await event.ack()
+        bus = EventBus('TWYLA_')
+        bus.listen('a-domain.an-event', 'testing', callback)
+        payload = EventPayload(
+            event_name='a-domain.an-event',
+            content={'name': 'test-name', 'text': 'test-text'},
+            context={'channel': 'test-channel',
+                     'channel_user': {'name': 'test-user', 'id': 24}})
+
+        async def doit():
+            await bus.start()
+            await bus.emit_many([payload, payload])
+            await settle(lambda: len(received) == 2)
+            await bus.queue_manager.stop()
+            await settle()
+        helpers.aio_run(doit())
+        assert received == ['test-name', 'test-name']
+
+    def test_dispatch_by_event_name(self):
+        received = []
+
+        async def created(event):
+            received.append(('created', event.content['name'],
+                             event.schema_version))
+            await event.ack()
+
+        async def deleted(event):
+            received.append(('deleted', event.content['name'],
+                             event.schema_version))
+            await event.ack()
+        bus = EventBus('TWYLA_')
+        bus.listen_many({'a-domain.an-event': created,
+                         'other-domain.to-be-listened': deleted},
+                        'a-service.testing')
+
+        def payload(event_name):
+            return EventPayload(
+                event_name=event_name,
+                content={'name': event_name, 'text': 'test-text'},
+                context={'channel': 'test-channel',
+                         'channel_user': {'name': 'test-user', 'id': 24}})
+
+        async def doit():
+            await bus.start()
+            await bus.emit_many([payload('other-domain.to-be-listened'),
+                                 payload('a-domain.an-event')])
+            await settle(lambda: len(received) == 2)
+            await bus.queue_manager.stop()
+            await settle()
+        helpers.aio_run(doit())
+        assert received == [('deleted', 'other-domain.to-be-listened', 1),
+                            ('created', 'a-domain.an-event', 1)]
+
+
+class MemoryTransportTests(TransportTests, unittest.TestCase):
+    transport = 'memory'
+
+
+class AmqpTransportTests(TransportTests, unittest.TestCase):
+    transport = 'amqp'
+
+
+class AioamqpTransportTests(TransportTests, unittest.TestCase):
+    transport = 'aioamqp'
+
+
+def test_get_transport():
+    assert transports.get_transport().name == 'aioamqp'
+    assert transports.get_transport('memory') is transports.MemoryTransport
+    assert transports.available_transports() == ['aioamqp', 'amqp', 'memory']
+    with pytest.raises(ValueError):
+        transports.get_transport('carrier-pigeon')
+
+
+@mock.patch.dict(os.environ, {'TWYLA_TRANSPORT': 'memory',
+                              'TWYLA_LOOP': 'asyncio'})
+def test_main_runs_on_its_own_loop_until_sigterm():
+    memory.reset()
+    set_schemata(*common.schemata_fixtures())
+    received = []
+
+    async def callback(event):
+        received.append(event.content['name'])
+        await event.ack()
+    # Everything is set up before the loop main runs on exists
+    bus = EventBus('TWYLA_')
+    bus.listen('a-domain.an-event', 'testing', callback)
+    stream = bus.stream('a-domain.an-event', 'streaming')
+    payload = EventPayload(
+        event_name='a-domain.an-event',
+        content={'name': 'test-name', 'text': 'test-text'},
+        context={'channel': 'test-channel',
+                 'channel_user': {'name': 'test-user', 'id': 24}})
+
+    async def emit_and_stop():
+        await bus.emit(payload)
+        await settle(lambda: received)
+        os.kill(os.getpid(), signal.SIGTERM)
+    loop = bus.new_event_loop()
+    try:
+        loop.call_later(0.05, lambda: loop.create_task(emit_and_stop()))
+        bus.main(loop)
+    finally:
+        loop.close()
+        asyncio.set_event_loop_policy(None)
+        asyncio.set_event_loop(helpers.aio_run.__self__)
+    assert received == ['test-name']
+    assert stream.closed
+    memory.reset()
@@ -0,0 +1,79 @@
+import asyncio
+import signal
+import unittest
+
+from twyla.service import telemetry, workers
+from twyla.service.test import helpers
+
+
+class FakeEventBus:
+    """Counts a received event, then runs until SIGTERM like EventBus.main"""
+
+    def __init__(self, aggregator, crash=False):
+        self.aggregator = aggregator
+        self.crash = crash
+
+    def new_event_loop(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        return loop
+
+    def main(self, loop):
+        if self.crash:
+            raise SystemExit(1)
+        self.aggregator.count('telemetry.received')
+        self.aggregator.gauge('telemetry.in_flight', 1)
+        self.aggregator.timing('telemetry.handler', 10)
+        loop.add_signal_handler(signal.SIGTERM, loop.stop)
+        loop.run_forever()
+
+
+def create_event_bus(aggregator):
+    return FakeEventBus(aggregator)
+
+
+def create_crashing_event_bus(aggregator):
+    return FakeEventBus(aggregator, crash=True)
+
+
+class SupervisorTests(unittest.TestCase):
+
+    def run_supervisor(self, supervisor, duration):
+        async def doit():
+            running = asyncio.ensure_future(supervisor.run(poll_interval=0.01))
+            await asyncio.sleep(duration)
+            supervisor.stop()
+            await running
+        helpers.aio_run(doit())
+
+    def test_metrics_of_workers_are_merged(self):
+        sent = {}
+        aggregator = telemetry.Aggregator(
+            lambda name, value, timestamp: sent.__setitem__(name, value))
+        supervisor = workers.Supervisor(create_event_bus, workers=2,
+                                        aggregator=aggregator,
+                                        metrics_interval=0.05,
+                                        start_method='fork')
+        self.run_supervisor(supervisor, 0.5)
+        assert sent['telemetry.received'] == 2
+        assert sent['telemetry.handler.count'] == 2
+        # Gauges are kept apart per worker instead of overwriting each other
+        assert sent['telemetry.in_flight.worker-0'] == 1
+        assert sent['telemetry.in_flight.worker-1'] == 1
+        assert supervisor.restarts == 0
+        # SIGTERM was forwarded and the workers stopped on their own
+        assert [worker.exitcode for worker in supervisor.workers] == [0, 0]
+
+    def test_exited_workers_are_restarted(self):
+        supervisor = workers.Supervisor(create_crashing_event_bus, workers=1,
+                                        restart_min_delay=0.01,
+                                        restart_max_delay=0.02,
+                                        start_method='fork')
+        self.run_supervisor(supervisor, 0.5)
+        assert supervisor.restarts >= 2
+        assert not supervisor.workers[0].is_alive()
+
+    def test_workers_default_to_cpu_count(self):
+        supervisor = workers.Supervisor(create_event_bus)
+        assert supervisor.worker_count >= 1
+        assert len(supervisor.workers) == supervisor.worker_count
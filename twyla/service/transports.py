@@ -0,0 +1,153 @@
+"""
+Transports connect QueueManager to a broker.
+
+A transport has a name and a connect coroutine function taking the
+configuration of the queue manager and the event loop. connect returns an open
+protocol (a connection) with the interface of aioamqp's AmqpProtocol that
+QueueManager relies on:
+
+- protocol: state (aioamqp.protocol.OPEN while connected), channel(), close()
+  and wait_closed()
+- declare: channel.exchange_declare, queue_declare (returning the queue name
+  and its message and consumer counts) and queue_bind
+- publish: channel.publish and confirm_select; with publisher confirms the
+  broker's acks and nacks are passed to channel.basic_server_ack and
+  basic_server_nack, which can be replaced (see queues.ConfirmTracker)
+- consume: channel.basic_qos and basic_consume, whose callback is awaited with
+  (channel, body, envelope, properties) for every delivery. The callbacks of a
+  channel are awaited one after another, but not in the frame reader of the
+  connection (see consumer), so they can wait for replies and confirms.
+- ack: channel.basic_client_ack and basic_reject
+- channel.is_open and close()
+
+Errors are raised as the exceptions of aioamqp.exceptions.
+
+The transport is selected with the transport setting of the queue manager:
+
+- aioamqp (default): the aioamqp client
+- amqp: the client of twyla.service.amqp, with a faster frame codec (needs
+  Python 3.7 or later)
+- memory: the in-process broker of twyla.service.memory
+"""
+import asyncio
+import collections
+import logging
+
+import aioamqp
+
+import twyla.service.memory as memory
+
+logger = logging.getLogger(__name__)
+
+
+class Deliveries:
+    """Awaits a consumer callback for every delivery in a task of its own.
+
+    aioamqp awaits consumer callbacks in the frame reader of the connection. A
+    callback waiting for anything the broker sends, like the confirms of its
+    emits or the reply to opening a channel, would wait forever, and a slow
+    one holds up every other channel of the connection. Deliveries are queued
+    here instead and handed to the callback one after another, like the other
+    transports do.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.deliveries = collections.deque()
+        self.delivering = None
+
+    async def __call__(self, channel, body, envelope, properties):
+        self.deliveries.append((channel, body, envelope, properties))
+        if self.delivering is None:
+            self.delivering = asyncio.ensure_future(self.run_deliveries())
+
+    async def run_deliveries(self):
+        try:
+            while self.deliveries:
+                delivery = self.deliveries.popleft()
+                # Deliveries of a closed channel can not be acked any more,
+                # the broker delivers them again.
+                if not delivery[0].is_open:
+                    continue
+                try:
+                    await self.callback(*delivery)
+                except Exception: # pylint: disable-msg=broad-except
+                    logger.exception("Error in consumer callback")
+        finally:
+            self.delivering = None
+
+
+class AioamqpTransport:
+    name = 'aioamqp'
+
+    @staticmethod
+    def consumer(callback):
+        """Return the callback to pass to basic_consume"""
+        return Deliveries(callback)
+
+    @staticmethod
+    async def connect(config, loop):
+        _, protocol = await aioamqp.connect(
+            config['amqp_host'],
+            config['amqp_port'],
+            config['amqp_user'],
+            config['amqp_pass'],
+            config['amqp_vhost'],
+            loop=loop
+        )
+        return protocol
+
+
+class AmqpTransport:
+    name = 'amqp'
+
+    @staticmethod
+    def consumer(callback):
+        # Deliveries are already handed to callbacks outside the reader
+        return callback
+
+    @staticmethod
+    async def connect(config, loop):
+        # Imported here as it is built on asyncio.BufferedProtocol, which is
+        # new in Python 3.7
+        import twyla.service.amqp as amqp
+        _, protocol = await amqp.connect(
+            config['amqp_host'],
+            config['amqp_port'],
+            config['amqp_user'],
+            config['amqp_pass'],
+            config['amqp_vhost'],
+            loop=loop
+        )
+        return protocol
+
+
+class MemoryTransport:
+    name = 'memory'
+
+    @staticmethod
+    def consumer(callback):
+        # Deliveries are already handed to callbacks outside the reader
+        return callback
+
+    @staticmethod
+    async def connect(config, loop):
+        _, protocol = await memory.connect(
+            virtualhost=config.get('amqp_vhost', '/'), loop=loop)
+        return protocol
+
+
+_TRANSPORTS = [AioamqpTransport, AmqpTransport, MemoryTransport]
+
+
+def available_transports():
+    return [transport.name for transport in _TRANSPORTS]
+
+
+def get_transport(name: str=None):
+    """Return the transport with the given name, aioamqp by default"""
+    name = name or AioamqpTransport.name
+    for transport in _TRANSPORTS:
+        if transport.name == name:
+            return transport
+    raise ValueError(f'Unknown transport {name}')
@@ -0,0 +1,211 @@
+"""
+Runs an event bus in several worker processes, so a service can use more than
+one core for decoding, validating and handling events.
+
+    def create_event_bus(aggregator):
+        t = Telemetry()
+        t.register_ticker(aggregator.count, 'received')
+        event_bus = EventBus('EVENT_BUS_', telemetry=t)
+        event_bus.listen('api.user_input', 'consumer', callback)
+        return event_bus
+
+    Supervisor(create_event_bus, workers=4).main()
+
+Every worker calls create_event_bus and runs the returned event bus with its
+own connection and consumers. The supervisor restarts workers that exit and,
+on SIGTERM or SIGINT, forwards SIGTERM to them, so they finish the events in
+flight before stopping (see EventBus.stop_main).
+
+create_event_bus is called with an Aggregator of the worker whose metrics are
+sent to the supervisor, which merges those of all workers and sends them with
+its own aggregator, if it has one. Counters and timers are added up, gauges are
+sent per worker as <name>.worker-<n>. With the spawn or forkserver start methods,
+create_event_bus has to be a module level function.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import time
+
+from twyla.service.event_bus import backoff_delay
+from twyla.service.telemetry import Aggregator
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerAggregator(Aggregator):
+    """Aggregator of a worker process that sends its metrics to the supervisor"""
+
+    def __init__(self, metrics_queue, flush_interval: float=1.0,
+                 relative_accuracy: float=0.01, source: str=None):
+        super().__init__(metrics_queue.put, flush_interval,
+                         relative_accuracy=relative_accuracy)
+        self.metrics_queue = metrics_queue
+        # Name of the worker, see Aggregator.merge
+        self.source = source
+
+    def flush(self):
+        counters, gauges, timers = self.take()
+        if counters or gauges or timers:
+            self.metrics_queue.put((counters, gauges, timers, self.source))
+
+
+def run_worker(create_event_bus, metrics_queue, flush_interval, source):
+    # The signal handling and event loop of the supervisor are inherited with
+    # the fork start method; the worker needs its own.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    aggregator = None
+    if metrics_queue is not None:
+        aggregator = WorkerAggregator(metrics_queue, flush_interval,
+                                      source=source)
+    event_bus = create_event_bus(aggregator)
+    loop = event_bus.new_event_loop()
+    if aggregator is not None:
+        loop.run_until_complete(aggregator.start())
+    event_bus.main(loop)
+    if aggregator is not None:
+        aggregator.flush()
+        # Wait until the metrics are written before the process exits
+        metrics_queue.close()
+        metrics_queue.join_thread()
+
+
+class Supervisor:
+    """Starts and watches worker processes running an event bus.
+
+    A worker that exits is started again after an exponential backoff
+    between restart_min_delay and restart_max_delay seconds. The backoff
+    starts over once a worker ran for restart_max_delay seconds. On shutdown,
+    workers still running after shutdown_timeout seconds are killed.
+    """
+
+    #pylint: disable-msg=too-many-instance-attributes
+    def __init__(self, create_event_bus, workers: int=None,
+                 aggregator: Aggregator=None, metrics_interval: float=1.0,
+                 restart_min_delay: float=0.5, restart_max_delay: float=30,
+                 shutdown_timeout: float=30, start_method: str=None):
+        self.create_event_bus = create_event_bus
+        self.worker_count = workers or os.cpu_count() or 1
+        self.aggregator = aggregator
+        self.metrics_interval = metrics_interval
+        self.restart_min_delay = restart_min_delay
+        self.restart_max_delay = restart_max_delay
+        self.shutdown_timeout = shutdown_timeout
+        self.context = multiprocessing.get_context(start_method)
+        self.metrics_queue = None
+        if aggregator is not None:
+            self.metrics_queue = self.context.Queue()
+        self.workers = [None] * self.worker_count
+        self.started_at = [0.0] * self.worker_count
+        self.attempts = [0] * self.worker_count
+        self.restart_at = [None] * self.worker_count
+        self.restarts = 0
+        self.stopping = None
+
+
+    def start_worker(self, slot: int):
+        process = self.context.Process(
+            target=run_worker,
+            args=(self.create_event_bus, self.metrics_queue,
+                  self.metrics_interval, f'worker-{slot}'),
+            name=f'twyla-worker-{slot}')
+        process.start()
+        logger.info("Started worker %d (pid %d)", slot, process.pid)
+        self.workers[slot] = process
+        self.started_at[slot] = time.monotonic()
+        self.restart_at[slot] = None
+
+
+    def check_workers(self):
+        now = time.monotonic()
+        for slot, process in enumerate(self.workers):
+            if self.restart_at[slot] is not None:
+                if now >= self.restart_at[slot]:
+                    self.restarts += 1
+                    self.start_worker(slot)
+                continue
+            if process.is_alive():
+                continue
+            if now - self.started_at[slot] >= self.restart_max_delay:
+                self.attempts[slot] = 0
+            delay = backoff_delay(self.attempts[slot], self.restart_min_delay,
+                                  self.restart_max_delay)
+            self.attempts[slot] += 1
+            self.restart_at[slot] = now + delay
+            logger.warning("Worker %d (pid %d) exited with %s, restarting "
+                           "in %.1fs", slot, process.pid, process.exitcode,
+                           delay)
+
+
+    def collect_metrics(self):
+        if self.metrics_queue is None:
+            return
+        while True:
+            try:
+                metrics = self.metrics_queue.get_nowait()
+            except queue.Empty:
+                return
+            self.aggregator.merge(*metrics)
+
+
+    def stop(self):
+        self.stopping.set()
+
+
+    async def run(self, poll_interval: float=0.1):
+        """Run the workers until stop is called or a signal is received"""
+        loop = asyncio.get_event_loop()
+        self.stopping = asyncio.Event()
+        loop.add_signal_handler(signal.SIGINT, self.stop)
+        loop.add_signal_handler(signal.SIGTERM, self.stop)
+        if self.aggregator is not None:
+            await self.aggregator.start()
+        try:
+            for slot in range(self.worker_count):
+                self.start_worker(slot)
+            while not self.stopping.is_set():
+                try:
+                    await asyncio.wait_for(self.stopping.wait(),
+                                           poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self.collect_metrics()
+                if not self.stopping.is_set():
+                    self.check_workers()
+            await self.shutdown(poll_interval)
+        finally:
+            loop.remove_signal_handler(signal.SIGINT)
+            loop.remove_signal_handler(signal.SIGTERM)
+            if self.aggregator is not None:
+                self.collect_metrics()
+                await self.aggregator.stop()
+
+
+    async def shutdown(self, poll_interval: float=0.1):
+        running = [process for process in self.workers
+                   if process is not None and process.is_alive()]
+        logger.info("Stopping %d workers", len(running))
+        for process in running:
+            process.terminate()
+        deadline = time.monotonic() + self.shutdown_timeout
+        while any(process.is_alive() for process in running):
+            if time.monotonic() >= deadline:
+                for process in running:
+                    if process.is_alive():
+                        logger.warning("Killing worker (pid %d)", process.pid)
+                        os.kill(process.pid, signal.SIGKILL)
+                break
+            # Keep reading metrics, a worker with a full queue would not exit
+            self.collect_metrics()
+            await asyncio.sleep(poll_interval)
+        for process in running:
+            process.join()
+
+
+    def main(self):
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(self.run())